@@ -0,0 +1,243 @@
+#  Copyright (c) 2024. Henry Yang
+#
+#  This program is licensed under the GNU General Public License v3.0.
+
+"""
+数据库压力测试：在临时目录里生成大量用户和对话记录，按插件的调用方式重放几种操作组合，统计每个方法的吞吐量和延迟。
+不会读写正式的 userdata.db。
+
+Database benchmark: populates a scratch database with many users and dialogue blobs, replays operation mixes the
+way the plugins call BotDatabase, and reports throughput and latency per method. The real userdata.db is never touched.
+
+用法 Usage (在项目根目录运行 run from the project root):
+    python benchmarks/database_benchmark.py --users 100000 --ops 20000
+    python benchmarks/database_benchmark.py --users 1000000 --backend sqlite --mix sign_in_storm --mix leaderboard
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import yaml
+from loguru import logger
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 每种操作组合：操作名 -> 权重
+MIXES = {
+    "sign_in_storm": {"sign_in": 1},  # 每天重置签到后大家集中签到，大部分用户不在缓存里
+    "gpt": {"gpt_charge": 0.7, "private_gpt": 0.3},  # GPT扣费和私聊上下文读写
+    "leaderboard": {"leaderboard": 0.5, "points_change": 0.5},  # 查排行榜的同时积分不停变化
+    "red_packet": {"red_packet": 1},  # 发红包后群里的人同时抢
+    "mixed": {"sign_in": 0.3, "points_query": 0.25, "gpt_charge": 0.25, "private_gpt": 0.1, "leaderboard": 0.05,
+              "red_packet": 0.05},
+}
+
+
+class Benchmark:
+    def __init__(self, db, args):
+        self.db = db
+        self.users = args.users
+        self.skew = args.skew
+        self.dialogue_users = int(args.users * args.dialogue_ratio)
+        self.dialogue_turns = args.dialogue_turns
+        self.dialogue_text = "测" * (args.dialogue_size // 3)  # 中文每个字3字节
+        self.group_size = args.group_size
+        self.random = random.Random(args.seed)
+
+        self.latencies = defaultdict(list)  # 方法名 -> [耗时（秒）]
+        self.signed_in = set()  # 签到风暴里已经签过到的用户
+
+    def wxid(self, index: int) -> str:
+        return f"wxid_bench_{index:07d}"
+
+    def pick_user(self) -> str:  # 活跃度不均匀，skew越大越集中在少数用户上
+        return self.wxid(int(self.users * self.random.random() ** self.skew))
+
+    def pick_dialogue_user(self) -> str:
+        return self.wxid(int(self.dialogue_users * self.random.random() ** self.skew))
+
+    async def call(self, method: str, *args):  # 调用数据库方法并记录耗时
+        start = time.perf_counter()
+        result = await getattr(self.db, method)(*args)
+        self.latencies[method].append(time.perf_counter() - start)
+        return result
+
+    # -----生成数据-----
+
+    def populate(self, batch_size: int = 10000) -> None:
+        storage = self.db.storage
+        now = time.time()
+        for start in range(0, self.users, batch_size):
+            wxids = [self.wxid(index) for index in range(start, min(start + batch_size, self.users))]
+            points = {wxid: self.random.randint(0, 5000) for wxid in wxids}
+            storage.write_users(
+                wxids,
+                {wxid: (points[wxid], f"用户{wxid[-7:]}", 0, 0) for wxid in wxids},
+                [(wxid, points[wxid], points[wxid], "benchmark", now) for wxid in wxids])  # 积分和流水保持一致
+        self.db.wxid_set.update(self.wxid(index) for index in range(self.users))
+
+        for index in range(self.dialogue_users):
+            turns = []
+            for turn in range(self.dialogue_turns):
+                turns.append({"role": "user" if turn % 2 == 0 else "assistant", "content": self.dialogue_text})
+            storage.append_dialogue(self.wxid(index), turns, 0)
+
+    # -----操作，和插件里的调用顺序一致-----
+
+    async def sign_in(self) -> None:
+        wxid = self.pick_user()
+        if await self.call("async_get_stat", wxid) == 0:
+            await self.call("async_add_points", wxid, self.random.randint(3, 20), "sign_in")
+            await self.call("async_set_stat", wxid, 1)
+        await self.call("async_get_nickname", wxid)
+
+    async def points_query(self) -> None:
+        wxid = self.pick_user()
+        await self.call("async_get_points", wxid)
+        await self.call("async_get_nickname", wxid)
+
+    async def gpt_charge(self) -> None:
+        wxid = self.pick_user()
+        if await self.call("async_get_points", wxid) >= 3 and not await self.call("async_get_whitelist", wxid):
+            await self.call("async_spend_points", wxid, 3, "mention_gpt")
+
+    async def private_gpt(self) -> None:
+        wxid = self.pick_dialogue_user()
+        if await self.call("async_get_points", wxid) < 3 or await self.call("async_get_whitelist", wxid):
+            return
+        await self.call("async_get_dialogue", wxid, self.dialogue_turns)
+        turns = [{"role": "user", "content": self.dialogue_text}, {"role": "assistant", "content": self.dialogue_text}]
+        await self.call("async_append_dialogue", wxid, turns, self.dialogue_turns)
+        await self.call("async_add_points", wxid, -3, "private_gpt")
+
+    async def leaderboard(self) -> None:
+        await self.call("async_get_leaderboard", 30)
+
+    async def points_change(self) -> None:
+        await self.call("async_add_points", self.pick_user(), self.random.randint(-50, 50), "benchmark")
+
+    async def red_packet(self) -> None:
+        group_start = self.random.randrange(0, max(self.users - self.group_size, 1))  # 一个群的成员是连续的一段用户
+        members = [self.wxid(group_start + index) for index in range(min(self.group_size, self.users))]
+        sender = self.random.choice(members)
+        if not await self.call("async_spend_points", sender, 100, "red_packet"):
+            return
+
+        grabbers = self.random.sample(members, min(10, len(members)))
+
+        async def grab(wxid):
+            await self.call("async_get_nickname", wxid)
+            await self.call("async_add_points", wxid, 10, "red_packet")
+
+        await asyncio.gather(*(grab(wxid) for wxid in grabbers))
+
+    # -----运行-----
+
+    async def run_mix(self, name: str, ops: int, concurrency: int, flush_interval: float) -> None:
+        mix = MIXES[name]
+        operations = self.random.choices(list(mix), weights=list(mix.values()), k=ops)
+        if name == "sign_in_storm":
+            await self.db.async_reset_stat()
+
+        self.latencies.clear()
+        pending = iter(operations)
+
+        async def worker():  # 同时处理concurrency条消息
+            for operation in pending:
+                await getattr(self, operation)()
+
+        async def flusher():  # 和 plans/database_flush.py 一样定时写入
+            while True:
+                await asyncio.sleep(flush_interval)
+                await self.call("async_flush")
+
+        flush_task = asyncio.create_task(flusher())
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        flush_task.cancel()
+        await self.call("async_flush")  # 计入最后一次写入
+        elapsed = time.perf_counter() - start
+
+        self.report(name, ops, elapsed)
+
+    def report(self, name: str, ops: int, elapsed: float) -> None:
+        print(f"\n== {name}: {ops} 次操作，用时 {elapsed:.2f} 秒，{ops / elapsed:.0f} ops/s ==")
+        print(f"{'方法 method':<26}{'次数 calls':>12}{'ops/s':>10}{'平均 mean':>12}{'p50':>10}{'p99':>10}{'最大 max':>12}")
+        for method, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            print(f"{method:<26}{len(latencies):>12}{len(latencies) / elapsed:>10.0f}"
+                  f"{sum(latencies) / len(latencies) * 1000:>10.3f}ms{percentile(latencies, 0.5) * 1000:>8.3f}ms"
+                  f"{percentile(latencies, 0.99) * 1000:>8.3f}ms{latencies[-1] * 1000:>10.3f}ms")
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    return sorted_values[int(fraction * (len(sorted_values) - 1))]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="BotDatabase 压力测试")
+    parser.add_argument("--users", type=int, default=100000, help="生成的用户数")
+    parser.add_argument("--ops", type=int, default=20000, help="每种组合的操作次数")
+    parser.add_argument("--concurrency", type=int, default=50, help="同时处理的消息数")
+    parser.add_argument("--backend", default="sqlite", choices=["sqlite", "memory", "kv"], help="存储后端")
+    parser.add_argument("--cache-size", type=int, default=None, help="内存中缓存的用户数，默认用 main_config.yml 的设置")
+    parser.add_argument("--flush-interval", type=float, default=None, help="定时写入间隔（秒），默认用 main_config.yml 的设置")
+    parser.add_argument("--skew", type=float, default=3.0, help="活跃度集中程度，1为均匀")
+    parser.add_argument("--dialogue-ratio", type=float, default=0.1, help="有私聊GPT对话记录的用户比例")
+    parser.add_argument("--dialogue-turns", type=int, default=20, help="每个用户保存的对话条数")
+    parser.add_argument("--dialogue-size", type=int, default=1200, help="每条对话的字节数")
+    parser.add_argument("--group-size", type=int, default=200, help="抢红包的群人数")
+    parser.add_argument("--mix", action="append", choices=list(MIXES), help="要运行的组合，可以重复，默认全部运行")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--path", default=None, help="临时数据库目录，指定时运行后保留")
+    return parser.parse_args()
+
+
+async def main(args):
+    with open(os.path.join(PROJECT_ROOT, "main_config.yml"), "r", encoding="utf-8") as f:  # 读取设置
+        main_config = yaml.safe_load(f.read())
+
+    main_config["database_backend"] = args.backend
+    if args.cache_size is not None:
+        main_config["database_user_cache_size"] = args.cache_size
+    if args.flush_interval is not None:
+        main_config["database_flush_interval"] = args.flush_interval
+
+    # BotDatabase 从当前目录读取设置和数据库，切换到临时目录就不会碰到正式数据
+    work_path = args.path or tempfile.mkdtemp(prefix="xybot_benchmark_")
+    os.makedirs(work_path, exist_ok=True)
+    with open(os.path.join(work_path, "main_config.yml"), "w", encoding="utf-8") as f:
+        yaml.safe_dump(main_config, f, allow_unicode=True)
+    os.chdir(work_path)
+    sys.path.insert(0, PROJECT_ROOT)
+
+    from utils.database import BotDatabase
+
+    db = BotDatabase()
+    benchmark = Benchmark(db, args)
+
+    print(f"后端 {args.backend}，{args.users} 个用户，缓存 {db.user_cache_size} 个，目录 {work_path}")
+    start = time.perf_counter()
+    benchmark.populate()
+    print(f"生成数据用时 {time.perf_counter() - start:.2f} 秒")
+
+    try:
+        for name in args.mix or list(MIXES):
+            await benchmark.run_mix(name, args.ops, args.concurrency, db.flush_interval)
+    finally:
+        db.flush()
+        if not args.path:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    logger.remove()  # 每次积分修改都会打日志，只保留警告以上，避免日志成为瓶颈
+    logger.add(sys.stderr, level="WARNING")
+    asyncio.run(main(parse_args()))
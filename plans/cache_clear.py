@@ -1,35 +1,30 @@
 import asyncio
-import os
 
 import schedule
-import yaml
 from loguru import logger
 from wcferry import client
 
+from utils.cache_manager import cache_manager
+from utils.media_store import media_store
 from utils.plans_interface import PlansInterface
+from utils.response_cache import response_cache
 
 
 class cache_clear(PlansInterface):
     def __init__(self):
-        main_config_path = "main_config.yml"
-        with open(main_config_path, "r", encoding="utf-8") as f:  # 读取设置
-            main_config = yaml.safe_load(f.read())
-
-        self.timezone = main_config["timezone"]  # 时区
+        pass
 
     async def job(self):
-        path = "resources/cache/"  # 图片缓存路径
-        for filename in os.listdir(path):  # 遍历文件夹
-            file_path = os.path.join(path, filename)  # 获取文件路径
-            # 判断路径是否为文件
-            if os.path.isfile(file_path):  # 如果是文件
-                # 删除文件
-                os.remove(file_path)
-        logger.info("[计划]清除缓存成功")  # 记录日志
+        loop = asyncio.get_running_loop()
+        evicted = await loop.run_in_executor(None, cache_manager.evict)  # 只淘汰过期或超出大小上限的文件，正在发送的文件不会被删除
+        if evicted:
+            logger.info(f"[计划]已淘汰 {evicted} 个缓存文件")  # 记录日志
+        await loop.run_in_executor(None, media_store.prune, cache_manager.max_age)  # 清理对应文件已过期的消息索引
+        await loop.run_in_executor(None, response_cache.flush_last_used)  # 批量写入回答缓存的最后使用时间
 
     def job_async(self):
         loop = asyncio.get_running_loop()
         loop.create_task(self.job())
 
     def run(self, bot: client.Wcf):
-        schedule.every(6).hours.do(self.job_async)  # 每六小时执行一次
+        schedule.every(1).minutes.do(self.job_async)  # 每分钟检查一次，单次开销只和需要淘汰的文件数有关
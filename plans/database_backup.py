@@ -0,0 +1,26 @@
+import asyncio
+
+import schedule
+from loguru import logger
+from wcferry import client
+
+from utils.database_backup import DatabaseBackup
+from utils.plans_interface import PlansInterface
+
+
+class database_backup(PlansInterface):
+    def __init__(self):
+        self.backup = DatabaseBackup()
+
+    async def job(self):
+        try:
+            await self.backup.async_backup()  # 在线备份，不会阻塞数据库写入和消息处理
+        except Exception as error:
+            logger.error(f"[计划]数据库备份失败: {error}")
+
+    def job_async(self):
+        loop = asyncio.get_running_loop()
+        loop.create_task(self.job())
+
+    def run(self, bot: client.Wcf):
+        schedule.every(self.backup.interval).hours.do(self.job_async)
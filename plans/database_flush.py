@@ -0,0 +1,22 @@
+import asyncio
+
+import schedule
+from wcferry import client
+
+from utils.database import BotDatabase
+from utils.plans_interface import PlansInterface
+
+
+class database_flush(PlansInterface):
+    def __init__(self):
+        self.db = BotDatabase()
+
+    async def job(self):
+        await self.db.async_flush()  # 把内存中的修改成批写入数据库
+
+    def job_async(self):
+        loop = asyncio.get_running_loop()
+        loop.create_task(self.job())
+
+    def run(self, bot: client.Wcf):
+        schedule.every(self.db.flush_interval).seconds.do(self.job_async)
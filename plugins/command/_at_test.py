@@ -20,7 +20,7 @@ class at_test(PluginInterface):
     async def run(self, bot: client.Wcf, recv: XYBotWxMsg):
         recv.content = re.split(" |\u2005", recv.content)  # 拆分消息
 
-        out_message = f"@{self.db.get_nickname(recv.sender)} At test!!!"
+        out_message = f"@{await self.db.async_get_nickname(recv.sender)} At test!!!"
         logger.info(f'[发送信息]{out_message}| [发送到] {recv.roomid}')
         bot.send_text(out_message, recv.roomid, recv.sender)
 
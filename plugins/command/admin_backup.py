@@ -0,0 +1,72 @@
+#  Copyright (c) 2024. Henry Yang
+#
+#  This program is licensed under the GNU General Public License v3.0.
+
+import os
+import re
+
+import yaml
+from loguru import logger
+from wcferry import client
+
+from utils.database import BotDatabase
+from utils.database_backup import DatabaseBackup
+from utils.plugin_interface import PluginInterface
+from wcferry_helper import XYBotWxMsg
+
+
+class admin_backup(PluginInterface):
+    def __init__(self):
+        config_path = "plugins/command/admin_backup.yml"
+        with open(config_path, "r", encoding="utf-8") as f:  # 读取插件设置
+            config = yaml.safe_load(f.read())
+
+        self.command_format_menu = config["command_format_menu"]  # 获取指令格式
+
+        main_config_path = "main_config.yml"
+        with open(main_config_path, "r", encoding="utf-8") as f:  # 读取设置
+            main_config = yaml.safe_load(f.read())
+
+        self.admin_list = main_config["admins"]  # 获取管理员列表
+
+        self.db = BotDatabase()  # 实例化数据库类
+        self.backup = DatabaseBackup()
+
+    async def run(self, bot: client.Wcf, recv: XYBotWxMsg):
+        recv.content = re.split(" |\u2005", recv.content)  # 拆分消息
+
+        if recv.sender not in self.admin_list:  # 判断是否为管理员
+            await self.send_friend_or_group(bot, recv, "-----XYBot-----\n❌你配用这个指令吗？")
+            return
+
+        if len(recv.content) == 1:  # 立即备份
+            await self.send_friend_or_group(bot, recv, "-----XYBot-----\n开始备份数据库，请稍等！💾")
+            try:
+                path = await self.backup.async_backup()
+                out_message = f"-----XYBot-----\n✅数据库已备份！\n{os.path.basename(path)} {os.path.getsize(path) / 1024:.1f}KB"
+            except Exception as error:
+                logger.error(f"[备份]数据库备份失败: {error}")
+                out_message = f"-----XYBot-----\n❌数据库备份失败！\n{error}"
+            await self.send_friend_or_group(bot, recv, out_message)
+
+        elif recv.content[1] == "列表":  # 查看已有备份
+            backups = self.backup.list_backups()
+            out_message = "-----XYBot-----\n📋已有备份："
+            for file, size in backups:
+                out_message += f"\n{file} {size / 1024:.1f}KB"
+            if not backups:
+                out_message += "\n无"
+            await self.send_friend_or_group(bot, recv, out_message)
+
+        else:
+            await self.send_friend_or_group(bot, recv, f"-----XYBot-----\n❌指令格式错误！\n\n{self.command_format_menu}")
+
+    async def send_friend_or_group(self, bot: client.Wcf, recv: XYBotWxMsg, out_message="null"):
+        if recv.from_group():  # 判断是群还是私聊
+            out_message = f"@{await self.db.async_get_nickname(recv.sender)}\n{out_message}"
+            logger.info(f'[发送@信息]{out_message}| [发送到] {recv.roomid}')
+            bot.send_text(out_message, recv.roomid, recv.sender)  # 发送@信息
+
+        else:
+            logger.info(f'[发送信息]{out_message}| [发送到] {recv.roomid}')
+            bot.send_text(out_message, recv.roomid)  # 发送
@@ -49,40 +49,27 @@ class admin_points(PluginInterface):
                 else:
                     change_wxid = recv.content[2]
 
-                self.db.set_points(change_wxid, int(recv.content[1]))
+                await self.db.async_set_points(change_wxid, int(recv.content[1]))
 
-                nickname = self.db.get_nickname(change_wxid)  # 尝试获取昵称
+                nickname = await self.db.async_get_nickname(change_wxid)  # 尝试获取昵称
 
                 out_message = f'-----XYBot-----\n😊成功将 {change_wxid} {nickname if nickname else ""} 的积分设置为 {recv.content[1]}！'
                 await self.send_friend_or_group(bot, recv, out_message)
 
 
-            elif recv.content[1] == "加":  # 操作是加分
+            elif recv.content[1] in ["加", "减"] and len(recv.content) >= 4:  # 操作是加分/减分，可以同时修改多个人
                 if recv.content[3].startswith('@') and recv.ats:  # 判断是@还是wxid
-                    change_wxid = recv.ats[-1]
+                    change_wxids = recv.ats
                 else:
-                    change_wxid = recv.content[3]
-
-                self.db.add_points(change_wxid, int(recv.content[2]))  # 修改积分
-
-                nickname = self.db.get_nickname(change_wxid)  # 尝试获取昵称
-                new_point = self.db.get_points(change_wxid)  # 获取修改后积分
-
-                out_message = f'-----XYBot-----\n😊成功给 {change_wxid} {nickname if nickname else ""} 加了 {recv.content[2]} 点积分，他现在有 {new_point} 点积分！'
-                await self.send_friend_or_group(bot, recv, out_message)
-
-            elif recv.content[1] == "减":  # 操作是减分
-                if recv.content[3].startswith('@'):  # 判断是@还是wxid
-                    change_wxid = recv.ats[-1]
-                else:
-                    change_wxid = recv.content[3]
-
-                self.db.add_points(change_wxid, int(recv.content[2]) * -1)  # 修改积分
+                    change_wxids = recv.content[3:]
 
-                nickname = self.db.get_nickname(change_wxid)  # 尝试获取昵称
-                new_point = self.db.get_points(change_wxid)  # 获取修改后积分
+                change = int(recv.content[2]) if recv.content[1] == "加" else int(recv.content[2]) * -1
+                await self.db.async_add_points_many({wxid: change for wxid in change_wxids}, "admin")  # 一次修改所有人的积分
 
-                out_message = f'-----XYBot-----\n😊成功给 {change_wxid} {nickname if nickname else ""} 减了 {recv.content[2]} 点积分，他现在有 {new_point} 点积分！'
+                users = await self.db.async_get_users(change_wxids)  # 一次获取昵称和修改后积分
+                out_message = "-----XYBot-----"
+                for change_wxid, user in users.items():
+                    out_message += f'\n😊成功给 {change_wxid} {user["NICKNAME"]} {recv.content[1]}了 {recv.content[2]} 点积分，他现在有 {user["POINTS"]} 点积分！'
                 await self.send_friend_or_group(bot, recv, out_message)
 
             else:
@@ -98,7 +85,7 @@ class admin_points(PluginInterface):
 
     async def send_friend_or_group(self, bot: client.Wcf, recv: XYBotWxMsg, out_message="null"):
         if recv.from_group():  # 判断是群还是私聊
-            out_message = f"@{self.db.get_nickname(recv.sender)}\n{out_message}"
+            out_message = f"@{await self.db.async_get_nickname(recv.sender)}\n{out_message}"
             logger.info(f'[发送@信息]{out_message}| [发送到] {recv.roomid}')
             bot.send_text(out_message, recv.roomid, recv.sender)  # 发送@信息
 
@@ -29,7 +29,7 @@ class admin_signin_reset(PluginInterface):
         admin_wxid = recv.sender
 
         if admin_wxid in self.admin_list:  # 如果操作人在白名单内
-            self.db.reset_stat()  # 重置数据库签到状态
+            await self.db.async_reset_stat()  # 重置数据库签到状态
             out_message = "-----XYBot-----\n😊成功重置签到状态！"
             logger.info(f'[发送信息]{out_message}| [发送到] {recv.roomid}')
             bot.send_text(out_message, recv.roomid)  # 发送信息
@@ -48,17 +48,17 @@ class admin_whitelist(PluginInterface):
                 wxid = recv.content[2]
 
             if recv.content[1] == "加入":
-                self.db.set_whitelist(wxid, 1)
+                await self.db.async_set_whitelist(wxid, 1)
 
-                nickname = self.db.get_nickname(wxid) # 尝试获取昵称
+                nickname = await self.db.async_get_nickname(wxid) # 尝试获取昵称
 
                 out_message = f"-----XYBot-----\n成功添加 {wxid} {nickname if nickname else ""} 到白名单！😊"
                 await self.send_friend_or_group(bot, recv, out_message)
 
             elif recv.content[1] == "移除":
-                self.db.set_whitelist(wxid, 0)
+                await self.db.async_set_whitelist(wxid, 0)
 
-                nickname = self.db.get_nickname(wxid)  # 尝试获取昵称
+                nickname = await self.db.async_get_nickname(wxid)  # 尝试获取昵称
 
                 out_message = f"-----XYBot-----\n成功把 {wxid} {nickname if nickname else ""} 移出白名单！😊"
                 await self.send_friend_or_group(bot, recv, out_message)
@@ -73,7 +73,7 @@ class admin_whitelist(PluginInterface):
 
     async def send_friend_or_group(self, bot: client.Wcf, recv: XYBotWxMsg, out_message="null"):
         if recv.from_group():  # 判断是群还是私聊
-            out_message = f"@{self.db.get_nickname(recv.sender)}\n{out_message}"
+            out_message = f"@{await self.db.async_get_nickname(recv.sender)}\n{out_message}"
             logger.info(f'[发送@信息]{out_message}| [发送到] {recv.roomid}')
             bot.send_text(out_message, recv.roomid, recv.sender)  # 发送@信息
 
@@ -8,7 +8,9 @@ import yaml
 from loguru import logger
 from wcferry import client
 
+from utils.llm_client import llm_client
 from utils.plugin_interface import PluginInterface
+from utils.response_cache import response_cache
 from wcferry_helper import XYBotWxMsg
 
 
@@ -95,7 +97,15 @@ class bot_status(PluginInterface):
         ], ""  # 嘿嘿
         for i in b:
             a += chr(i)
-        out_message = f"-----XYBot-----\n{self.status_message}\nBot version: {self.bot_version}\n{base64.b64decode(a).decode('utf-8')}"
+        cache_stats = response_cache.stats()
+        llm_stats = llm_client.stats()
+        out_message = f"-----XYBot-----\n{self.status_message}\nBot version: {self.bot_version}\n" \
+                      f"GPT回答缓存: {cache_stats['entries']}条 命中率{cache_stats['hit_rate']:.0%} " \
+                      f"({cache_stats['hits']}/{cache_stats['hits'] + cache_stats['misses']})\n" \
+                      f"GPT请求: 进行中{llm_stats['running']} 排队{llm_stats['waiting']} " \
+                      f"排队时间平均{llm_stats['wait_average']:.1f}秒 p95 {llm_stats['wait_p95']:.1f}秒 " \
+                      f"重试{llm_stats['retries']}次 合并{llm_stats['coalesced']}次\n" \
+                      f"{base64.b64decode(a).decode('utf-8')}"
         logger.info(f'[发送信息]{out_message}| [发送到] {recv.roomid}')
         bot.send_text(out_message, recv.roomid)  # 发送
         bot.send_pat_msg(recv.roomid, recv.sender)  # 发送拍一拍消息
@@ -11,11 +11,14 @@ import time
 
 import yaml
 from loguru import logger
-from openai import AsyncOpenAI
 from wcferry import client
 
+from utils.cache_manager import cache_manager
 from utils.database import BotDatabase
+from utils.llm_client import llm_client
 from utils.plugin_interface import PluginInterface
+from utils.response_cache import response_cache
+from utils.sensitive_words import sensitive_words
 from wcferry_helper import XYBotWxMsg
 
 
@@ -40,14 +43,6 @@ class dalle3(PluginInterface):
 
         self.admins = main_config["admins"]  # 管理员列表
 
-        self.openai_api_base = main_config["openai_api_base"]  # openai api 链接
-        self.openai_api_key = main_config["openai_api_key"]  # openai api 密钥
-
-        sensitive_words_path = "sensitive_words.yml"  # 加载敏感词yml
-        with open(sensitive_words_path, "r", encoding="utf-8") as f:  # 读取设置
-            sensitive_words_config = yaml.safe_load(f.read())
-        self.sensitive_words = sensitive_words_config["sensitive_words"]  # 敏感词列表
-
         self.db = BotDatabase()
 
     async def run(self, bot: client.Wcf, recv: XYBotWxMsg):
@@ -60,10 +55,10 @@ class dalle3(PluginInterface):
         if len(recv.content) < 2:  # 指令格式正确
             error = f"-----XYBot-----\n参数错误！🙅\n\n{self.command_format_menu}"
         # 检查积分是否足够，管理员与白名单不需要检查
-        elif user_wxid not in self.admins and self.db.get_whitelist(user_wxid) == 0 and self.db.get_points(
+        elif user_wxid not in self.admins and await self.db.async_get_whitelist(user_wxid) == 0 and await self.db.async_get_points(
                 user_wxid) < self.price:
             error = f"-----XYBot-----\n积分不足！😭需要 {self.price} 点积分！"
-        elif not self.senstitive_word_check(user_request_prompt):  # 敏感词检查
+        elif not sensitive_words.check(user_request_prompt):  # 敏感词检查
             error = "-----XYBot-----\n内容包含敏感词!⚠️"
         elif not user_request_prompt:
             error = f"-----XYBot-----\n请输入描述！🤔\n\n{self.command_format_menu}"
@@ -72,26 +67,45 @@ class dalle3(PluginInterface):
             await self.send_friend_or_group(bot, recv, error)
             return
 
+        charged = user_wxid not in self.admins and await self.db.async_get_whitelist(user_wxid) == 0  # 管理员与白名单不扣积分
+        if charged and not await self.db.async_spend_points(user_wxid, self.price, "dalle3"):  # 先扣除积分，出错时补回
+            await self.send_friend_or_group(bot, recv, f"-----XYBot-----\n积分不足！😭需要 {self.price} 点积分！")
+            return
+
         await self.send_friend_or_group(bot, recv, "-----XYBot-----\n正在生成图片，请稍等...🤔")
 
-        image_path = await self.dalle3(user_request_prompt)
+        cache_key = response_cache.key("image", self.model_name, user_request_prompt, quality=self.image_quality,
+                                       size=self.image_size)
+        image_path = response_cache.get_file(cache_key)  # 同样的描述生成过，直接用缓存的图片，照常扣积分
+        if image_path:
+            logger.info(f"[DALL·E] 使用缓存的图片: {user_request_prompt}")
+        else:
+            image_path = await llm_client.coalesce(cache_key, lambda: self.generate(user_wxid, cache_key, user_request_prompt))
 
-        if isinstance(image_path, Exception):  # 如果出现错误，向用户发送错误信息
+        if isinstance(image_path, Exception):  # 如果出现错误，补回积分并向用户发送错误信息
+            if charged:
+                await self.db.async_add_points(user_wxid, self.price, "dalle3")
             await self.send_friend_or_group(bot, recv, f"-----XYBot-----\n出现错误，未扣除积分！⚠️\n{image_path}")
             return
 
-        if user_wxid not in self.admins and self.db.get_whitelist(user_wxid) == 0:  # 如果用户不是管理员或者白名单，扣积分
-            self.db.add_points(user_wxid, -self.price)
+        if charged:
             await self.send_friend_or_group(bot, recv, f"-----XYBot-----\n🎉图片生成完毕，已扣除 {self.price} 点积分！🙏")
             bot.send_pat_msg(recv.roomid, user_wxid) # 拍一拍
 
-        bot.send_image(image_path, recv.roomid)
+        with cache_manager.pinned_file(image_path):
+            bot.send_image(image_path, recv.roomid)
         logger.info(f'[发送图片]{image_path}| [发送到] {recv.roomid}')
 
-    async def dalle3(self, prompt):  # 返回生成的图片的绝对路径，报错的话返回错误
-        client = AsyncOpenAI(api_key=self.openai_api_key, base_url=self.openai_api_base)
+    async def generate(self, wxid, cache_key, prompt):  # 同样的描述同时请求时只生成一次，大家共用这张图片
+        image_path = await self.dalle3(wxid, prompt)
+        if not isinstance(image_path, Exception):
+            response_cache.put_file(cache_key, image_path)
+        return image_path
+
+    async def dalle3(self, wxid, prompt):  # 返回生成的图片的绝对路径，报错的话返回错误
         try:
-            image_generation = await client.images.generate(
+            image_generation = await llm_client.generate_image(
+                wxid,
                 prompt=prompt,
                 model=self.model_name,
                 n=1,
@@ -103,6 +117,7 @@ class dalle3(PluginInterface):
             save_path = os.path.abspath(f"resources/cache/dalle3_{time.time_ns()}.png")
             with open(save_path, "wb") as f:
                 f.write(image_b64decode)
+            cache_manager.register(save_path)
         except Exception as e:
             return e
 
@@ -110,15 +125,9 @@ class dalle3(PluginInterface):
 
     async def send_friend_or_group(self, bot: client.Wcf, recv: XYBotWxMsg, out_message: str):
         if recv.from_group():  # 判断是群还是私聊
-            out_message = f"@{self.db.get_nickname(recv.sender)}\n{out_message}"
+            out_message = f"@{await self.db.async_get_nickname(recv.sender)}\n{out_message}"
             logger.info(f'[发送@信息]{out_message}| [发送到] {recv.roomid}')
             bot.send_text(out_message, recv.roomid, recv.sender)  # 发送@信息
         else:
             logger.info(f'[发送信息]{out_message}| [发送到] {recv.roomid}')
             bot.send_text(out_message, recv.roomid)  # 发送信息
-
-    def senstitive_word_check(self, message):  # 检查敏感词
-        for word in self.sensitive_words:
-            if word in message:
-                return False
-        return True
@@ -11,6 +11,7 @@ from loguru import logger
 from openpyxl import Workbook
 from wcferry import client
 
+from utils.cache_manager import cache_manager
 from utils.plugin_interface import PluginInterface
 from wcferry_helper import XYBotWxMsg
 
@@ -57,11 +58,13 @@ class get_contact_list(PluginInterface):
 
             excel_path = f"{self.excel_save_path}/XYBotContact_{time.time_ns()}.xlsx"  # 保存路径
             wb.save(excel_path)  # 保存表格
+            cache_manager.register(excel_path)
 
             path = os.path.abspath(excel_path)
 
             logger.info(f'[发送文件]{path}| [发送到] {recv.roomid}')  # 发送
-            bot.send_file(path, recv.roomid)  # 发送文件
+            with cache_manager.pinned_file(path):
+                bot.send_file(path, recv.roomid)  # 发送文件
 
         else:  # 用户不是管理员
             out_message = "-----XYBot-----\n❌你配用这个指令吗？"
@@ -12,6 +12,7 @@ from PIL import Image, ImageDraw
 from loguru import logger
 from wcferry import client
 
+from utils.cache_manager import cache_manager
 from utils.database import BotDatabase
 from utils.plugin_interface import PluginInterface
 from wcferry_helper import XYBotWxMsg
@@ -150,7 +151,8 @@ class gomoku(PluginInterface):
             board_image_path = self.draw_game_board(game_id)
             # 把路径转成绝对路径
             board_image_path = os.path.abspath(board_image_path)
-            bot.send_image(board_image_path, self.gomoku_games[game_id]['chatroom'])
+            with cache_manager.pinned_file(board_image_path):
+                bot.send_image(board_image_path, self.gomoku_games[game_id]['chatroom'])
             logger.info(
                 f"[发送信息](五子棋棋盘图片){board_image_path}| [发送到] {self.gomoku_games[game_id]['chatroom']}")
 
@@ -223,7 +225,8 @@ class gomoku(PluginInterface):
             board_image_path = self.draw_game_board(game_id, highlight=(x, y))
             # 把路径转成绝对路径
             board_image_path = os.path.abspath(board_image_path)
-            bot.send_image(board_image_path, self.gomoku_games[game_id]['chatroom'])
+            with cache_manager.pinned_file(board_image_path):
+                bot.send_image(board_image_path, self.gomoku_games[game_id]['chatroom'])
             logger.info(
                 f"[发送信息](五子棋棋盘图片){board_image_path}| [发送到] {self.gomoku_games[game_id]['chatroom']}")
 
@@ -295,6 +298,7 @@ class gomoku(PluginInterface):
 
         saving_path = f'resources/cache/gomoku_board_{game_id}.png'
         board_image.save(saving_path)  # 保存图片
+        cache_manager.register(saving_path)
         return saving_path  # 返回图片路径
 
     def is_winning(self, game_id):
@@ -380,7 +384,7 @@ class gomoku(PluginInterface):
         if recv.from_group():  # 判断是群还是私聊
             out_message = '\n' + out_message
             if at_to_wxid:
-                out_message = f"@{self.db.get_nickname(at_to_wxid)}\n{out_message}"
+                out_message = f"@{await self.db.async_get_nickname(at_to_wxid)}\n{out_message}"
                 logger.info(f'[发送@信息]{out_message}| [发送到] {recv.roomid}')
                 bot.send_text(out_message, recv.roomid, recv.sender)  # 发送@信息
             else:
@@ -6,11 +6,13 @@ import re
 
 import yaml
 from loguru import logger
-from openai import AsyncOpenAI
 from wcferry import client
 
 from utils.database import BotDatabase
+from utils.llm_client import llm_client
 from utils.plugin_interface import PluginInterface
+from utils.response_cache import response_cache
+from utils.sensitive_words import sensitive_words
 from wcferry_helper import XYBotWxMsg
 
 
@@ -27,20 +29,16 @@ class gpt(PluginInterface):
         self.gpt_max_token = config["gpt_max_token"]  # gpt 最大token
         self.gpt_temperature = config["gpt_temperature"]  # gpt 温度
 
+        self.gpt_stream = config["gpt_stream"]  # 是否边生成边分段发送回答
+        self.stream_flush_chars = config["stream_flush_chars"]  # 攒够多少字后在句子结尾处发送
+        self.stream_flush_seconds = config["stream_flush_seconds"]  # 距离上一段多少秒后在句子结尾处发送
+
         main_config_path = "main_config.yml"
         with open(main_config_path, "r", encoding="utf-8") as f:  # 读取设置
             main_config = yaml.safe_load(f.read())
 
         self.admins = main_config["admins"]  # 获取管理员列表
 
-        self.openai_api_base = main_config["openai_api_base"]  # openai api 链接
-        self.openai_api_key = main_config["openai_api_key"]  # openai api 密钥
-
-        sensitive_words_path = "sensitive_words.yml"  # 加载敏感词yml
-        with open(sensitive_words_path, "r", encoding="utf-8") as f:  # 读取设置
-            sensitive_words_config = yaml.safe_load(f.read())
-        self.sensitive_words = sensitive_words_config["sensitive_words"]  # 敏感词列表
-
         self.db = BotDatabase()
 
     async def run(self, bot: client.Wcf, recv: XYBotWxMsg):
@@ -50,44 +48,92 @@ class gpt(PluginInterface):
 
         error_message = ""
 
-        if self.db.get_points(user_wxid) < self.gpt_point_price and self.db.get_whitelist(
+        if await self.db.async_get_points(user_wxid) < self.gpt_point_price and await self.db.async_get_whitelist(
                 user_wxid) != 1 and user_wxid not in self.admins:  # 积分不足 不在白名单 不是管理员
             error_message = f"-----XYBot-----\n积分不足,需要{self.gpt_point_price}点⚠️"
         elif len(recv.content) < 2:  # 指令格式正确
             error_message = f"-----XYBot-----\n参数错误!❌\n\n{self.command_format_menu}"
 
         gpt_request_message = " ".join(recv.content[1:])  # 用户问题
-        if not self.senstitive_word_check(gpt_request_message):  # 敏感词检查
+        if not sensitive_words.check(gpt_request_message):  # 敏感词检查
             error_message = "-----XYBot-----\n内容包含敏感词!⚠️"
 
         if not error_message:
             out_message = "-----XYBot-----\n已收到指令，处理中，请勿重复发送指令！👍"  # 发送已收到信息，防止用户反复发送命令
             await self.send_friend_or_group(bot, recv, out_message)
 
-            if self.db.get_whitelist(user_wxid) == 1 or user_wxid in self.admins:  # 如果用户在白名单内/是管理员
-                chatgpt_answer = await self.chatgpt(gpt_request_message)
+            if await self.db.async_get_whitelist(user_wxid) == 1 or user_wxid in self.admins:  # 如果用户在白名单内/是管理员
+                chatgpt_answer = await self.answer(bot, recv, gpt_request_message)
                 if chatgpt_answer[0]:
-                    out_message = f"-----XYBot-----\n因为你在白名单内，所以没扣除积分！👍\nChatGPT回答：\n{chatgpt_answer[1]}\n\n⚙️ChatGPT版本：{self.gpt_version}"
+                    out_message = f"-----XYBot-----\n因为你在白名单内，所以没扣除积分！👍\n{chatgpt_answer[1]}⚙️ChatGPT版本：{self.gpt_version}"
                 else:
                     out_message = f"-----XYBot-----\n出现错误！⚠️{chatgpt_answer}"
                 await self.send_friend_or_group(bot, recv, out_message)
 
-            elif self.db.get_points(user_wxid) >= self.gpt_point_price:
-                self.db.add_points(user_wxid, self.gpt_point_price * -1)  # 减掉积分
-                chatgpt_answer = await self.chatgpt(gpt_request_message)  # 从chatgpt api 获取回答
+            elif await self.db.async_spend_points(user_wxid, self.gpt_point_price, "gpt"):  # 积分足够时减掉积分
+                chatgpt_answer = await self.answer(bot, recv, gpt_request_message)  # 从chatgpt api 获取回答
                 if chatgpt_answer[0]:
-                    out_message = f"-----XYBot-----\n已扣除{self.gpt_point_price}点积分，还剩{self.db.get_points(user_wxid)}点积分👍\nChatGPT回答：\n{chatgpt_answer[1]}\n\n⚙️ChatGPT版本：{self.gpt_version}"  # 创建信息
+                    out_message = f"-----XYBot-----\n已扣除{self.gpt_point_price}点积分，还剩{await self.db.async_get_points(user_wxid)}点积分👍\n{chatgpt_answer[1]}⚙️ChatGPT版本：{self.gpt_version}"  # 创建信息
                 else:
-                    self.db.add_points(user_wxid, self.gpt_point_price)  # 补回积分
+                    await self.db.async_add_points(user_wxid, self.gpt_point_price, "gpt")  # 补回积分
                     out_message = f"-----XYBot-----\n出现错误，已补回积分！⚠️{chatgpt_answer}"
                 await self.send_friend_or_group(bot, recv, out_message)
         else:
             await self.send_friend_or_group(bot, recv, error_message)
 
-    async def chatgpt(self, gpt_request_message):
-        client = AsyncOpenAI(api_key=self.openai_api_key, base_url=self.openai_api_base)
+    async def answer(self, bot: client.Wcf, recv: XYBotWxMsg, gpt_request_message):  # 返回要放进结果信息里的回答部分
+        cache_key = response_cache.key("chat", self.gpt_version, gpt_request_message,
+                                       temperature=self.gpt_temperature, max_tokens=self.gpt_max_token)
+        cached_answer = response_cache.get(cache_key)
+        if cached_answer is not None:  # 同样的问题问过，直接用缓存的回答，照常扣积分
+            logger.info(f"[GPT] 使用缓存的回答: {gpt_request_message}")
+            return True, f"ChatGPT回答：\n{cached_answer}\n\n"
+
+        # 同样的问题正在请求时等它的回答，不重复请求；这时即使开了流式也只能等完整的回答
+        streamed = self.gpt_stream and not llm_client.is_in_flight(cache_key)
+
+        async def request():
+            if streamed:
+                answer = await self.chatgpt_stream(bot, recv, gpt_request_message)  # 回答边生成边发送给第一个提问的人
+            else:
+                answer = await self.chatgpt(recv.sender, gpt_request_message)
+            if answer[0]:
+                response_cache.put(cache_key, answer[1])
+            return answer
+
+        chatgpt_answer = await llm_client.coalesce(cache_key, request)
+        if not chatgpt_answer[0]:
+            return chatgpt_answer
+        elif streamed:
+            return True, ""  # 回答已经分段发送过了
+        return True, f"ChatGPT回答：\n{chatgpt_answer[1]}\n\n"
+
+    async def chatgpt_stream(self, bot: client.Wcf, recv: XYBotWxMsg, gpt_request_message):  # 边生成边按句子发送
         try:
-            chat_completion = await client.chat.completions.create(
+            async with await llm_client.stream_chat(
+                recv.sender,
+                self.stream_flush_chars,
+                self.stream_flush_seconds,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": gpt_request_message,
+                    }
+                ],
+                model=self.gpt_version,
+                temperature=self.gpt_temperature,
+                max_tokens=self.gpt_max_token,
+            ) as stream:  # 发送出错时也会关闭连接、归还名额
+                async for segment in stream.segments():
+                    await self.send_friend_or_group(bot, recv, segment)
+            return True, stream.text
+        except Exception as error:
+            return False, error
+
+    async def chatgpt(self, wxid, gpt_request_message):
+        try:
+            chat_completion = await llm_client.chat(
+                wxid,
                 messages=[
                     {
                         "role": "user",
@@ -102,15 +148,9 @@ class gpt(PluginInterface):
         except Exception as error:
             return False, error
 
-    def senstitive_word_check(self, message):  # 检查敏感词
-        for word in self.sensitive_words:
-            if word in message:
-                return False
-        return True
-
     async def send_friend_or_group(self, bot: client.Wcf, recv: XYBotWxMsg, out_message="null"):
         if recv.from_group():  # 判断是群还是私聊
-            out_message = f"@{self.db.get_nickname(recv.sender)}\n{out_message}"
+            out_message = f"@{await self.db.async_get_nickname(recv.sender)}\n{out_message}"
             logger.info(f'[发送@信息]{out_message}| [发送到] {recv.roomid}')
             bot.send_text(out_message, recv.roomid, recv.sender)  # 发送@信息
 
@@ -34,14 +34,12 @@ class lucky_draw(PluginInterface):
     async def run(self, bot: client.Wcf, recv: XYBotWxMsg):
         recv.content = re.split(" |\u2005", recv.content)  # 拆分消息
 
-        global _draw_count, _draw_name  # 全局变量防止出错
-
         # -----初始化与消息格式监测-----
         target_wxid = recv.sender  # 获取发送者wxid
 
         command = recv.content  # 指令
 
-        target_points = self.db.get_points(target_wxid)  # 获取目标积分
+        target_points = await self.db.async_get_points(target_wxid)  # 获取目标积分
 
         error = ""
 
@@ -89,8 +87,6 @@ class lucky_draw(PluginInterface):
 
             wins = []  # 赢取列表
 
-            self.db.add_points(target_wxid, -1 * draw_cost)  # 扣取积分
-
             # 保底抽奖
             min_guaranteed = _draw_count // self.draw_per_guarantee  # 保底抽奖次数
             for _ in range(min_guaranteed):  # 先把保底抽了
@@ -130,7 +126,16 @@ class lucky_draw(PluginInterface):
             for win_name, win_points, win_symbol in wins:  # 统计赢取的积分
                 total_win_points += win_points
 
-            self.db.add_points(target_wxid, total_win_points)  # 把赢取的积分加入数据库
+            await self.db.async_get_users([target_wxid])  # 先加载用户，下面的修改只在内存里进行
+            with self.db.atomic(target_wxid):  # 扣取积分和加入赢取的积分一起生效
+                enough_points = self.db.spend_points(target_wxid, draw_cost, "lucky_draw")
+                if enough_points:
+                    self.db.add_points(target_wxid, total_win_points, "lucky_draw")
+
+            if not enough_points:
+                await self.send_friend_or_group(bot, recv, "-----XYBot-----\n❌积分不足！")
+                return
+
             logger.info(
                 f"[抽奖] wxid: {target_wxid} | 抽奖名: {_draw_name} | 次数: {_draw_count} | 赢取积分: {total_win_points}"
             )
@@ -147,7 +152,7 @@ class lucky_draw(PluginInterface):
 
     async def send_friend_or_group(self, bot: client.Wcf, recv: XYBotWxMsg, out_message="null"):
         if recv.from_group():  # 判断是群还是私聊
-            out_message = f"@{self.db.get_nickname(recv.sender)}\n{out_message}"
+            out_message = f"@{await self.db.async_get_nickname(recv.sender)}\n{out_message}"
             logger.info(f'[发送@信息]{out_message}| [发送到] {recv.roomid}')
             bot.send_text(out_message, recv.roomid, recv.sender)  # 发送@信息
         else:
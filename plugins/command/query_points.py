@@ -21,8 +21,8 @@ class query_points(PluginInterface):
 
         query_wxid = recv.sender  # 获取查询wxid
 
-        points_count = self.db.get_points(query_wxid)
+        points_count = await self.db.async_get_points(query_wxid)
 
-        out_message = f"@{self.db.get_nickname(query_wxid)}\n-----XYBot-----\n你有{points_count}点积分！👍"  # 从数据库获取积分数并创建信息
+        out_message = f"@{await self.db.async_get_nickname(query_wxid)}\n-----XYBot-----\n你有{points_count}点积分！👍"  # 从数据库获取积分数并创建信息
         logger.info(f'[发送@信息]{out_message}| [发送到] {recv.roomid}')
         bot.send_text(out_message, recv.roomid, query_wxid)
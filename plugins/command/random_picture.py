@@ -11,6 +11,7 @@ import yaml
 from loguru import logger
 from wcferry import client
 
+from utils.cache_manager import cache_manager
 from utils.plugin_interface import PluginInterface
 from wcferry_helper import XYBotWxMsg
 
@@ -38,11 +39,13 @@ class random_picture(PluginInterface):
                 with open(cache_path, "wb") as file:  # 下载并保存
                     file.write(await req.read())
                     file.close()
+                cache_manager.register(cache_path)
 
             await conn_ssl.close()
 
             logger.info(f'[发送信息](随机图图图片) {cache_path}| [发送到] {recv.roomid}')
-            bot.send_image(os.path.abspath(cache_path), recv.roomid)  # 发送图片
+            with cache_manager.pinned_file(cache_path):
+                bot.send_image(os.path.abspath(cache_path), recv.roomid)  # 发送图片
             bot.send_pat_msg(recv.roomid, recv.sender)  # 发送拍一拍消息
 
         except Exception as error:
@@ -2,6 +2,9 @@
 #
 #  This program is licensed under the GNU General Public License v3.0.
 
+import asyncio
+import heapq
+import json
 import os
 import random
 import re
@@ -12,6 +15,7 @@ from captcha.image import ImageCaptcha
 from loguru import logger
 from wcferry import client
 
+from utils.cache_manager import cache_manager
 from utils.database import BotDatabase
 from utils.plugin_interface import PluginInterface
 from wcferry_helper import XYBotWxMsg
@@ -44,7 +48,23 @@ class red_packet(PluginInterface):
             os.makedirs(cache_path)
             logger.info("已创建cache文件夹")
 
-        self.red_packets = {}  # 红包列表
+        self.red_packets_path = "resources/red_packets.json"  # 红包持久化文件，重启后恢复未过期红包
+        self.red_packets = self.load_red_packets()  # 红包列表
+
+        self.expiry_heap = [(packet["time"] + self.max_time, key) for key, packet in self.red_packets.items()]  # 到期时间堆
+        heapq.heapify(self.expiry_heap)
+        self.expiry_wakeup = asyncio.Event()  # 有新红包时唤醒超时引擎
+        self.expiry_task = None
+        self.bot = None
+
+    def on_load(self, bot: client.Wcf):  # 插件加载后启动超时引擎，恢复重启前未过期的红包
+        self.bot = bot
+        self.expiry_task = asyncio.get_running_loop().create_task(self.expiry_loop())
+
+    def on_unload(self):  # 插件卸载或重载前停止超时引擎，由新实例接手
+        if self.expiry_task is not None:
+            self.expiry_task.cancel()
+            self.expiry_task = None
 
     async def run(self, bot: client.Wcf, recv: XYBotWxMsg):
         recv.content = re.split(" |\u2005", recv.content)  # 拆分消息
@@ -72,9 +92,9 @@ class red_packet(PluginInterface):
         elif int(recv.content[2]) > int(recv.content[1]):
             error = "-----XYBot-----\n❌红包数量不能大于红包积分！"
 
-        # 判断是否有足够积分
+        # 判断是否有足够积分，足够时直接扣除
         if not error:
-            if self.db.get_points(red_packet_sender) < int(recv.content[1]):
+            if not await self.db.async_spend_points(red_packet_sender, int(recv.content[1]), "red_packet"):
                 error = "-----XYBot-----\n❌积分不足！"
 
         if not error:
@@ -82,7 +102,7 @@ class red_packet(PluginInterface):
             red_packet_amount = int(recv.content[2])  # 红包数量
             red_packet_chatroom = recv.roomid  # 红包所在群聊
 
-            red_packet_sender_nick = self.db.get_nickname(red_packet_sender)  # 获取昵称
+            red_packet_sender_nick = await self.db.async_get_nickname(red_packet_sender)  # 获取昵称
             if not red_packet_sender_nick:
                 red_packet_sender_nick = red_packet_sender
 
@@ -104,8 +124,9 @@ class red_packet(PluginInterface):
                 "sender_nick": red_packet_sender_nick,
             }  # 红包信息
 
+            await self.db.async_flush()  # 先把扣除的积分写入数据库，再保存红包，崩溃时不会凭空多出积分
             self.red_packets[chr_5] = new_red_packet  # 把红包放入红包列表
-            self.db.add_points(red_packet_sender, red_packet_points * -1)  # 扣除积分
+            self.schedule_expiry(chr_5)  # 到期时自动退还
 
             # 组建信息
             out_message = f"-----XYBot-----\n{red_packet_sender_nick} 发送了一个红包！\n\n🧧红包金额：{red_packet_points}点积分\n🧧红包数量：{red_packet_amount}个\n\n🧧红包口令请见下图！\n\n快输入指令来抢红包！\n指令：{self.command_prefix}抢红包 口令"
@@ -114,7 +135,8 @@ class red_packet(PluginInterface):
             bot.send_text(out_message, recv.roomid)
             logger.info(f'[发送信息] (红包口令图片) {captcha_path} | [发送到] {recv.roomid}')
 
-            bot.send_image(captcha_path, recv.roomid)
+            with cache_manager.pinned_file(captcha_path):
+                bot.send_image(captcha_path, recv.roomid)
 
 
         else:
@@ -139,28 +161,27 @@ class red_packet(PluginInterface):
             error = "-----XYBot-----\n❌不能抢自己的红包！"
 
         if not error:
-            try:  # 抢红包
-                grabbed_points = self.red_packets[req_captcha][
-                    "list"
-                ].pop()  # 抢到的积分
-                self.red_packets[req_captcha]["grabbed"].append(
-                    red_packet_grabber
-                )  # 把抢红包的人加入已抢列表
-
-                red_packet_grabber_nick = self.db.get_nickname(red_packet_grabber)  # 获取昵称
+            try:  # 抢红包，检查、取出积分和记录已抢在同一段同步代码里完成，中间没有await，不需要加锁
+                red_packet = self.red_packets[req_captcha]  # 之后会await，先拿住红包，别的协程删除口令也不影响
+                grabbed_points = red_packet["list"].pop()  # 抢到的积分
+                red_packet["grabbed"].append(red_packet_grabber)  # 把抢红包的人加入已抢列表
+
+                red_packet_grabber_nick = await self.db.async_get_nickname(red_packet_grabber)  # 获取昵称
                 if not red_packet_grabber_nick:
                     red_packet_grabber_nick = red_packet_grabber
 
-                self.db.add_points(red_packet_grabber, grabbed_points)  # 增加积分
+                await self.db.async_add_points(red_packet_grabber, grabbed_points, "red_packet")  # 增加积分
 
                 # 组建信息
                 out_message = f"-----XYBot-----\n🧧恭喜 {red_packet_grabber_nick} 抢到了 {grabbed_points} 点积分！"
                 await self.send_friend_or_group(bot, recv, out_message)
                 bot.send_pat_msg(recv.roomid, red_packet_grabber)  # 发送拍一拍消息
 
-                # 判断是否抢完
-                if not self.red_packets[req_captcha]["list"]:
-                    self.red_packets.pop(req_captcha)
+                # 判断是否抢完，抢完的红包在超时堆里惰性删除
+                if not red_packet["list"]:
+                    self.red_packets.pop(req_captcha, None)
+                await self.db.async_flush()  # 抢到的积分写入数据库之后再保存红包
+                self.save_red_packets()
 
             except IndexError:
                 error = "-----XYBot-----\n❌红包已被抢完！"
@@ -174,8 +195,7 @@ class red_packet(PluginInterface):
 
             return
 
-    @staticmethod
-    def generate_captcha():  # 生成口令
+    def generate_captcha(self):  # 生成口令
         chr_all = [
             "a",
             "b",
@@ -201,9 +221,12 @@ class red_packet(PluginInterface):
             "9",
         ]
         chr_5 = "".join(random.sample(chr_all, 5))
+        while chr_5 in self.red_packets:  # 避免和未过期的红包口令重复
+            chr_5 = "".join(random.sample(chr_all, 5))
         captcha_image = ImageCaptcha().generate_image(chr_5)
         path = f"resources/cache/{chr_5}.jpg"
         captcha_image.save(path)
+        cache_manager.register(path)
 
         return chr_5, path
 
@@ -221,28 +244,87 @@ class red_packet(PluginInterface):
 
         return result
 
-    async def expired_red_packets_check(self, bot: client.Wcf):  # 检查是否有超时红包
-        logger.info("[计划任务]检查是否有超时的红包")
-        for key in list(self.red_packets.keys()):
-            if time.time() - self.red_packets[key]["time"] > self.max_time:  # 判断是否超时
-
-                red_packet_sender = self.red_packets[key].sender  # 获取红包发送人
-                red_packet_points_left_sum = sum(self.red_packets[key]["list"])  # 获取剩余积分
-                red_packet_chatroom = self.red_packets[key]["chatroom"]  # 获取红包所在群聊
-                red_packet_sender_nick = self.red_packets[key]["sender_nick"]  # 获取红包发送人昵称
-
-                self.db.add_points(red_packet_sender, red_packet_points_left_sum)  # 归还积分
-                self.red_packets.pop(key)  # 删除红包
-                logger.info("[红包]有红包超时，已归还积分！")  # 记录日志
+    def load_red_packets(self) -> dict:  # 读取持久化的红包
+        if not os.path.exists(self.red_packets_path):
+            return {}
+        try:
+            with open(self.red_packets_path, "r", encoding="utf-8") as f:
+                red_packets = json.load(f)
+            logger.info(f"[红包]已恢复 {len(red_packets)} 个未过期红包")
+            return red_packets
+        except (OSError, ValueError) as error:
+            logger.error(f"[红包]读取红包持久化文件失败: {error}")
+            return {}
+
+    def save_red_packets(self) -> None:  # 持久化红包，先写临时文件再替换，避免写到一半崩溃
+        temp_path = f"{self.red_packets_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.red_packets, f, ensure_ascii=False)
+        os.replace(temp_path, self.red_packets_path)
+
+    def schedule_expiry(self, key: str) -> None:  # 把红包放入超时堆
+        heapq.heappush(self.expiry_heap, (self.red_packets[key]["time"] + self.max_time, key))
+        self.save_red_packets()
+        self.expiry_wakeup.set()  # 新红包可能比当前等待的更早到期
+
+    async def expiry_loop(self):  # 超时引擎，睡到堆顶红包到期时准时退还，插件卸载或重载时由 on_unload 取消
+        logger.info("[红包]超时引擎已启动")
+        try:
+            while True:
+                wait_time = self.expiry_heap[0][0] - time.time() if self.expiry_heap else None
+                if wait_time is None or wait_time > 0:
+                    self.expiry_wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.expiry_wakeup.wait(), wait_time)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                try:  # 退还到一半时被取消会让积分和红包文件不一致，所以用 shield 让这一批退还做完
+                    await asyncio.shield(self.refund_red_packets(self.pop_expired_red_packets()))
+                except Exception as error:
+                    logger.error(f"[红包]退还超时红包失败: {error}")
+        except asyncio.CancelledError:
+            logger.info("[红包]超时引擎已退出")
+            raise
+
+    def pop_expired_red_packets(self) -> list:  # 取出所有到期的红包
+        now = time.time()
+        expired = []
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            deadline, key = heapq.heappop(self.expiry_heap)
+            red_packet = self.red_packets.get(key)
+            if red_packet and red_packet["time"] + self.max_time == deadline:  # 已抢完的红包已经不在红包列表里了
+                expired.append((key, self.red_packets.pop(key)))
+        return expired
+
+    async def refund_red_packets(self, expired: list):  # 批量退还超时红包，同一群的通知合并成一条
+        if not expired:
+            return
 
-                # 组建信息并发送
-                out_message = f"-----XYBot-----\n🧧发现有红包 {key} 超时！已归还剩余 {red_packet_points_left_sum} 积分给 {red_packet_sender_nick}"
-                bot.send_text(out_message, red_packet_chatroom)
-                logger.info(f"[发送信息]{out_message}| [发送到] {red_packet_chatroom}")
+        refunds = {}  # 发送人 -> 退还积分
+        notices = {}  # 群聊 -> 通知
+        for key, red_packet in expired:
+            red_packet_points_left_sum = sum(red_packet["list"])  # 获取剩余积分
+            red_packet_sender = red_packet["sender"]  # 获取红包发送人
+            refunds[red_packet_sender] = refunds.get(red_packet_sender, 0) + red_packet_points_left_sum
+            notices.setdefault(red_packet["chatroom"], []).append(
+                f"🧧红包 {key} 超时！已归还剩余 {red_packet_points_left_sum} 积分给 {red_packet['sender_nick']}")
+
+        refunds = {red_packet_sender: points for red_packet_sender, points in refunds.items() if points}
+        await self.db.async_add_points_many(refunds, "red_packet")  # 一次归还所有积分
+        await self.db.async_flush()  # 归还的积分写入数据库之后再保存红包
+        self.save_red_packets()
+        logger.info(f"[红包]有 {len(expired)} 个红包超时，已归还积分！")  # 记录日志
+
+        for red_packet_chatroom, lines in notices.items():  # 组建信息并发送
+            out_message = "-----XYBot-----\n" + "\n".join(lines)
+            self.bot.send_text(out_message, red_packet_chatroom)
+            logger.info(f"[发送信息]{out_message}| [发送到] {red_packet_chatroom}")
 
     async def send_friend_or_group(self, bot: client.Wcf, recv: XYBotWxMsg, out_message="null"):
         if recv.from_group():  # 判断是群还是私聊
-            out_message = f"@{self.db.get_nickname(recv.sender)}\n{out_message}"
+            out_message = f"@{await self.db.async_get_nickname(recv.sender)}\n{out_message}"
             logger.info(f'[发送@信息]{out_message}| [发送到] {recv.roomid}')
             bot.send_text(out_message, recv.roomid, recv.sender)  # 发送@信息
         else:
@@ -45,26 +45,29 @@ class sign_in(PluginInterface):
 
         sign_wxid = recv.sender
 
-        signstat = str(self.db.get_stat(sign_wxid))  # 从数据库获取签到状态
+        async with self.db.lock_users(sign_wxid):  # 检查签到状态和加积分之间不被同一人的其他签到打断
+            signstat = str(await self.db.async_get_stat(sign_wxid))  # 从数据库获取签到状态
+            signed_in = self.signstat_check(signstat)
 
-        if self.signstat_check(signstat):  # 如果今天未签到
-            self.db.add_points(sign_wxid, signin_points)  # 在数据库加积分
-            now_datetime = datetime.now(tz=pytz.timezone(self.timezone)).strftime("%Y%m%d")  # 获取现在格式化后时间
-            self.db.set_stat(sign_wxid, now_datetime)  # 设置签到状态为现在格式化后时间
+            if signed_in:  # 如果今天未签到
+                await self.db.async_add_points(sign_wxid, signin_points, "sign_in")  # 在数据库加积分
+                now_datetime = datetime.now(tz=pytz.timezone(self.timezone)).strftime("%Y%m%d")  # 获取现在格式化后时间
+                await self.db.async_set_stat(sign_wxid, now_datetime)  # 设置签到状态为现在格式化后时间
 
+        if signed_in:
             # 运势
             lucky_num = random.randint(self.min_lucky_star, self.max_lucky_star)
             lucky_star = "⭐️" * lucky_num
             lucky_star_message = f"你的运势：{lucky_star}\n{self.lucky_star_message.get(lucky_num)}"
 
-            out_message = f"@{self.db.get_nickname(sign_wxid)}\n-----XYBot-----\n签到成功！你领到了{signin_points}个积分！✅\n\n{lucky_star_message}"  # 创建发送信息
+            out_message = f"@{await self.db.async_get_nickname(sign_wxid)}\n-----XYBot-----\n签到成功！你领到了{signin_points}个积分！✅\n\n{lucky_star_message}"  # 创建发送信息
             logger.info(f"[发送@信息]{out_message}| [发送到] {recv.roomid}")
             bot.send_text(out_message, recv.roomid, sign_wxid)
 
         else:  # 今天已签到，不加积分
             next_sign_in_date = datetime.strptime(signstat, "%Y%m%d") + timedelta(days=1)
             next_sign_in_date_formatted = next_sign_in_date.strftime("%Y年%m月%d日")
-            out_message = f"@{self.db.get_nickname(sign_wxid)}\n-----XYBot-----\n❌你今天已经签到过了，每日凌晨刷新签到哦！下一次签到日期：{next_sign_in_date_formatted}"  # 创建信息
+            out_message = f"@{await self.db.async_get_nickname(sign_wxid)}\n-----XYBot-----\n❌你今天已经签到过了，每日凌晨刷新签到哦！下一次签到日期：{next_sign_in_date_formatted}"  # 创建信息
             logger.info(f"[发送@信息]{out_message}| [发送到] {recv.roomid}")
             bot.send_text(out_message, recv.roomid, sign_wxid)
 
@@ -5,6 +5,7 @@
 from loguru import logger
 from wcferry import client
 
+from utils.cache_manager import cache_manager
 from utils.plugin_interface import PluginInterface
 from wcferry_helper import XYBotWxMsg
 
@@ -17,4 +18,7 @@ class image_test(PluginInterface):
         logger.debug(f"收到图片消息！{recv}")
 
         bot.send_text(f"收到图片消息！{recv}", recv.roomid)
-        bot.send_image(recv.image, recv.roomid)
+        image_path = await recv.get_image()
+        if image_path:
+            with cache_manager.pinned_file(image_path):  # 发送期间固定文件，防止被缓存淘汰
+                bot.send_image(image_path, recv.roomid)
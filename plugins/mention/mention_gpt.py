@@ -9,11 +9,13 @@ import time
 
 import yaml
 from loguru import logger
-from openai import AsyncOpenAI
 from wcferry import client
 
+from utils.cache_manager import cache_manager
 from utils.database import BotDatabase
+from utils.llm_client import llm_client
 from utils.plugin_interface import PluginInterface
+from utils.sensitive_words import sensitive_words
 from wcferry_helper import XYBotWxMsg
 
 
@@ -28,6 +30,10 @@ class mention_gpt(PluginInterface):
         self.gpt_max_token = config["gpt_max_token"]  # gpt 最大token
         self.gpt_temperature = config["gpt_temperature"]  # gpt 温度
 
+        self.gpt_stream = config["gpt_stream"]  # 是否边生成边分段发送回答
+        self.stream_flush_chars = config["stream_flush_chars"]  # 攒够多少字后在句子结尾处发送
+        self.stream_flush_seconds = config["stream_flush_seconds"]  # 距离上一段多少秒后在句子结尾处发送
+
         self.model_name = config["model_name"]  # 模型名称
         self.image_quality = config["image_quality"]  # 图片质量
         self.image_size = config["image_size"]  # 图片尺寸
@@ -41,13 +47,32 @@ class mention_gpt(PluginInterface):
 
         self.admins = main_config["admins"]  # 获取管理员列表
 
-        self.openai_api_base = main_config["openai_api_base"]  # openai api 链接
-        self.openai_api_key = main_config["openai_api_key"]  # openai api 密钥
+        self.system_message = {
+            "role": "system",
+            "content": "You are a helpful, creative, clever, and very friendly assistant. You output in plain text instead of markdown.",
+        }
+
+        self.tools = [
+            {
+                "type": "function",
+                "function": {
+                    "name": "generate_and_send_picture",
+                    "description": "Generate an image using the user's description. Call this when the user requests an image, for example when a user asks 'Can you show me a picture of a cat?'. The function returns true on sucess.",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "prompt": {
+                                "type": "string",
+                                "description": "The prompt of the image to generate."
+                            },
 
-        sensitive_words_path = "sensitive_words.yml"  # 加载敏感词yml
-        with open(sensitive_words_path, "r", encoding="utf-8") as f:  # 读取设置
-            sensitive_words_config = yaml.safe_load(f.read())
-        self.sensitive_words = sensitive_words_config["sensitive_words"]  # 敏感词列表
+                        },
+                        "required": ["prompt"],
+                        "additionalProperties": False,
+                    }
+                }
+            }
+        ]  # GPT可以调用的生成图片函数
 
         self.db = BotDatabase()
 
@@ -56,23 +81,41 @@ class mention_gpt(PluginInterface):
         gpt_request_message = recv.content
 
         error = ""
-        if self.db.get_points(
-                user_wxid) < self.max_possible_points and user_wxid not in self.admins and not self.db.get_whitelist(
+        if await self.db.async_get_points(
+                user_wxid) < self.max_possible_points and user_wxid not in self.admins and not await self.db.async_get_whitelist(
             user_wxid):  # 积分不够
             error = f"本功能可消耗最多 {self.max_possible_points} 点积分，您的积分不足，无法使用GPT功能！⚠️"
-        elif not self.senstitive_word_check(gpt_request_message):  # 有敏感词
+        elif not sensitive_words.check(gpt_request_message):  # 有敏感词
             error = "您的问题中包含敏感词，请重新输入！⚠️"
 
+        charged = user_wxid not in self.admins and not await self.db.async_get_whitelist(user_wxid)  # 管理员与白名单不扣积分
+        if not error and charged and not await self.db.async_spend_points(user_wxid, self.max_possible_points,
+                                                                        "mention_gpt"):  # 先按极限扣除，用完后补回没用到的
+            error = f"本功能可消耗最多 {self.max_possible_points} 点积分，您的积分不足，无法使用GPT功能！⚠️"
+
         if error:
             await self.send_friend_or_group(bot, recv, error)
             return
 
-        chat_completion = await self.chatgpt(gpt_request_message)
+        used_points = 0  # 实际消耗的积分，出错时为0
+        try:
+            if self.gpt_stream:
+                used_points = await self.run_stream(bot, recv, gpt_request_message)
+            else:
+                used_points = await self.run_once(bot, recv, gpt_request_message)
+        finally:
+            if charged and used_points < self.max_possible_points:
+                await self.db.async_add_points(user_wxid, self.max_possible_points - used_points, "mention_gpt")
+
+    async def run_once(self, bot: client.Wcf, recv: XYBotWxMsg, gpt_request_message) -> int:  # 返回实际消耗的积分
+        user_wxid = recv.sender
+        chat_completion = await self.chatgpt(user_wxid, gpt_request_message)
 
         if not chat_completion[0]:
             logger.error(str(chat_completion[1]))
             out_message = f"出现错误，请稍后再试！⚠️\n错误信息：\n{str(chat_completion[1])}"
             await self.send_friend_or_group(bot, recv, out_message)
+            return 0
 
         chat_completion = chat_completion[1]
         if chat_completion.choices[0].message.tool_calls:
@@ -90,54 +133,80 @@ class mention_gpt(PluginInterface):
                 "tool_call_id": tool_call.id
             }
 
-            chat_completion_2 = await self.function_call_result_to_gpt(gpt_request_message, chat_completion, function_call_result_message)
+            chat_completion_2 = await self.function_call_result_to_gpt(user_wxid, gpt_request_message, chat_completion, function_call_result_message)
             await self.send_friend_or_group(bot, recv, chat_completion_2.choices[0].message.content)
+            return self.gpt_point_price * 2 + self.image_price
 
-            if user_wxid not in self.admins and not self.db.get_whitelist(user_wxid):
-                minus_points = self.gpt_point_price * 2 + self.image_price
-                self.db.add_points(user_wxid, minus_points * -1)
+        await self.send_friend_or_group(bot, recv, chat_completion.choices[0].message.content)
+        return self.gpt_point_price
 
-        else:
-            await self.send_friend_or_group(bot, recv, chat_completion.choices[0].message.content)
-            if user_wxid not in self.admins and not self.db.get_whitelist(user_wxid):
-                self.db.add_points(user_wxid, self.gpt_point_price * -1)
+    async def run_stream(self, bot: client.Wcf, recv: XYBotWxMsg, gpt_request_message) -> int:  # 边生成边按句子发送回答，返回实际消耗的积分
+        user_wxid = recv.sender
+        user_message = {"role": "user", "content": gpt_request_message}
 
-    async def chatgpt(self, gpt_request_message):
-        client = AsyncOpenAI(api_key=self.openai_api_key, base_url=self.openai_api_base)
         try:
-            tools = [
-                {
-                    "type": "function",
-                    "function": {
-                        "name": "generate_and_send_picture",
-                        "description": "Generate an image using the user's description. Call this when the user requests an image, for example when a user asks 'Can you show me a picture of a cat?'. The function returns true on sucess.",
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "prompt": {
-                                    "type": "string",
-                                    "description": "The prompt of the image to generate."
-                                },
-
-                            },
-                            "required": ["prompt"],
-                            "additionalProperties": False,
-                        }
-                    }
+            async with await llm_client.stream_chat(
+                user_wxid,
+                self.stream_flush_chars,
+                self.stream_flush_seconds,
+                messages=[self.system_message, user_message],
+                tools=self.tools,
+                model=self.gpt_version,
+                temperature=self.gpt_temperature,
+                max_tokens=self.gpt_max_token,
+                parallel_tool_calls=False
+            ) as stream:  # 发送出错时也会关闭连接、归还名额
+                async for segment in stream.segments():
+                    await self.send_friend_or_group(bot, recv, segment)
+
+            minus_points = self.gpt_point_price
+            if stream.tool_calls:  # GPT要求生成图片
+                tool_call = stream.tool_calls[min(stream.tool_calls)]
+                prompt = json.loads(tool_call["function"]["arguments"]).get("prompt")
+
+                success = await self.generate_and_send_picture(prompt, bot, recv)
+
+                function_call_result_message = {
+                    "role": "tool",
+                    "content": json.dumps({
+                        "prompt": prompt,
+                        "success": success,
+                    }),
+                    "tool_call_id": tool_call["id"]
                 }
-            ]
-            chat_completion = await client.chat.completions.create(
+
+                async with await llm_client.stream_chat(
+                    user_wxid,
+                    self.stream_flush_chars,
+                    self.stream_flush_seconds,
+                    messages=[self.system_message, user_message, stream.message(), function_call_result_message],
+                    model=self.gpt_version,
+                    temperature=self.gpt_temperature,
+                    max_tokens=self.gpt_max_token,
+                ) as stream_2:
+                    async for segment in stream_2.segments():
+                        await self.send_friend_or_group(bot, recv, segment)
+
+                minus_points = self.gpt_point_price * 2 + self.image_price
+        except Exception as error:
+            logger.error(str(error))
+            await self.send_friend_or_group(bot, recv, f"出现错误，请稍后再试！⚠️\n错误信息：\n{str(error)}")
+            return 0
+
+        return minus_points
+
+    async def chatgpt(self, wxid, gpt_request_message):
+        try:
+            chat_completion = await llm_client.chat(
+                wxid,
                 messages=[
-                    {
-                        "role": "system",
-                        "content": "You are a helpful, creative, clever, and very friendly assistant. You output in plain text instead of markdown.",
-                    },
+                    self.system_message,
                     {
                         "role": "user",
                         "content": gpt_request_message,
                     }
                 ],
-                tools=tools,
+                tools=self.tools,
                 model=self.gpt_version,
                 temperature=self.gpt_temperature,
                 max_tokens=self.gpt_max_token,
@@ -147,13 +216,9 @@ class mention_gpt(PluginInterface):
         except Exception as error:
             return False, error
 
-    async def function_call_result_to_gpt(self, gpt_request_message, chat_completion, function_call_result_message):
-        client = AsyncOpenAI(api_key=self.openai_api_key, base_url=self.openai_api_base)
+    async def function_call_result_to_gpt(self, wxid, gpt_request_message, chat_completion, function_call_result_message):
         message_payload = [
-                {
-                    "role": "system",
-                    "content": "You are a helpful, creative, clever, and very friendly assistant. You output in plain text instead of markdown.",
-                },
+                self.system_message,
                 {
                     "role": "user",
                     "content": gpt_request_message,
@@ -161,7 +226,8 @@ class mention_gpt(PluginInterface):
                 chat_completion.choices[0].message.dict(),
                 function_call_result_message
             ]
-        response_chat_completion = await client.chat.completions.create(
+        response_chat_completion = await llm_client.chat(
+            wxid,
             messages=message_payload,
             model=self.gpt_version,
             temperature=self.gpt_temperature,
@@ -172,19 +238,20 @@ class mention_gpt(PluginInterface):
     async def generate_and_send_picture(self, prompt: str, bot: client.Wcf, recv: XYBotWxMsg) -> bool:
         try:
             await self.send_friend_or_group(bot, recv, f"⚙️生成图片中...")
-            save_path = await self.dalle3(prompt)
-            bot.send_image(save_path, recv.roomid)
+            save_path = await self.dalle3(recv.sender, prompt)
+            with cache_manager.pinned_file(save_path):
+                bot.send_image(save_path, recv.roomid)
             logger.info(f"发送图片: {save_path}")
             return True
         except Exception as error:
             logger.error(f"Error: {error}")
             return False
 
-    async def dalle3(self, prompt):  # 返回生成的图片的绝对路径，报错的话返回错误
+    async def dalle3(self, wxid, prompt):  # 返回生成的图片的绝对路径，报错的话返回错误
         logger.info(f"开始生成图片: {prompt}")
-        client = AsyncOpenAI(api_key=self.openai_api_key, base_url=self.openai_api_base)
         try:
-            image_generation = await client.images.generate(
+            image_generation = await llm_client.generate_image(
+                wxid,
                 prompt=prompt,
                 model=self.model_name,
                 n=1,
@@ -196,21 +263,16 @@ class mention_gpt(PluginInterface):
             save_path = os.path.abspath(f"resources/cache/dalle3_{time.time_ns()}.png")
             with open(save_path, "wb") as f:
                 f.write(image_b64decode)
+            cache_manager.register(save_path)
         except Exception as e:
             return e
 
         logger.info(f"生成图片 {prompt} 成功: {save_path}")
         return save_path
 
-    def senstitive_word_check(self, message):  # 检查敏感词
-        for word in self.sensitive_words:
-            if word in message:
-                return False
-        return True
-
     async def send_friend_or_group(self, bot: client.Wcf, recv: XYBotWxMsg, out_message="null"):
         if recv.from_group():  # 判断是群还是私聊
-            out_message = f"@{self.db.get_nickname(recv.sender)}\n{out_message}"
+            out_message = f"@{await self.db.async_get_nickname(recv.sender)}\n{out_message}"
             logger.info(f'[发送@信息]{out_message}| [发送到] {recv.roomid}')
             bot.send_text(out_message, recv.roomid, recv.sender)  # 发送@信息
 
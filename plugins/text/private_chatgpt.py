@@ -2,15 +2,18 @@
 #
 #  This program is licensed under the GNU General Public License v3.0.
 
+import asyncio
 import re
+from collections import OrderedDict
 
 import yaml
 from loguru import logger
-from openai import AsyncOpenAI
 from wcferry import client
 
 from utils.database import BotDatabase
+from utils.llm_client import estimate_message_tokens, llm_client, truncate_to_tokens
 from utils.plugin_interface import PluginInterface
+from utils.sensitive_words import sensitive_words
 from wcferry_helper import XYBotWxMsg
 
 
@@ -27,24 +30,29 @@ class private_chatgpt(PluginInterface):
         self.gpt_max_token = config["gpt_max_token"]  # gpt 最大token
         self.gpt_temperature = config["gpt_temperature"]  # gpt 温度
 
+        self.gpt_stream = config["gpt_stream"]  # 是否边生成边分段发送回答
+        self.stream_flush_chars = config["stream_flush_chars"]  # 攒够多少字后在句子结尾处发送
+        self.stream_flush_seconds = config["stream_flush_seconds"]  # 距离上一段多少秒后在句子结尾处发送
+
         self.private_chat_gpt_price = config["private_chat_gpt_price"]  # 私聊gpt使用价格（单次）
         self.dialogue_count = config["dialogue_count"]  # 保存的对话轮数
         self.clear_dialogue_keyword = config["clear_dialogue_keyword"]
 
+        self.dialogue_token_budget = config["dialogue_token_budget"]  # 发给GPT的上下文（包括新问题）最多多少token，0为不限制
+        self.dialogue_summary = config["dialogue_summary"]  # 是否把超出记忆轮数、被删掉的旧对话总结成摘要
+        self.summary_max_tokens = config["summary_max_tokens"]  # 摘要最多多少token
+
+        self.summaries = OrderedDict()  # wxid -> 摘要，按最近使用排列
+        self.summary_cache_size = 1000  # 内存中最多保存的摘要数
+        self.summary_pending = {}  # wxid -> 已经从数据库删掉、还没总结的对话
+        self.summary_tasks = {}  # wxid -> 正在后台生成的摘要
+
         main_config_path = "main_config.yml"
         with open(main_config_path, "r", encoding="utf-8") as f:  # 读取设置
             main_config = yaml.safe_load(f.read())
 
         self.admins = main_config["admins"]  # 管理员列表
 
-        self.openai_api_base = main_config["openai_api_base"]  # openai api 链接
-        self.openai_api_key = main_config["openai_api_key"]  # openai api 密钥
-
-        sensitive_words_path = "sensitive_words.yml"  # 加载敏感词yml
-        with open(sensitive_words_path, "r", encoding="utf-8") as f:  # 读取设置
-            sensitive_words_config = yaml.safe_load(f.read())
-        self.sensitive_words = sensitive_words_config["sensitive_words"]  # 敏感词列表
-
         self.db = BotDatabase()
 
     async def run(self, bot: client.Wcf, recv: XYBotWxMsg):
@@ -66,25 +74,37 @@ class private_chatgpt(PluginInterface):
             return
 
         error = ''
-        if self.db.get_points(wxid) < self.private_chat_gpt_price and wxid not in self.admins and not self.db.get_whitelist(wxid):  # 积分不够
+        if await self.db.async_get_points(wxid) < self.private_chat_gpt_price and wxid not in self.admins and not await self.db.async_get_whitelist(wxid):  # 积分不够
             error = f"您的积分不足 {self.private_chat_gpt_price} 点，无法使用私聊GPT功能！⚠️"
-        elif not self.senstitive_word_check(gpt_request_message):  # 有敏感词
+        elif not sensitive_words.check(gpt_request_message):  # 有敏感词
             error = "您的问题中包含敏感词，请重新输入！⚠️"
 
         if not error:  # 如果没有错误
             if recv.content[0] in self.clear_dialogue_keyword:  # 如果是清除对话记录的关键词，清除数据库对话记录
-                self.clear_dialogue(wxid)  # 保存清除了的数据到数据库
+                await self.clear_dialogue(wxid)  # 保存清除了的数据到数据库
                 out_message = "对话记录已清除！✅"
                 bot.send_text(out_message, wxid)
                 logger.info(f'[发送信息]{out_message}| [发送到] {wxid}')
             else:
-                gpt_answer = await self.chatgpt(wxid, gpt_request_message)  # 调用chatgpt函数
+                charged = wxid not in self.admins and not await self.db.async_get_whitelist(wxid)  # 管理员与白名单不扣积分
+                if charged and not await self.db.async_spend_points(wxid, self.private_chat_gpt_price,
+                                                                    "private_gpt"):  # 先扣除积分，出错时补回
+                    error = f"您的积分不足 {self.private_chat_gpt_price} 点，无法使用私聊GPT功能！⚠️"
+                    bot.send_text(error, wxid)
+                    logger.info(f'[发送信息]{error}| [发送到] {wxid}')
+                    return
+
+                if self.gpt_stream:
+                    gpt_answer = await self.chatgpt_stream(bot, wxid, gpt_request_message)  # 回答已经分段发送过了
+                else:
+                    gpt_answer = await self.chatgpt(wxid, gpt_request_message)  # 调用chatgpt函数
                 if gpt_answer[0]:  # 如果没有错误
-                    bot.send_text(gpt_answer[1], wxid)  # 发送回答
-                    logger.info(f'[发送信息]{gpt_answer[1]}| [发送到] {wxid}')
-                    if wxid not in self.admins and not self.db.get_whitelist(wxid):
-                        self.db.add_points(wxid, -self.private_chat_gpt_price)  # 扣除积分，管理员不扣
+                    if not self.gpt_stream:
+                        bot.send_text(gpt_answer[1], wxid)  # 发送回答
+                        logger.info(f'[发送信息]{gpt_answer[1]}| [发送到] {wxid}')
                 else:
+                    if charged:
+                        await self.db.async_add_points(wxid, self.private_chat_gpt_price, "private_gpt")  # 补回积分
                     out_message = f"出现错误⚠️！\n{gpt_answer[1]}"  # 如果有错误，发送错误信息
                     bot.send_text(out_message, wxid)
                     logger.error(f'[发送信息]{out_message}| [发送到] {wxid}')
@@ -93,50 +113,141 @@ class private_chatgpt(PluginInterface):
             logger.info(f'[发送信息]{error}| [发送到] {wxid}')
 
     async def chatgpt(self, wxid: str, message: str):  # 这个函数请求了openai的api
-        request_content = self.compose_gpt_dialogue_request_content(wxid, message)  # 构成对话请求内容，返回一个包含之前对话的列表
+        request_content = await self.compose_gpt_dialogue_request_content(wxid, message)  # 构成对话请求内容，返回一个包含之前对话的列表
+        if request_content is None:
+            return False, "您的问题太长，请缩短后再试！"
 
-        client = AsyncOpenAI(api_key=self.openai_api_key, base_url=self.openai_api_base)
         try:
-            chat_completion = await client.chat.completions.create(
+            chat_completion = await llm_client.chat(
+                wxid,
                 messages=request_content,
                 model=self.gpt_version,
                 temperature=self.gpt_temperature,
                 max_tokens=self.gpt_max_token,
             )  # 调用openai api
 
-            self.save_gpt_dialogue_request_content(wxid, request_content,
-                                                   chat_completion.choices[0].message.content)  # 保存对话请求与回答内容
+            await self.save_gpt_dialogue_request_content(wxid, request_content,
+                                                         chat_completion.choices[0].message.content)  # 保存对话请求与回答内容
             return True, chat_completion.choices[0].message.content  # 返回对话回答内容
         except Exception as error:
             return False, error
 
-    def compose_gpt_dialogue_request_content(self, wxid: str, new_message: str) -> list:
-        json_data = self.db.get_private_gpt_data(wxid)  # 从数据库获得到之前的对话
-
-        if not json_data or "data" not in json_data.keys():  # 如果没有对话数据，则初始化
-            init_data = {"data": []}
-            json_data = init_data
-
-        previous_dialogue = json_data['data'][self.dialogue_count * -2:]  # 获取指定轮数的对话，乘-2是因为一轮对话包含了1个请求和1个答复
-        request_content = [{"role": "system", "content": "You are a helpful assistant that output in plain text."}]
-        request_content += previous_dialogue  # 将之前的对话加入到api请求内容中
-
-        request_content.append({"role": "user", "content": new_message})  # 将用户新的问题加入api请求内容
-
-        return request_content
+    async def chatgpt_stream(self, bot: client.Wcf, wxid: str, message: str):  # 边生成边按句子发送
+        request_content = await self.compose_gpt_dialogue_request_content(wxid, message)
+        if request_content is None:
+            return False, "您的问题太长，请缩短后再试！"
 
-    def save_gpt_dialogue_request_content(self, wxid: str, request_content: list, gpt_response: str) -> None:
-        request_content.append({"role": "assistant", "content": gpt_response})  # 将gpt回答加入到api请求内容
-        request_content = request_content[self.dialogue_count * -2:]  # 将列表切片以符合指定的对话轮数，乘-2是因为一轮对话包含了1个请求和1个答复
+        try:
+            async with await llm_client.stream_chat(
+                wxid,
+                self.stream_flush_chars,
+                self.stream_flush_seconds,
+                messages=request_content,
+                model=self.gpt_version,
+                temperature=self.gpt_temperature,
+                max_tokens=self.gpt_max_token,
+            ) as stream:  # 发送出错时也会关闭连接、归还名额
+                async for segment in stream.segments():
+                    bot.send_text(segment, wxid)
+                    logger.info(f'[发送信息]{segment}| [发送到] {wxid}')
 
-        json_data = {"data": request_content}  # 构成保存需要的json数据
-        self.db.save_private_gpt_data(wxid, json_data)  # 保存到数据库中
+            await self.save_gpt_dialogue_request_content(wxid, request_content, stream.text)  # 保存完整的回答
+            return True, stream.text
+        except Exception as error:
+            return False, error
 
-    def senstitive_word_check(self, message):  # 检查敏感词
-        for word in self.sensitive_words:
-            if word in message:
-                return False
-        return True
+    async def compose_gpt_dialogue_request_content(self, wxid: str, new_message: str) -> list:  # 新问题放不下时返回None
+        request_content = [{"role": "system", "content": "You are a helpful assistant that output in plain text."}]
+        history = []
+        if self.dialogue_count:  # 获取指定轮数的对话，乘2是因为一轮对话包含了1个请求和1个答复
+            history = await self.db.async_get_dialogue(wxid, self.dialogue_count * 2)
+
+        new_request = {"role": "user", "content": new_message}
+        summary = self.summaries.get(wxid)
+        summary_message = {"role": "system", "content": f"Summary of the earlier conversation: {summary}"}
+        if not self.dialogue_token_budget:  # 不限制token，将摘要、之前的对话和新的问题加入api请求内容
+            if summary:
+                request_content.append(summary_message)
+                self.summaries.move_to_end(wxid)
+            return request_content + history + [new_request]
+
+        budget = self.dialogue_token_budget - estimate_message_tokens(request_content[0])
+        if estimate_message_tokens(new_request) > budget:  # 新问题本身就放不下，不发送请求
+            logger.info(f"[私聊GPT] {wxid} 的问题超过了 {budget} token 的上限")
+            return None
+        budget -= estimate_message_tokens(new_request)
+
+        if summary and estimate_message_tokens(summary_message) <= budget:
+            request_content.append(summary_message)
+            budget -= estimate_message_tokens(summary_message)
+            self.summaries.move_to_end(wxid)
+
+        kept = 0  # 从最新的对话往前放，放不下为止
+        for message in reversed(history):
+            budget -= estimate_message_tokens(message)
+            if budget < 0:
+                break
+            kept += 1
+        if kept and history[-kept]["role"] == "assistant":  # 从问题开始
+            kept -= 1
+
+        return request_content + history[len(history) - kept:] + [new_request]
+
+    def queue_summary(self, wxid: str, trimmed: list) -> None:  # 把从数据库删掉的旧对话交给后台总结，同一个用户按顺序总结
+        self.summary_pending.setdefault(wxid, []).extend(trimmed)
+        if wxid not in self.summary_tasks:
+            self.summary_tasks[wxid] = asyncio.create_task(self.update_summary(wxid))
+
+    async def update_summary(self, wxid: str) -> None:  # 把旧的摘要和新删掉的对话总结成新的摘要，直到没有待总结的对话
+        try:
+            while self.summary_pending.get(wxid):
+                turns = self.summary_pending.pop(wxid)
+                transcript = "\n".join(f"{message['role']}: {message['content']}" for message in turns)
+                if self.dialogue_token_budget:
+                    transcript = truncate_to_tokens(transcript, self.dialogue_token_budget)
+                try:
+                    chat_completion = await llm_client.chat(
+                        wxid,
+                        messages=[
+                            {"role": "system", "content": "Summarize the conversation below in a few sentences, keeping "
+                                                          "names, facts and open questions. Reply in the language of the "
+                                                          "conversation."},
+                            {"role": "user", "content": f"Earlier summary:\n{self.summaries.get(wxid, '')}\n\n"
+                                                        f"Conversation:\n{transcript}"},
+                        ],
+                        model=self.gpt_version,
+                        temperature=0.3,
+                        max_tokens=self.summary_max_tokens,
+                    )
+                except Exception as error:
+                    logger.error(f"[私聊GPT] 生成 {wxid} 的对话摘要失败: {error}")
+                    continue
+
+                self.summaries[wxid] = chat_completion.choices[0].message.content
+                self.summaries.move_to_end(wxid)
+                while len(self.summaries) > self.summary_cache_size:
+                    self.summaries.popitem(last=False)
+        finally:
+            if self.summary_tasks.get(wxid) is asyncio.current_task():
+                del self.summary_tasks[wxid]
+
+    async def save_gpt_dialogue_request_content(self, wxid: str, request_content: list, gpt_response: str) -> None:
+        if not self.dialogue_count:  # 关闭了上下文记忆
+            return
 
-    def clear_dialogue(self, wxid):  # 清除对话记录
-        self.db.save_private_gpt_data(wxid, {"data": []})
+        new_turns = [request_content[-1], {"role": "assistant", "content": gpt_response}]  # 只追加新的问题和回答
+        keep = self.dialogue_count * 2
+        if self.dialogue_summary:  # 超出记忆轮数、马上要被删掉的旧对话先交给后台总结
+            history = await self.db.async_get_dialogue(wxid, keep)
+            trimmed = history[:max(len(history) + len(new_turns) - keep, 0)]
+            if trimmed:
+                self.queue_summary(wxid, trimmed)
+        await self.db.async_append_dialogue(wxid, new_turns, keep)  # 保存到数据库中，只保留指定轮数
+
+    async def clear_dialogue(self, wxid):  # 清除对话记录
+        await self.db.async_clear_dialogue(wxid)
+        self.summaries.pop(wxid, None)
+        self.summary_pending.pop(wxid, None)
+        task = self.summary_tasks.pop(wxid, None)
+        if task:  # 正在生成的摘要属于已经清除的对话
+            task.cancel()
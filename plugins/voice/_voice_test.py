@@ -16,4 +16,5 @@ class voice_test(PluginInterface):
     async def run(self, bot: client.Wcf, recv: XYBotWxMsg):
         logger.debug(f"收到语音消息！{recv}")
         bot.send_text(str(recv), recv.roomid)
-        bot.send_file(recv.voice, recv.roomid)
+        bot.send_file(await recv.get_voice(), recv.roomid)
+        logger.debug(f"语音解码后WAV大小：{len(await recv.get_voice_wav())}")
@@ -8,6 +8,7 @@ from loguru import logger
 from wcferry import wcf_pb2, WxMsg
 
 import utils.xybot as xybot
+from utils.llm_client import llm_client
 from utils.plans_manager import plan_manager
 from utils.plugin_manager import plugin_manager
 from wcferry_helper import *
@@ -106,6 +107,7 @@ async def main():
     # ---- 加载插件 加载计划 ---- #
 
     # 加载所有插件
+    plugin_manager.bot = bot  # 插件加载时可能需要启动自己的后台任务，例如红包的超时引擎
     plugin_manager.load_plugins()  # 加载所有插件
     logger.success("已加载所有插件")
 
@@ -126,14 +128,17 @@ async def main():
 
     rsp = wcf_pb2.Response()
 
-    with pynng.Pair1() as sock:
-        sock.dial(bot.msg_url, block=True)
-        logger.success(f"连接成功: {bot.msg_url}")
-
-        logger.info("开始接受消息")
-        while True:
-            message = await recv_msg_async(sock, rsp)
-            asyncio.create_task(handlebot.message_handler(bot, WxMsg(message))).add_done_callback(callback)
+    try:
+        with pynng.Pair1() as sock:
+            sock.dial(bot.msg_url, block=True)
+            logger.success(f"连接成功: {bot.msg_url}")
+
+            logger.info("开始接受消息")
+            while True:
+                message = await recv_msg_async(sock, rsp)
+                asyncio.create_task(handlebot.message_handler(bot, WxMsg(message))).add_done_callback(callback)
+    finally:
+        await llm_client.close()  # 关闭GPT插件共用的连接池
 
 
 if __name__ == "__main__":
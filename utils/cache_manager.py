@@ -0,0 +1,196 @@
+#  Copyright (c) 2024. Henry Yang
+#
+#  This program is licensed under the GNU General Public License v3.0.
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import yaml
+from loguru import logger
+
+from utils.singleton import singleton
+
+
+@singleton
+class CacheManager:
+    def __init__(self):
+        with open("main_config.yml", "r", encoding="utf-8") as f:  # 读取设置
+            main_config = yaml.safe_load(f.read())
+
+        self.cache_path = os.path.abspath("resources/cache")
+        self.max_size = main_config["cache_max_size_mb"] * 1024 * 1024  # 缓存总大小上限（字节）
+        self.max_age = main_config["cache_max_age_hours"] * 3600  # 缓存文件最长保留时间（秒）
+
+        self.files = OrderedDict()  # 路径 -> (大小, 最后使用时间)，按最后使用时间从旧到新排列
+        self.pinned = {}  # 正在使用的文件，路径 -> [引用数, 大小]，不参与淘汰
+        self.total_size = 0
+        self.lock = threading.Lock()  # 下载线程和事件循环都会登记文件
+
+        if not os.path.exists(self.cache_path):  # 检测是否有cache文件夹
+            logger.info("检测到未创建cache缓存文件夹")
+            os.makedirs(self.cache_path)
+            logger.info("已创建cache文件夹")
+
+        self._scan()
+
+    def _scan(self) -> None:  # 启动时把已有的缓存文件按修改时间登记
+        existing = []
+        for root, dirs, files in os.walk(self.cache_path):
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                existing.append((stat.st_mtime, path, stat.st_size))
+
+        for mtime, path, size in sorted(existing):
+            self.files[path] = (size, mtime)
+            self.total_size += size
+
+        logger.info(f"[缓存]已登记 {len(self.files)} 个缓存文件，共 {self.total_size / 1024 / 1024:.1f}MB")
+
+    def register(self, path: str) -> None:
+        """
+        登记新写入或被覆盖的缓存文件，超过大小上限时立即淘汰最久未使用的文件。
+        Register a cache file that was just written, evicting least recently used files if the size cap is exceeded.
+        :param path: 文件路径。The file path.
+        """
+        path = os.path.abspath(path)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+
+        with self.lock:
+            if path in self.pinned:
+                self.total_size += size - self.pinned[path][1]
+                self.pinned[path][1] = size
+            else:
+                old = self.files.pop(path, None)
+                if old:
+                    self.total_size -= old[0]
+                self.files[path] = (size, time.time())
+                self.total_size += size
+
+            evicted = self._pop_over_size()
+
+        self._remove(evicted)
+
+    def touch(self, path: str) -> None:
+        """
+        标记文件刚被使用过。Mark a cache file as recently used.
+        :param path: 文件路径。The file path.
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            if path in self.files:
+                self.files[path] = (self.files.pop(path)[0], time.time())
+
+    def pin(self, path: str) -> None:
+        """
+        固定文件，在解除固定前不会被淘汰。Pin a file so it is not evicted until unpinned.
+        :param path: 文件路径。The file path.
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            if path in self.pinned:
+                self.pinned[path][0] += 1
+                return
+
+            entry = self.files.pop(path, None)
+            if entry:
+                size = entry[0]
+            else:  # 还没登记过的文件
+                size = os.path.getsize(path) if os.path.exists(path) else 0
+                self.total_size += size
+            self.pinned[path] = [1, size]
+
+    def unpin(self, path: str) -> None:
+        """
+        解除固定，文件重新作为最新使用的文件参与淘汰。Unpin a file, it becomes the most recently used cache entry.
+        :param path: 文件路径。The file path.
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            if path not in self.pinned:
+                return
+
+            self.pinned[path][0] -= 1
+            if self.pinned[path][0] > 0:
+                return
+
+            size = self.pinned.pop(path)[1]
+            if os.path.exists(path):
+                self.files[path] = (size, time.time())
+            else:
+                self.total_size -= size
+
+            evicted = self._pop_over_size()
+
+        self._remove(evicted)
+
+    @contextmanager
+    def pinned_file(self, path: str):
+        """
+        在with块内固定文件，发送图片/文件期间不会被缓存淘汰，结束后文件算作刚被使用过。
+        Pin a file for the duration of the with block, e.g. while it is being sent, so the cache cannot evict it.
+        Afterwards the file counts as just used.
+        :param path: 文件路径。The file path.
+        """
+        self.pin(path)
+        try:
+            yield os.path.abspath(path)
+        finally:
+            self.unpin(path)
+
+    def evict(self) -> int:
+        """
+        淘汰过期和超出大小上限的文件，只检查最久未使用的一端。
+        Evict expired files and files over the size cap, only looking at the least recently used end.
+        :return: 删除的文件数量。The number of removed files.
+        """
+        expire_before = time.time() - self.max_age
+        evicted = []
+        with self.lock:
+            while self.files:
+                path, (size, last_used) = next(iter(self.files.items()))
+                if last_used > expire_before:
+                    break
+                self.files.popitem(last=False)
+                self.total_size -= size
+                evicted.append(path)
+
+            evicted += self._pop_over_size()
+
+        self._remove(evicted)
+        return len(evicted)
+
+    def _pop_over_size(self) -> list:  # 需要持有锁
+        evicted = []
+        while self.total_size > self.max_size and self.files:
+            path, (size, last_used) = self.files.popitem(last=False)
+            self.total_size -= size
+            evicted.append(path)
+        return evicted
+
+    @staticmethod
+    def _remove(paths: list) -> None:
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as error:
+                logger.warning(f"[缓存]删除缓存文件 {path} 失败: {error}")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"files": len(self.files) + len(self.pinned), "pinned": len(self.pinned), "size": self.total_size}
+
+
+# 实例化缓存管理器
+cache_manager = CacheManager()
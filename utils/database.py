@@ -2,58 +2,57 @@
 #
 #  This program is licensed under the GNU General Public License v3.0.
 
-import json
-import os
-import sqlite3
+import asyncio
+import atexit
+import itertools
+import threading
+import time
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 
+import yaml
 from loguru import logger
 
 from utils.singleton import singleton
-
-
-# row factory function for the database
-def dict_factory(cursor, row):
-    fields = [column[0] for column in cursor.description]
-    return {key: value for key, value in zip(fields, row)}
+from utils.storage import create_storage, new_user
 
 
 @singleton
 class BotDatabase:
     def __init__(self):
-        self.database_column = [("WXID", "TEXT PRIMARY KEY"), ("NICKNAME", "TEXT"), ("POINTS", "INT"),
-                                ("SIGNINSTAT", "INT"), ("WHITELIST", "INT"), ("PRIVATE_GPT_DATA", "TEXT")]
-
-        if not os.path.exists("userdata.db"):  # 检查数据库是否存在
-            logger.warning("检测到数据库不存在，正在创建数据库")
-            conn = sqlite3.connect("userdata.db")
-            c = conn.cursor()
-
-            # compose create table sql
-            create_table_sql = f"CREATE TABLE USERDATA ("
-            for column in self.database_column:
-                create_table_sql += f"{column[0]} {column[1]}, "
-            create_table_sql = create_table_sql[:-2] + ")"
+        with open("main_config.yml", "r", encoding="utf-8") as f:  # 读取设置
+            main_config = yaml.safe_load(f.read())
 
-            c.execute(create_table_sql)
+        self.flush_interval = main_config["database_flush_interval"]  # 内存中的修改最多隔多久写入数据库（秒）
+        self.user_cache_size = main_config["database_user_cache_size"]  # 内存中最多缓存的用户数
+        self.evict_scan_limit = 64  # 淘汰时最多多看几个还没写入的用户
 
-            conn.commit()
-            c.close()
-            conn.close()
+        self.storage = create_storage(main_config["database_backend"])  # 存储后端，默认是 userdata.db
+        self.read_workers = 4  # 同时读取存储后端的线程数
 
-            logger.warning("已创建数据库")
+        self.wxid_set = self.storage.get_wxids()  # 已有用户集合，之后只在创建用户时增加，不再重新读取
 
-        self.database = sqlite3.connect(
-            "userdata.db", check_same_thread=False
-        )  # 连接数据库
+        # 常用的用户数据（积分、签到、白名单、昵称）缓存在内存里，修改先记在内存，再定时成批写入数据库
+        self.user_cache = OrderedDict()  # wxid -> {"NICKNAME", "POINTS", "SIGNINSTAT", "WHITELIST"}，按最近使用排列
+        self.dirty_users = {}  # 还没写入数据库的用户，wxid -> {"new": 是否需要新建, "ledger": [(变化, 余额, 原因, 时间)]}
+        self.flushing_users = {}  # 正在写入数据库的用户，提交之前不能移出缓存，格式和 dirty_users 一样
+        self.cache_lock = threading.RLock()
+        self.leaderboard = None  # 内存中的积分排行榜 [{"WXID", "NICKNAME", "POINTS"}]，积分变化时直接更新，无法更新时置空
+        self.leaderboard_size = 0  # 内存中排行榜的长度
+        self.user_change_count = 0  # 每次修改用户数据时增加，用来判断读数据库期间有没有修改
+        atexit.register(self._flush_at_exit)  # 退出时把内存里的修改写入数据库
 
-        self.database.row_factory = dict_factory
-
-        self.wxid_list = self._get_wxid_list()  # 获取已有用户列表
+        # 插件里“先检查再修改”中间有await的流程按用户加协程锁，不同用户互不等待
+        self.lock_stripes = 64  # 协程锁分段数，wxid按哈希分到各段
+        self.user_locks = [asyncio.Lock() for _ in range(self.lock_stripes)]
 
         self.executor = ThreadPoolExecutor(
             max_workers=1, thread_name_prefix="database"
-        )  # 用来当queue用
+        )  # 唯一的写线程，所有写操作都在这里排队
+        self.read_executor = ThreadPoolExecutor(
+            max_workers=self.read_workers, thread_name_prefix="database_read"
+        )  # async_ 开头的读方法在这里运行，不阻塞事件循环
 
     def _execute_in_queue(self, method, *args, **kwargs):
         future = self.executor.submit(method, *args, **kwargs)
@@ -64,272 +63,501 @@ class BotDatabase:
             # 处理异常情况
             logger.error(error)
 
-    def _get_wxid_list(self):
-        cursor = self.database.cursor()
+    async def _async_execute_in_queue(self, method, *args, **kwargs):  # 等待写线程时只挂起当前协程
+        try:
+            return await asyncio.wrap_future(self.executor.submit(method, *args, **kwargs))
+        except Exception as error:
+            logger.error(error)
 
+    async def _async_read(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
         try:
-            cursor.execute("select u.WXID from USERDATA u;")  # 获取已有用户
-            return [item["WXID"] for item in cursor.fetchall()]  # 获取已有用户列表
-        finally:
-            cursor.close()
+            return await loop.run_in_executor(self.read_executor, lambda: method(*args, **kwargs))
+        except Exception as error:
+            logger.error(error)
 
-    def _check_user(self, wxid):
-        cursor = self.database.cursor()
+    async def _async_cached(self, wxids, method, *args):  # 用户都在缓存里时直接在内存里完成，否则先在读线程里加载
+        if not all(wxid in self.user_cache for wxid in wxids):
+            return await self._async_read(method, *args)
+        try:  # 和 _async_read 一样处理异常，结果不因用户在不在缓存里而不同
+            return method(*args)
+        except Exception as error:
+            logger.error(error)
+
+    def _cached_user(self, wxid, load=True) -> dict:  # 取得缓存的用户数据，不在缓存里时从数据库读取，需要时新建用户
+        with self.cache_lock:
+            user = self.user_cache.get(wxid)
+            if user is not None:
+                self.user_cache.move_to_end(wxid)
+                return user
+
+        if not load:  # 持有锁时不读数据库
+            return None
+        return self._load_users((wxid,))[wxid]
+
+    @contextmanager
+    def _locked_users(self, *wxids):  # 先在锁外加载用户，再拿锁取得缓存的用户数据；期间又被移出缓存的话重新加载，锁里不读数据库
+        while True:
+            self._preload_users(wxids)
+            with self.cache_lock:
+                users = {wxid: self._cached_user(wxid, load=False) for wxid in wxids}
+                if None not in users.values():
+                    yield users
+                    return
+
+    def _preload_users(self, wxids) -> None:  # 在拿锁之前把不在缓存里的用户读进来，读数据库时不占着锁
+        if not all(wxid in self.user_cache for wxid in wxids):
+            self._load_users(wxids)
+
+    def _load_users(self, wxids) -> dict:  # 一次查询加载多个用户到缓存里，返回 wxid -> 缓存的用户数据
+        missing = [wxid for wxid in dict.fromkeys(wxids) if wxid not in self.user_cache and wxid in self.wxid_set]
+        rows = self.storage.load_users(missing) if missing else {}
+
+        users = {}
+        with self.cache_lock:
+            for wxid in wxids:
+                user = self.user_cache.get(wxid)
+                if user is None:  # 读数据库期间没有被别的线程加载
+                    user = rows.get(wxid)
+                    if user is None:  # 新用户，写入数据库时再创建
+                        user = new_user()
+                        self.dirty_users.setdefault(wxid, {"new": True, "ledger": []})
+                    self.user_cache[wxid] = user
+                else:
+                    self.user_cache.move_to_end(wxid)
+                users[wxid] = user
+            self._evict_users(users)
+        return users
+
+    def _evict_users(self, keep):  # 需要持有锁，超出上限时从最久未使用的一端移出已写入数据库的用户，keep里的用户不移出
+        excess = len(self.user_cache) - self.user_cache_size
+        if excess <= 0:
+            return
+
+        evicted = []
+        for wxid in itertools.islice(self.user_cache, excess + self.evict_scan_limit):  # 只看最旧的一段，不扫整个缓存
+            if len(evicted) >= excess:
+                break
+            if wxid not in self.dirty_users and wxid not in self.flushing_users and wxid not in keep:
+                evicted.append(wxid)
+        for wxid in evicted:  # 最旧的一段都还没写入时先超出上限，等写入之后再移出
+            del self.user_cache[wxid]
+
+    def _mark_dirty(self, wxid, change=0, reason=""):  # 需要持有锁，记录待写入的修改，有积分变化时同时记录流水
+        entry = self.dirty_users.setdefault(wxid, {"new": False, "ledger": []})
+        if change:
+            entry["ledger"].append((change, self.user_cache[wxid]["POINTS"], reason, time.time()))
+
+        self.user_change_count += 1
+        if self.leaderboard is not None:
+            self._update_leaderboard(wxid)
+
+    def _update_leaderboard(self, wxid):  # 需要持有锁，用修改后的用户数据更新内存中的排行榜
+        user = self.user_cache[wxid]
+        entry = next((entry for entry in self.leaderboard if entry["WXID"] == wxid), None)
+        full = len(self.leaderboard) >= self.leaderboard_size  # 没满说明所有用户都在榜上
+
+        if entry is not None:
+            if full and user["POINTS"] < entry["POINTS"]:  # 积分变少，榜外的用户可能超过他，下次重新查询
+                self.leaderboard = None
+                return
+            entry["NICKNAME"], entry["POINTS"] = user["NICKNAME"], user["POINTS"]
+        elif not full or user["POINTS"] > self.leaderboard[-1]["POINTS"]:  # 进入排行榜
+            self.leaderboard.append({"WXID": wxid, "NICKNAME": user["NICKNAME"], "POINTS": user["POINTS"]})
+        else:
+            return
+
+        self.leaderboard.sort(key=lambda item: item["POINTS"], reverse=True)
+        del self.leaderboard[self.leaderboard_size:]
+
+    def flush(self) -> int:
+        return self._execute_in_queue(self._flush)
+
+    def _flush(self) -> int:  # 只在写线程里调用，所有待写入的修改在一个事务里提交
+        with self.cache_lock:
+            if not self.dirty_users:
+                return 0
+            rows = {wxid: dict(self.user_cache[wxid]) for wxid in self.dirty_users}
+            dirty, self.dirty_users = self.dirty_users, {}
+            self.flushing_users = dirty  # 提交之前被移出缓存的话，会从数据库读到写入前的数据
+
+        try:  # 积分只写入变化量，存储里的积分始终等于流水总和
+            self.storage.write_users(
+                [wxid for wxid, entry in dirty.items() if entry["new"]],
+                {wxid: (sum(change for change, _, _, _ in entry["ledger"]), rows[wxid]["NICKNAME"],
+                        rows[wxid]["SIGNINSTAT"], rows[wxid]["WHITELIST"]) for wxid, entry in dirty.items()},
+                [(wxid, *record) for wxid, entry in dirty.items() for record in entry["ledger"]])
+        except Exception:
+            with self.cache_lock:  # 写入失败，把修改放回去等下次写入
+                for wxid, entry in dirty.items():
+                    newer = self.dirty_users.get(wxid)
+                    if newer:
+                        entry["new"] = entry["new"] or newer["new"]
+                        entry["ledger"] += newer["ledger"]
+                    self.dirty_users[wxid] = entry
+                self.flushing_users = {}
+            raise
+
+        with self.cache_lock:
+            self.wxid_set.update(wxid for wxid, entry in dirty.items() if entry["new"])
+            self.flushing_users = {}
+        logger.debug(f"[数据库] 已写入 {len(dirty)} 个用户的修改")
+        return len(dirty)
+
+    def _flush_at_exit(self):  # 退出时写线程已经结束，直接在当前线程写入
         try:
-            if not wxid in self.wxid_list:  # 不存在，创建用户并设置积分为增加的积分
-                sql = "INSERT INTO USERDATA (WXID, NICKNAME, POINTS, SIGNINSTAT, WHITELIST, PRIVATE_GPT_DATA) VALUES (?, ?, ?, ?, ?, ?)"
-                arg = (wxid, "", 0, 0, 0, "{}")
-                cursor.execute(sql, arg)
-                self.database.commit()  # 提交数据库
-            self.wxid_list = self._get_wxid_list()
-        finally:
-            cursor.close()
+            flushed = self._flush()
+            if flushed:
+                logger.info(f"[数据库] 退出前已写入 {flushed} 个用户的修改")
+        except Exception as error:
+            logger.error(f"[数据库] 退出前写入失败: {error}")
 
-    def add_points(self, wxid, num):
-        return self._execute_in_queue(self._add_points, wxid, num)
+    def add_points(self, wxid, num, reason=""):
+        with self._locked_users(wxid) as users:
+            user = users[wxid]
+            user["POINTS"] += num
+            self._mark_dirty(wxid, num, reason)
+            new_points = user["POINTS"]
 
-    def _add_points(self, wxid, num):
-        cursor = self.database.cursor()
+        logger.info(f"[数据库] {wxid} 积分已加 {num} 点，当前积分{new_points}")
 
-        try:
-            self._check_user(wxid)
-            sql = "SELECT POINTS FROM USERDATA WHERE WXID=?"  # 获取当前积分
-            arg = (wxid,)
-            cursor.execute(sql, arg)
-            new_points = cursor.fetchall()[0]["POINTS"] + num
-            sql = "UPDATE USERDATA SET POINTS=? WHERE WXID=?"
-            arg = (new_points, wxid,)
-            cursor.execute(sql, arg)
-            self.database.commit()
-            logger.info(f"[数据库] {wxid} 积分已加 {num} 点，当前积分{new_points}")
-        finally:
-            cursor.close()
+    def spend_points(self, wxid, num, reason=""):  # 积分足够时扣除并返回True，检查和扣除在同一把锁里
+        with self._locked_users(wxid) as users:
+            user = users[wxid]
+            if user["POINTS"] < num:
+                return False
+            user["POINTS"] -= num
+            self._mark_dirty(wxid, num * -1, reason)
+            new_points = user["POINTS"]
 
-    def set_points(self, wxid, num):
-        return self._execute_in_queue(self._set_points, wxid, num)
+        logger.info(f"[数据库] {wxid} 积分已扣除 {num} 点，当前积分{new_points}")
+        return True
 
-    def _set_points(self, wxid, num):
-        cursor = self.database.cursor()
+    def set_points(self, wxid, num, reason="admin"):
+        with self._locked_users(wxid) as users:
+            user = users[wxid]
+            change = num - user["POINTS"]
+            user["POINTS"] = num
+            self._mark_dirty(wxid, change, reason)
 
-        try:
-            self._check_user(wxid)
-            sql = "UPDATE USERDATA SET POINTS=? WHERE WXID=?"
-            arg = (num, wxid,)
-            cursor.execute(sql, arg)
-            self.database.commit()
-            logger.info(f"[数据库] {wxid} 积分已设置为 {num} 点")
-        finally:
-            cursor.close()
+        logger.info(f"[数据库] {wxid} 积分已设置为 {num} 点")
 
-    def get_points(self, wxid):
-        return self._execute_in_queue(self._get_points, wxid)
+    def get_points_ledger(self, wxid, limit=20) -> list:
+        self.flush()  # 先写入内存里的流水
 
-    def _get_points(self, wxid):
-        cursor = self.database.cursor()
+        return self.storage.get_points_ledger(wxid, limit)
 
-        try:
-            self._check_user(wxid)
-            sql = "SELECT POINTS FROM USERDATA WHERE WXID=?"
-            arg = (wxid,)
-            cursor.execute(sql, arg)
-            result = cursor.fetchall()[0]["POINTS"]
-            return result
-        finally:
-            cursor.close()
+    def audit_points(self) -> list:
+        """
+        找出积分和流水总和对不上的用户。Find users whose points do not match the sum of their ledger.
+        :return: list - [{"WXID", "POINTS", "LEDGER_POINTS"}]
+        """
+        return self.storage.audit_points()
 
-    def get_stat(self, wxid):
-        return self._execute_in_queue(self._get_stat, wxid)
+    def rebuild_points(self, wxid):
+        return self._execute_in_queue(self._rebuild_points, wxid)
 
-    def _get_stat(self, wxid):
-        cursor = self.database.cursor()
+    def _rebuild_points(self, wxid):  # 用流水总和重算积分，读写数据库时不占着锁，最后再更新缓存
+        self._flush()
+        self.storage.rebuild_points(wxid)
+        row = self.storage.load_users([wxid]).get(wxid)
 
-        try:
-            self._check_user(wxid)
-            sql = "SELECT SIGNINSTAT FROM USERDATA WHERE WXID=?"
-            arg = (wxid,)
-            cursor.execute(sql, arg)
-            result = cursor.fetchall()[0]["SIGNINSTAT"]
-            return result
-        finally:
-            cursor.close()
+        with self.cache_lock:
+            user = self.user_cache.get(wxid)
+            if user is not None and row is not None:  # 重算期间的修改还没写入，加回去
+                pending = self.dirty_users.get(wxid, {"ledger": []})["ledger"]
+                user["POINTS"] = row["POINTS"] + sum(change for change, _, _, _ in pending)
+            self.leaderboard = None
 
-    def set_stat(self, wxid, num):
-        return self._execute_in_queue(self._set_stat, wxid, num)
+        logger.info(f"[数据库] {wxid} 积分已按流水重算")
 
-    def _set_stat(self, wxid, num):
-        cursor = self.database.cursor()
+    def get_points(self, wxid):
+        return self._cached_user(wxid)["POINTS"]
 
-        try:
-            self._check_user(wxid)
-            sql = "UPDATE USERDATA SET SIGNINSTAT=? WHERE WXID=?"
+    def get_stat(self, wxid):
+        return self._cached_user(wxid)["SIGNINSTAT"]
 
-            arg = (num, wxid,)
-            cursor.execute(sql, arg)
-            self.database.commit()  # 提交数据库
-            logger.info(f"[数据库] {wxid} 签到状态已设置为 {num}")
-        finally:
-            cursor.close()
+    def set_stat(self, wxid, num):
+        with self._locked_users(wxid) as users:
+            users[wxid]["SIGNINSTAT"] = num
+            self._mark_dirty(wxid)
+
+        logger.info(f"[数据库] {wxid} 签到状态已设置为 {num}")
 
     def reset_stat(self):
-        cursor = self.database.cursor()
+        with self.cache_lock:  # 内存和数据库一起重置，在锁里提交保证排在之后的写入前面
+            for user in self.user_cache.values():
+                user["SIGNINSTAT"] = 0
+            future = self.executor.submit(self._reset_stat)
 
         try:
-            sql = "UPDATE USERDATA SET SIGNINSTAT=0"
-            cursor.execute(sql)
-            self.database.commit()  # 提交数据库
-            logger.info("[数据库] 签到状态已重置")
-        finally:
-            cursor.close()
+            return future.result(timeout=20)
+        except Exception as error:
+            logger.error(error)
 
-    def get_highest_points(self, num):
-        cursor = self.database.cursor()
+    def _reset_stat(self):
+        self.storage.reset_stat()
+        logger.info("[数据库] 签到状态已重置")
 
-        try:
-            sql = "SELECT * FROM USERDATA ORDER BY POINTS DESC LIMIT ?;"
-            arg = (num,)
-            cursor.execute(sql, arg)
-            result = cursor.fetchall()
-            return result
-        finally:
-            cursor.close()
+    def get_leaderboard(self, num) -> list:
+        """
+        获取积分排行榜，优先使用内存中的排行榜。Get the points leaderboard, served from memory when possible.
+        :param num: 排行榜人数。The number of users.
+        :return: list - [{"WXID", "NICKNAME", "POINTS"}]
+        """
+        with self.cache_lock:
+            if self.leaderboard is not None and num <= self.leaderboard_size:
+                return [dict(entry) for entry in self.leaderboard[:num]]
+            change_count = self.user_change_count
+
+        self.flush()  # 排行需要最新的积分
+
+        result = self.storage.get_leaderboard(num)
+
+        with self.cache_lock:
+            if change_count == self.user_change_count:  # 读数据库期间没有修改，可以作为内存中的排行榜
+                self.leaderboard = [dict(entry) for entry in result]
+                self.leaderboard_size = num
+
+        return result
+
+    def get_highest_points(self, num):  # 新代码请使用 get_leaderboard
+        return self.get_leaderboard(num)
 
     def set_whitelist(self, wxid, stat):
-        cursor = self.database.cursor()
+        with self._locked_users(wxid) as users:
+            users[wxid]["WHITELIST"] = stat
+            self._mark_dirty(wxid)
 
-        try:
-            self._check_user(wxid)
-            sql = "UPDATE USERDATA SET WHITELIST=? WHERE WXID=?"
-            arg = (stat, wxid,)
-            cursor.execute(sql, arg)
-            self.database.commit()  # 提交数据库
-            logger.info(f"[数据库] {wxid} 白名单状态已设置为 {stat}")
-        finally:
-            cursor.close()
+        logger.info(f"[数据库] {wxid} 白名单状态已设置为 {stat}")
 
     def get_whitelist(self, wxid):
-        cursor = self.database.cursor()
-
-        try:
-            self._check_user(wxid)
-            sql = "SELECT WHITELIST FROM USERDATA WHERE WXID=?"
-            arg = (wxid,)
-            cursor.execute(sql, arg)
-            result = cursor.fetchall()[0]["WHITELIST"]
-            return result
-        finally:
-            cursor.close()
+        return self._cached_user(wxid)["WHITELIST"]
 
     def safe_trade_points(self, trader_wxid, target_wxid, num):
-        return self._execute_in_queue(
-            self._safe_trade_points, trader_wxid, target_wxid, num
-        )
-
-    def _safe_trade_points(self, trader_wxid, target_wxid, num):
-        cursor = self.database.cursor()
+        with self._locked_users(trader_wxid, target_wxid) as users:  # 扣除和增加在同一把锁里，写入数据库时也在同一个事务里
+            trader, target = users[trader_wxid], users[target_wxid]
+            if trader["POINTS"] < num:
+                return False
 
+            trader["POINTS"] -= num
+            self._mark_dirty(trader_wxid, num * -1, "trade")
+            target["POINTS"] += num
+            self._mark_dirty(target_wxid, num, "trade")
+
+        logger.info(f"[数据库] {trader_wxid} 转帐 {num} 点积分给 {target_wxid}")
+        return True
+
+    @contextmanager
+    def atomic(self, *wxids):
+        """
+        在with块内对这些用户的多步修改要么全部生效，要么在出错时全部撤销，之后在同一个事务里写入数据库。
+        块内请只调用同步方法，不要await。
+        Make several changes to these users atomically: they are all undone if the block raises, and are written
+        to the database in one transaction. Only call synchronous methods inside the block, never await.
+        :param wxids: 要修改的用户。The users that will be changed.
+        :return: wxid -> 用户数据。wxid -> user data.
+        """
+        with self._locked_users(*wxids) as users:
+            saved = {wxid: (dict(user), len(self.dirty_users[wxid]["ledger"]) if wxid in self.dirty_users else None)
+                     for wxid, user in users.items()}
+            leaderboard = [dict(entry) for entry in self.leaderboard] if self.leaderboard is not None else None
+            leaderboard_size, change_count = self.leaderboard_size, self.user_change_count
+            try:
+                yield users
+            except Exception:
+                for wxid, (row, ledger_length) in saved.items():
+                    users[wxid].update(row)
+                    if ledger_length is None:
+                        self.dirty_users.pop(wxid, None)
+                    elif wxid in self.dirty_users:
+                        del self.dirty_users[wxid]["ledger"][ledger_length:]
+                # 块内的修改已经更新过排行榜，一起撤销
+                self.leaderboard, self.leaderboard_size = leaderboard, leaderboard_size
+                self.user_change_count = change_count
+                raise
+
+    @asynccontextmanager
+    async def lock_users(self, *wxids):
+        """
+        锁住这些用户，让插件里跨越await的“检查-修改”流程不被同一用户的其他消息打断，其他用户不受影响。
+        多个用户按固定顺序加锁，不会互相等待。
+        Lock these users so a check-then-modify sequence spanning awaits is not interleaved with other messages
+        from the same users. Unrelated users are not blocked. Stripes are acquired in a fixed order to avoid deadlocks.
+        :param wxids: 要锁住的用户。The users to lock.
+        """
+        stripes = sorted({hash(wxid) % self.lock_stripes for wxid in wxids})
+        acquired = []
         try:
-            self._check_user(trader_wxid)
-            self._check_user(target_wxid)
-            sql = "SELECT POINTS FROM USERDATA WHERE WXID=?"
-            arg = (trader_wxid,)
-
-            cursor.execute(sql, arg)
-            trader_points = cursor.fetchall()[0]["POINTS"]
-            if trader_points >= num:
-                self._add_points(trader_wxid, num * -1)
-                self._add_points(target_wxid, num)
-                return True
-            else:
-                return False
+            for stripe in stripes:
+                await self.user_locks[stripe].acquire()
+                acquired.append(self.user_locks[stripe])
+            yield
         finally:
-            cursor.close()
+            for lock in reversed(acquired):
+                lock.release()
+
+    def get_users(self, wxids) -> dict:
+        """
+        一次取得多个用户的数据。Get the data of several users at once.
+        :param wxids: 用户列表。The users.
+        :return: wxid -> {"NICKNAME", "POINTS", "SIGNINSTAT", "WHITELIST"}
+        """
+        with self._locked_users(*wxids) as users:
+            return {wxid: dict(user) for wxid, user in users.items()}
+
+    def add_points_many(self, changes: dict, reason="") -> None:
+        """
+        批量修改积分。Change the points of several users at once.
+        :param changes: wxid -> 积分变化。wxid -> points change.
+        :param reason: 流水记录的原因。The reason recorded in the ledger.
+        """
+        with self.atomic(*changes):
+            for wxid, num in changes.items():
+                self.add_points(wxid, num, reason)
+
+    def set_stat_many(self, stats: dict) -> None:
+        """
+        批量设置签到状态。Set the sign-in state of several users at once.
+        :param stats: wxid -> 签到状态。wxid -> sign-in state.
+        """
+        with self.atomic(*stats) as users:
+            for wxid, num in stats.items():
+                users[wxid]["SIGNINSTAT"] = num
+                self._mark_dirty(wxid)
+
+        logger.info(f"[数据库] 已设置 {len(stats)} 个用户的签到状态")
 
     def get_user_list(self) -> list:
-        cursor = self.database.cursor()
+        self.flush()  # 包括还没写入的新用户
 
-        try:
-            cursor.execute("select * from USERDATA")
-            result = cursor.fetchall()
-            return result
-        finally:
-            cursor.close()
+        return self.storage.get_user_list()
 
     def get_user_count(self) -> int:
-        cursor = self.database.cursor()
+        self.flush()  # 包括还没写入的新用户
 
-        try:
-            cursor.execute("select count(*) from USERDATA")
-            result = cursor.fetchall()[0]["count(*)"]
-            return result
-        finally:
-            cursor.close()
+        return self.storage.get_user_count()
 
-    def get_private_gpt_data(self, wxid: str) -> dict:
-        cursor = self.database.cursor()
+    def get_dialogue(self, wxid: str, limit: int) -> list:
+        """
+        获取最近的几条私聊GPT对话。Get the latest private GPT dialogue turns.
+        :param wxid: 用户wxid。The user.
+        :param limit: 最多返回的条数。The maximum number of turns.
+        :return: list - [{"role", "content"}]，从旧到新。Oldest first.
+        """
+        return self.storage.get_dialogue(wxid, limit)
 
-        try:
-            self._check_user(wxid)
-            sql = "SELECT PRIVATE_GPT_DATA FROM USERDATA WHERE WXID=?"
-            arg = (wxid,)
-            cursor.execute(sql, arg)
-            json_string = cursor.fetchone()["PRIVATE_GPT_DATA"]
-            if not json_string:
-                return {}
-            else:
-                json_data = json.loads(json_string)
-                return json_data
-        finally:
-            cursor.close()
+    def append_dialogue(self, wxid: str, turns: list, keep: int = 0) -> None:
+        return self._execute_in_queue(self._append_dialogue, wxid, turns, keep)
 
-    def save_private_gpt_data(self, wxid: str, data: dict) -> None:
-        cursor = self.database.cursor()
+    def _append_dialogue(self, wxid: str, turns: list, keep: int = 0) -> None:  # keep不为0时只保留最后keep条
+        self.storage.append_dialogue(wxid, turns, keep)
 
-        try:
-            self._check_user(wxid)
-            json_string = json.dumps(data)
-
-            sql = "UPDATE USERDATA SET PRIVATE_GPT_DATA=? WHERE WXID=?"
-            args = (json_string, wxid,)
-            cursor.execute(sql, args)
-            self.database.commit()  # 提交数据库
-            logger.info(f"[数据库] {wxid} 私聊GPT数据已保存")
-        finally:
-            cursor.close()
+        logger.info(f"[数据库] {wxid} 私聊GPT对话已保存")
 
-    def get_columns(self) -> list:
-        cursor = self.database.cursor()
+    def clear_dialogue(self, wxid: str) -> None:
+        return self._execute_in_queue(self._clear_dialogue, wxid)
 
-        try:
-            cursor.execute("PRAGMA table_info(USERDATA)")
-            columns = cursor.fetchall()
-            column_names = [column["name"] for column in columns]
-            return column_names
-        finally:
-            cursor.close()
+    def _clear_dialogue(self, wxid: str) -> None:
+        self.storage.clear_dialogue(wxid)
 
-    def get_nickname(self, wxid: str) -> str:
-        cursor = self.database.cursor()
+        logger.info(f"[数据库] {wxid} 私聊GPT对话已清除")
 
-        try:
-            self._check_user(wxid)
-            sql = "SELECT NICKNAME FROM USERDATA WHERE WXID=?"
-            arg = (wxid,)
-            cursor.execute(sql, arg)
-            result = cursor.fetchall()[0]["NICKNAME"]
+    def get_columns(self) -> list:
+        return self.storage.get_columns()
 
-            return result
-        finally:
-            cursor.close()
+    def get_nickname(self, wxid: str) -> str:
+        return self._cached_user(wxid)["NICKNAME"]
 
     def set_nickname(self, wxid: str, nickname: str) -> None:
-        cursor = self.database.cursor()
+        with self._locked_users(wxid) as users:
+            user = users[wxid]
+            if user["NICKNAME"] != nickname:  # 每条消息都会设置昵称，没变时不需要写入
+                user["NICKNAME"] = nickname
+                self._mark_dirty(wxid)
 
-        try:
-            self._check_user(wxid)
-            sql = "UPDATE USERDATA SET NICKNAME=? WHERE WXID=?"
+    # ---- 异步接口，插件里请使用这些方法，慢磁盘只会让等待的协程变慢，不会卡住整个机器人 ---- #
 
-            arg = (nickname, wxid,)
-            cursor.execute(sql, arg)
-            self.database.commit()  # 提交数据库
-        finally:
-            cursor.close()
+    async def async_flush(self) -> int:
+        return await self._async_execute_in_queue(self._flush)
+
+    async def async_add_points(self, wxid, num, reason=""):
+        return await self._async_cached((wxid,), self.add_points, wxid, num, reason)
+
+    async def async_spend_points(self, wxid, num, reason=""):
+        return await self._async_cached((wxid,), self.spend_points, wxid, num, reason)
+
+    async def async_set_points(self, wxid, num, reason="admin"):
+        return await self._async_cached((wxid,), self.set_points, wxid, num, reason)
+
+    async def async_get_points_ledger(self, wxid, limit=20) -> list:
+        return await self._async_read(self.get_points_ledger, wxid, limit)
+
+    async def async_audit_points(self) -> list:
+        return await self._async_read(self.audit_points)
+
+    async def async_rebuild_points(self, wxid):
+        return await self._async_execute_in_queue(self._rebuild_points, wxid)
+
+    async def async_get_points(self, wxid):
+        return await self._async_cached((wxid,), self.get_points, wxid)
+
+    async def async_get_stat(self, wxid):
+        return await self._async_cached((wxid,), self.get_stat, wxid)
+
+    async def async_set_stat(self, wxid, num):
+        return await self._async_cached((wxid,), self.set_stat, wxid, num)
+
+    async def async_reset_stat(self):
+        return await self._async_read(self.reset_stat)
+
+    async def async_get_leaderboard(self, num) -> list:
+        if self.leaderboard is not None and num <= self.leaderboard_size:
+            return self.get_leaderboard(num)
+        return await self._async_read(self.get_leaderboard, num)
+
+    async def async_get_highest_points(self, num):
+        return await self._async_read(self.get_highest_points, num)
+
+    async def async_set_whitelist(self, wxid, stat):
+        return await self._async_cached((wxid,), self.set_whitelist, wxid, stat)
+
+    async def async_get_whitelist(self, wxid):
+        return await self._async_cached((wxid,), self.get_whitelist, wxid)
+
+    async def async_safe_trade_points(self, trader_wxid, target_wxid, num):
+        return await self._async_cached((trader_wxid, target_wxid), self.safe_trade_points, trader_wxid, target_wxid,
+                                        num)
+
+    async def async_get_users(self, wxids) -> dict:
+        return await self._async_cached(wxids, self.get_users, wxids)
+
+    async def async_add_points_many(self, changes: dict, reason="") -> None:
+        return await self._async_cached(changes, self.add_points_many, changes, reason)
+
+    async def async_set_stat_many(self, stats: dict) -> None:
+        return await self._async_cached(stats, self.set_stat_many, stats)
+
+    async def async_get_user_list(self) -> list:
+        return await self._async_read(self.get_user_list)
+
+    async def async_get_user_count(self) -> int:
+        return await self._async_read(self.get_user_count)
+
+    async def async_get_dialogue(self, wxid: str, limit: int) -> list:
+        return await self._async_read(self.get_dialogue, wxid, limit)
+
+    async def async_append_dialogue(self, wxid: str, turns: list, keep: int = 0) -> None:
+        return await self._async_execute_in_queue(self._append_dialogue, wxid, turns, keep)
+
+    async def async_clear_dialogue(self, wxid: str) -> None:
+        return await self._async_execute_in_queue(self._clear_dialogue, wxid)
+
+    async def async_get_columns(self) -> list:
+        return await self._async_read(self.get_columns)
+
+    async def async_get_nickname(self, wxid: str) -> str:
+        return await self._async_cached((wxid,), self.get_nickname, wxid)
+
+    async def async_set_nickname(self, wxid: str, nickname: str) -> None:
+        return await self._async_cached((wxid,), self.set_nickname, wxid, nickname)
@@ -0,0 +1,132 @@
+#  Copyright (c) 2024. Henry Yang
+#
+#  This program is licensed under the GNU General Public License v3.0.
+
+import asyncio
+import gzip
+import os
+import shutil
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+from loguru import logger
+
+from utils.database import BotDatabase
+from utils.singleton import singleton
+from utils.storage import SQLiteStorage
+
+
+class BackupRestarted(Exception):  # 备份期间数据库被修改的次数太多
+    pass
+
+
+@singleton
+class DatabaseBackup:
+    def __init__(self):
+        with open("main_config.yml", "r", encoding="utf-8") as f:  # 读取设置
+            main_config = yaml.safe_load(f.read())
+
+        self.interval = main_config["database_backup_interval_hours"]  # 自动备份间隔（小时）
+        self.keep = main_config["database_backup_keep"]  # 保留的备份数量
+        self.compress = main_config["database_backup_compress"]  # 是否用gzip压缩备份
+
+        self.backup_path = os.path.abspath("resources/backups")
+        self.pages = 256  # 每一步复制的页数，两步之间让出数据库
+        self.step_sleep = 0.01  # 两步之间的间隔（秒）
+        self.max_restarts = 5  # 备份期间数据库被修改会从头开始，超过这个次数就改为一次复制完
+
+        os.makedirs(self.backup_path, exist_ok=True)
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="database_backup"
+        )  # 备份在单独的线程里排队进行，不占用数据库的写线程
+
+    async def async_backup(self) -> str:
+        """
+        先把内存里的修改写入数据库，再在后台线程备份。Flush pending changes, then back up on a background thread.
+        :return: 备份文件的路径。The path of the backup file.
+        """
+        db = BotDatabase()
+        if not isinstance(db.storage, SQLiteStorage):
+            raise RuntimeError("只有sqlite存储后端支持备份")
+
+        await db.async_flush()
+        return await asyncio.wrap_future(self.executor.submit(self.backup, db.storage.path))
+
+    def backup(self, database_path: str = "userdata.db") -> str:
+        """
+        用SQLite的在线备份接口备份数据库，并删除多余的旧备份。
+        Back up the database with SQLite's online backup API and remove old backups beyond the retention count.
+        :param database_path: 数据库路径。The database path.
+        :return: 备份文件的路径。The path of the backup file.
+        """
+        start_time = time.time()
+        name = time.strftime("userdata_%Y%m%d_%H%M%S.db")
+        temp_path = os.path.join(self.backup_path, name + ".tmp")
+
+        source = sqlite3.connect(f"file:{database_path}?mode=ro", uri=True)  # 只读连接，WAL模式下不会阻塞写线程
+        destination = sqlite3.connect(temp_path)
+        try:
+            try:
+                self._copy(source, destination, self.pages)
+            except BackupRestarted:
+                logger.warning("[备份]备份期间数据库频繁修改，改为一次复制完")
+                self._copy(source, destination, -1)
+        finally:
+            destination.close()
+            source.close()
+
+        if self.compress:
+            path = os.path.join(self.backup_path, name + ".gz")
+            with open(temp_path, "rb") as f_in, gzip.open(path + ".tmp", "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            os.remove(temp_path)
+            os.replace(path + ".tmp", path)
+        else:
+            path = os.path.join(self.backup_path, name)
+            os.replace(temp_path, path)
+
+        removed = self.rotate()
+        logger.info(f"[备份]数据库已备份到 {path}，用时 {time.time() - start_time:.2f} 秒，删除了 {removed} 个旧备份")
+        return path
+
+    def _copy(self, source: sqlite3.Connection, destination: sqlite3.Connection, pages: int) -> None:
+        restarts = 0
+        last_remaining = None
+
+        def progress(status, remaining, total):  # 剩余页数变多说明备份从头开始了
+            nonlocal restarts, last_remaining
+            if last_remaining is not None and remaining > last_remaining:
+                restarts += 1
+                if restarts > self.max_restarts:
+                    raise BackupRestarted()
+            last_remaining = remaining
+
+        source.backup(destination, pages=pages, progress=progress, sleep=self.step_sleep)
+
+    def rotate(self) -> int:
+        """
+        只保留最新的几个备份。Keep only the newest backups.
+        :return: 删除的备份数量。The number of removed backups.
+        """
+        backups = sorted(file for file in os.listdir(self.backup_path)
+                         if file.startswith("userdata_") and not file.endswith(".tmp"))
+        removed = backups[:-self.keep] if self.keep > 0 else []
+        for file in removed:
+            os.remove(os.path.join(self.backup_path, file))
+        return len(removed)
+
+    def list_backups(self) -> list:
+        """
+        列出已有的备份。List existing backups.
+        :return: list - [(文件名 file name, 大小 size in bytes)]，从新到旧。Newest first.
+        """
+        backups = sorted((file for file in os.listdir(self.backup_path)
+                          if file.startswith("userdata_") and not file.endswith(".tmp")), reverse=True)
+        return [(file, os.path.getsize(os.path.join(self.backup_path, file))) for file in backups]
+
+
+# 实例化数据库备份
+database_backup = DatabaseBackup()
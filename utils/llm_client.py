@@ -0,0 +1,341 @@
+#  Copyright (c) 2024. Henry Yang
+#
+#  This program is licensed under the GNU General Public License v3.0.
+
+import asyncio
+import random
+import re
+import time
+from collections import OrderedDict, deque
+from email.utils import parsedate_to_datetime
+
+import httpx
+import yaml
+from loguru import logger
+from openai import (APIConnectionError, AsyncOpenAI, DefaultAsyncHttpxClient, InternalServerError,
+                    RateLimitError)
+
+from utils.singleton import singleton
+
+SENTENCE_ENDS = ("。", "！", "？", "!", "?", "；", ";", "\n", ". ")  # 流式回答在这些地方分段
+WIDE_CHARACTERS = re.compile(r"[\u2e80-\U0002ffff]")  # 中日韩文字和全角标点，大约每个字1个token
+MESSAGE_OVERHEAD_TOKENS = 4  # 每条消息的角色等格式大约占用的token
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    不加载分词器，快速估算文字的token数，中文每字约1个，其他文字每4个字符约1个。
+    Quickly estimate the token count without a tokenizer: about 1 per CJK character and 1 per 4 other characters.
+    :param text: 文字。The text.
+    :return: 估算的token数。The estimated token count.
+    """
+    wide = len(WIDE_CHARACTERS.findall(text))
+    return wide + (len(text) - wide + 3) // 4
+
+
+def estimate_message_tokens(message: dict) -> int:
+    return estimate_tokens(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    截取文字的开头部分，使估算的token数不超过上限。Keep the start of the text so its estimated tokens fit the limit.
+    :param text: 文字。The text.
+    :param max_tokens: token上限。The token limit.
+    :return: 截取后的文字。The truncated text.
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+
+    low, high = 0, len(text)  # 二分查找最长的开头
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
+
+
+class ChatStream:
+    def __init__(self, stream, flush_chars: int, flush_seconds: float, release=None):
+        self.stream = stream
+        self.release = release  # 读完后调用，归还调度器的名额
+        self.flush_chars = flush_chars  # 攒够这么多字后在句子结尾处分段
+        self.flush_seconds = flush_seconds  # 距离上一段超过这么多秒后在句子结尾处分段
+
+        self.text = ""  # 完整的回答，读完之后可用
+        self.tool_calls = {}  # 序号 -> {"id", "type", "function": {"name", "arguments"}}，函数调用的参数是分段传来的
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+    async def aclose(self):
+        """
+        关闭流式回答的连接并归还调度器的名额，没读完就不要了时也要调用，可以重复调用。
+        Close the underlying response and release the scheduler slot. Call it even if the stream was not read to the end.
+        Safe to call more than once.
+        """
+        try:
+            await self.stream.close()
+        finally:
+            if self.release:
+                self.release()
+                self.release = None
+
+    async def segments(self):
+        """
+        读取流式回答，在句子或段落结尾处分段返回。Read the stream and yield the answer in sentence or paragraph chunks.
+        :return: 异步生成器，每次一段文字。An async generator of text chunks.
+        """
+        try:
+            async for segment in self._segments():
+                yield segment
+        finally:
+            if self.release:
+                self.release()
+                self.release = None
+
+    async def _segments(self):
+        buffer = ""
+        last_flush = time.monotonic()
+        async for chunk in self.stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+
+            for tool_call in delta.tool_calls or []:
+                entry = self.tool_calls.setdefault(tool_call.index, {"id": "", "type": "function",
+                                                                     "function": {"name": "", "arguments": ""}})
+                if tool_call.id:
+                    entry["id"] = tool_call.id
+                if tool_call.function:
+                    entry["function"]["name"] += tool_call.function.name or ""
+                    entry["function"]["arguments"] += tool_call.function.arguments or ""
+
+            if not delta.content:
+                continue
+            self.text += delta.content
+            buffer += delta.content
+
+            if len(buffer) >= self.flush_chars or time.monotonic() - last_flush >= self.flush_seconds:
+                cut = max(buffer.rfind(end) for end in SENTENCE_ENDS) + 1  # 最后一个句子结尾之后，没有则等下一段
+                if cut:
+                    segment, buffer = buffer[:cut].strip(), buffer[cut:]
+                    last_flush = time.monotonic()
+                    if segment:
+                        yield segment
+
+        if buffer.strip():
+            yield buffer.strip()
+
+    def message(self) -> dict:
+        """
+        读完之后，把回答组成可以放回对话里的消息。Build the assistant message to put back into the dialogue, after reading.
+        :return: {"role": "assistant", "content", "tool_calls"}
+        """
+        message = {"role": "assistant", "content": self.text or None}
+        if self.tool_calls:
+            message["tool_calls"] = [self.tool_calls[index] for index in sorted(self.tool_calls)]
+        return message
+
+
+@singleton
+class LLMClient:
+    def __init__(self):
+        with open("main_config.yml", "r", encoding="utf-8") as f:  # 读取设置
+            main_config = yaml.safe_load(f.read())
+
+        self.openai_api_base = main_config["openai_api_base"]  # openai api 链接
+        self.openai_api_key = main_config["openai_api_key"]  # openai api 密钥
+
+        limits = httpx.Limits(
+            max_connections=main_config["openai_max_connections"],
+            max_keepalive_connections=main_config["openai_max_keepalive_connections"],
+            keepalive_expiry=main_config["openai_keepalive_expiry"],
+        )  # 空闲的连接保留下来给之后的请求复用，省去每次建立连接和TLS握手
+
+        self.http_client = DefaultAsyncHttpxClient(limits=limits)  # 保留openai默认的超时等设置
+        self.client = AsyncOpenAI(api_key=self.openai_api_key, base_url=self.openai_api_base, max_retries=0,
+                                  http_client=self.http_client)  # 所有GPT插件共用的客户端，重试由下面的调度器负责
+
+        # 调度：同时进行的请求数有上限，排队的请求按用户轮流，一个人刷屏不会占满名额
+        self.max_concurrency = main_config["openai_max_concurrency"]  # 同时进行的请求数上限
+        self.max_retries = main_config["openai_max_retries"]  # 限流或服务器出错时最多重试几次
+        self.retry_base_delay = main_config["openai_retry_base_delay"]  # 第一次重试前等待的秒数，之后每次翻倍
+        self.retry_max_delay = main_config["openai_retry_max_delay"]  # 重试等待的上限（秒）
+        self.running = 0  # 正在进行的请求数
+        self.waiting = OrderedDict()  # wxid -> 排队的请求，按轮到的顺序排列
+        self.wait_times = deque(maxlen=1000)  # 最近的排队时间（秒）
+        self.retries = 0  # 重试的次数
+
+        self.in_flight = {}  # 键 -> 正在进行的请求，同样的请求共用一个
+        self.coalesced = 0  # 共用了别人请求的次数
+
+    def is_in_flight(self, key: str) -> bool:
+        return key in self.in_flight
+
+    async def coalesce(self, key: str, factory):
+        """
+        同样的请求正在进行时等它的结果，不再重复请求。Share the result of an identical request that is already in flight.
+        :param key: 请求的键，例如回答缓存的键。The request key, e.g. the response cache key.
+        :param factory: 没有进行中的请求时调用，返回要执行的协程。Called when nothing is in flight, returns the coroutine to run.
+        :return: 请求的结果。The result of the request.
+        """
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self.in_flight[key] = task
+            task.add_done_callback(lambda done: self._finish_flight(key, done))
+        else:
+            self.coalesced += 1
+            logger.info(f"[GPT] 同样的请求正在进行，等待它的结果，已合并 {self.coalesced} 次")
+
+        return await asyncio.shield(task)  # 某个等待者被取消时，请求照常进行
+
+    def _finish_flight(self, key: str, task) -> None:
+        if self.in_flight.get(key) is task:
+            del self.in_flight[key]
+
+    async def chat(self, wxid: str, **kwargs):
+        """
+        排队后请求对话补全。Request a chat completion through the scheduler.
+        :param wxid: 发起请求的用户，用来轮流排队。The requesting user, for fair queuing.
+        :param kwargs: chat.completions.create 的参数。Arguments for chat.completions.create.
+        :return: 对话补全。The chat completion.
+        """
+        chat_completion = await self._request(wxid, lambda: self.client.chat.completions.create(**kwargs))
+        self._release()
+        return chat_completion
+
+    async def generate_image(self, wxid: str, **kwargs):
+        """
+        排队后请求生成图片。Request an image generation through the scheduler.
+        :param wxid: 发起请求的用户，用来轮流排队。The requesting user, for fair queuing.
+        :param kwargs: images.generate 的参数。Arguments for images.generate.
+        :return: 生成的图片。The image generation result.
+        """
+        image_generation = await self._request(wxid, lambda: self.client.images.generate(**kwargs))
+        self._release()
+        return image_generation
+
+    async def stream_chat(self, wxid: str, flush_chars: int, flush_seconds: float, **kwargs) -> ChatStream:
+        """
+        排队后流式请求对话补全，读完之前一直占用名额。
+        Request a streamed chat completion through the scheduler. The slot is held until the stream is read.
+        :param wxid: 发起请求的用户，用来轮流排队。The requesting user, for fair queuing.
+        :param flush_chars: 攒够这么多字后分段。Chunk once this many characters are buffered.
+        :param flush_seconds: 距离上一段超过这么多秒后分段。Chunk once this many seconds have passed since the last chunk.
+        :param kwargs: chat.completions.create 的参数。Arguments for chat.completions.create.
+        :return: 用 segments() 读取的流式回答，请在 async with 里使用，保证连接关闭、名额归还。
+                 The stream, read with segments(). Use it in an async with block so the connection is closed and the slot released.
+        """
+        stream = await self._request(wxid, lambda: self.client.chat.completions.create(stream=True, **kwargs))
+        return ChatStream(stream, flush_chars, flush_seconds, self._release)
+
+    async def _request(self, wxid: str, factory):  # 排队并在限流时重试，成功时仍占用名额由调用者归还，失败时已归还
+        attempt = 0
+        while True:
+            await self._acquire(wxid)
+            try:
+                return await factory()
+            except (RateLimitError, InternalServerError, APIConnectionError) as error:
+                self._release()  # 等待重试时把名额让给别人
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._retry_delay(error, attempt)
+                logger.warning(f"[GPT] 请求失败: {error}，{delay:.1f} 秒后第 {attempt + 1} 次重试")
+            except BaseException:
+                self._release()
+                raise
+
+            attempt += 1
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+    def _retry_delay(self, error, attempt: int) -> float:  # 优先按服务器给的 Retry-After，否则指数退避加随机抖动
+        response = getattr(error, "response", None)
+        if response is not None:
+            retry_after_ms = response.headers.get("retry-after-ms")
+            retry_after = response.headers.get("retry-after")
+            try:
+                if retry_after_ms:
+                    return min(float(retry_after_ms) / 1000, self.retry_max_delay)
+                elif retry_after:
+                    return min(float(retry_after), self.retry_max_delay)
+            except ValueError:
+                try:  # 也可能是HTTP日期
+                    return min(max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0),
+                               self.retry_max_delay)
+                except (TypeError, ValueError):
+                    pass
+
+        delay = min(self.retry_base_delay * 2 ** attempt, self.retry_max_delay)
+        return delay * random.uniform(0.5, 1.5)
+
+    async def _acquire(self, wxid: str) -> None:  # 等到有空的名额，排队时各个用户轮流
+        if self.running < self.max_concurrency and not self.waiting:
+            self.running += 1
+            self.wait_times.append(0.0)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(wxid, deque()).append(future)
+        start_time = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():  # 已经拿到名额才被取消，还回去
+                self._release()
+            else:
+                queue = self.waiting.get(wxid)
+                if queue and future in queue:
+                    queue.remove(future)
+                    if not queue:
+                        del self.waiting[wxid]
+            raise
+
+        wait_time = time.monotonic() - start_time
+        self.wait_times.append(wait_time)
+        if wait_time > 1:
+            logger.info(f"[GPT] {wxid} 的请求排队了 {wait_time:.1f} 秒，还有 {len(self.waiting)} 人在排队")
+
+    def _release(self) -> None:  # 名额直接交给下一个轮到的用户，没人排队时才减少计数
+        while self.waiting:
+            wxid, queue = next(iter(self.waiting.items()))
+            future = queue.popleft()
+            if queue:
+                self.waiting.move_to_end(wxid)  # 这个用户还有请求，排到最后
+            else:
+                del self.waiting[wxid]
+
+            if not future.done():
+                future.set_result(None)
+                return
+
+        self.running -= 1
+
+    def stats(self) -> dict:
+        """
+        调度的情况。Scheduler statistics.
+        :return: {"running", "waiting", "wait_average", "wait_p95", "retries", "coalesced"}
+        """
+        wait_times = sorted(self.wait_times)
+        return {"running": self.running, "waiting": sum(len(queue) for queue in self.waiting.values()),
+                "wait_average": sum(wait_times) / len(wait_times) if wait_times else 0.0,
+                "wait_p95": wait_times[int(0.95 * (len(wait_times) - 1))] if wait_times else 0.0,
+                "retries": self.retries, "coalesced": self.coalesced}
+
+    async def close(self) -> None:
+        """
+        关闭连接池。Close the connection pool.
+        """
+        await self.client.close()
+        logger.info("[GPT] 已关闭OpenAI连接池")
+
+
+# 实例化GPT客户端
+llm_client = LLMClient()
@@ -0,0 +1,218 @@
+#  Copyright (c) 2024. Henry Yang
+#
+#  This program is licensed under the GNU General Public License v3.0.
+
+import asyncio
+import atexit
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import yaml
+from loguru import logger
+from wcferry import client
+
+from utils.cache_manager import cache_manager
+from utils.singleton import singleton
+from utils.voice_decoder import decode_silk_to_wav, silk_available
+from wcferry_helper import async_download_image, async_get_audio_msg
+
+
+@singleton
+class MediaStore:
+    def __init__(self):
+        with open("main_config.yml", "r", encoding="utf-8") as f:  # 读取设置
+            main_config = yaml.safe_load(f.read())
+
+        self.download_executor = ThreadPoolExecutor(
+            max_workers=main_config["media_download_workers"], thread_name_prefix="media_download"
+        )  # 限制同时向注入器请求下载的数量，超出的排队
+        self.voice_executor = ThreadPoolExecutor(
+            max_workers=main_config["voice_download_workers"], thread_name_prefix="voice_download"
+        )  # 语音单独一个池子，不和图片抢
+        self.voice_decode_executor = None  # SILK解码进程池，第一次用到时再创建
+        atexit.register(self.shutdown)  # 退出时结束解码进程
+        self.voice_sample_rate = 24000
+
+        self.store_path = os.path.join(cache_manager.cache_path, "media")  # 按内容哈希存放的媒体文件
+        self.download_path = os.path.join(cache_manager.cache_path, "downloading")  # 下载中的临时文件
+        os.makedirs(self.store_path, exist_ok=True)
+        os.makedirs(self.download_path, exist_ok=True)
+
+        self.index = sqlite3.connect("resources/media_index.db", check_same_thread=False)  # 消息id -> 内容哈希
+        self.index.execute("CREATE TABLE IF NOT EXISTS MEDIA_INDEX (MSGID TEXT PRIMARY KEY, HASH TEXT, PATH TEXT, TIME REAL)")
+        self.index.commit()
+        self.index_lock = threading.Lock()
+
+    def lookup(self, msg_id: int) -> str:
+        """
+        按消息id查找已下载的媒体文件。Look up a downloaded media file by message id.
+        :param msg_id: 消息id。The message id.
+        :return: 文件的绝对路径，没有则返回空字符串。The absolute path of the file, or an empty string if there is none.
+        """
+        with self.index_lock:
+            row = self.index.execute("SELECT PATH FROM MEDIA_INDEX WHERE MSGID=?", (str(msg_id),)).fetchone()
+            if not row:
+                return ""
+
+            path = os.path.join(self.store_path, row[0])
+            if not os.path.exists(path):  # 已经被缓存淘汰
+                self.index.execute("DELETE FROM MEDIA_INDEX WHERE MSGID=?", (str(msg_id),))
+                self.index.commit()
+                return ""
+
+        cache_manager.touch(path)
+        return path
+
+    async def get_image(self, bot: client.Wcf, msg_id: int, extra: str, timeout: int = 30) -> str:
+        """
+        获取图片消息的文件，同一条消息只下载一次，相同内容只存一份。
+        Get the file of an image message. Each message is downloaded once and identical content is stored once.
+        :param bot: 机器人实例。The bot.
+        :param msg_id: 消息id。The message id.
+        :param extra: 消息的extra字段。The extra field of the message.
+        :param timeout: 下载超时时间。The download timeout.
+        :return: 文件的绝对路径，下载失败返回空字符串。The absolute path of the file, or an empty string if the download failed.
+        """
+        path = self.lookup(msg_id)
+        if path:
+            logger.debug(f"[媒体]消息 {msg_id} 命中本地存储: {path}")
+            return path
+
+        temp_dir = tempfile.mkdtemp(dir=self.download_path)  # 每次下载单独一个目录，避免同名文件互相覆盖
+        try:
+            downloaded = await async_download_image(bot, msg_id, extra, temp_dir, timeout, self.download_executor)
+            if not downloaded:
+                return ""
+
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.store, msg_id, downloaded)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    async def get_voice(self, bot: client.Wcf, msg_id: int, timeout: int = 30) -> str:
+        """
+        获取语音消息转成的MP3文件，同一条消息只下载一次。
+        Get a voice message converted to an MP3 file. Each message is downloaded once.
+        :param bot: 机器人实例。The bot.
+        :param msg_id: 消息id。The message id.
+        :param timeout: 下载超时时间。The download timeout.
+        :return: 文件的绝对路径，下载失败返回空字符串。The absolute path of the file, or an empty string if the download failed.
+        """
+        path = self.lookup(msg_id)
+        if path:
+            return path
+
+        temp_dir = tempfile.mkdtemp(dir=self.download_path)
+        try:
+            downloaded = await async_get_audio_msg(bot, msg_id, temp_dir, timeout, self.voice_executor)
+            if not downloaded:
+                return ""
+
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.store, msg_id, downloaded)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    async def get_voice_wav(self, bot: client.Wcf, msg_id: int) -> bytes:
+        """
+        直接从微信数据库读取语音的SILK数据，在工作进程里解码成WAV，不经过磁盘。
+        Read the SILK data of a voice message from the WeChat database and decode it to WAV in a worker process,
+        without touching the disk.
+        :param bot: 机器人实例。The bot.
+        :param msg_id: 消息id。The message id.
+        :return: WAV数据，失败返回空bytes。The WAV data, or empty bytes on failure.
+        """
+        if not silk_available():
+            logger.warning("[媒体]未安装silk-python，无法解码语音，请使用 get_voice() 获取MP3文件")
+            return b""
+
+        loop = asyncio.get_running_loop()
+        silk = await loop.run_in_executor(self.voice_executor, self.query_silk, bot, msg_id)
+        if not silk:
+            return b""
+
+        if self.voice_decode_executor is None:
+            self.voice_decode_executor = ProcessPoolExecutor(max_workers=1)
+
+        try:
+            return await loop.run_in_executor(self.voice_decode_executor, decode_silk_to_wav, silk,
+                                              self.voice_sample_rate)
+        except Exception as error:
+            logger.error(f"[媒体]解码语音 {msg_id} 失败: {error}")
+            return b""
+
+    def shutdown(self) -> None:
+        """
+        结束SILK解码进程，之后用到时会重新创建。Shut down the SILK decode worker process, it is recreated on next use.
+        """
+        executor, self.voice_decode_executor = self.voice_decode_executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+            logger.debug("[媒体]语音解码进程已结束")
+
+    @staticmethod
+    def query_silk(bot: client.Wcf, msg_id: int) -> bytes:  # 语音数据存在MediaMSG*.db里
+        for db in bot.get_dbs():
+            if not db.startswith("MediaMSG"):
+                continue
+            rows = bot.query_sql(db, f"SELECT Buf FROM Media WHERE Reserved0 = {int(msg_id)}")
+            if rows and rows[0].get("Buf"):
+                return rows[0]["Buf"]
+        return b""
+
+    def store(self, msg_id: int, downloaded: str) -> str:
+        """
+        把下载好的文件按内容哈希存入，并记录消息id索引。
+        Move a downloaded file into content-addressed storage and index it by message id.
+        :param msg_id: 消息id。The message id.
+        :param downloaded: 下载好的文件路径。The path of the downloaded file.
+        :return: 存储后的绝对路径。The absolute path in storage.
+        """
+        content_hash = self.hash_file(downloaded)
+        relative_path = os.path.join(content_hash[:2], content_hash + os.path.splitext(downloaded)[1])
+        path = os.path.join(self.store_path, relative_path)
+
+        if os.path.exists(path):  # 同样的内容已经存过了，比如同一张图被转发到多个群
+            os.remove(downloaded)
+            cache_manager.touch(path)
+            logger.debug(f"[媒体]消息 {msg_id} 与已存储的文件内容相同: {path}")
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(downloaded, path)
+            cache_manager.register(path)
+
+        with self.index_lock:
+            self.index.execute("INSERT OR REPLACE INTO MEDIA_INDEX (MSGID, HASH, PATH, TIME) VALUES (?, ?, ?, ?)",
+                               (str(msg_id), content_hash, relative_path, time.time()))
+            self.index.commit()
+
+        return path
+
+    def prune(self, max_age: float) -> int:
+        """
+        删除过旧的索引记录。Remove index entries older than max_age seconds.
+        :param max_age: 最长保留时间（秒）。The maximum age in seconds.
+        :return: 删除的记录数量。The number of removed entries.
+        """
+        with self.index_lock:
+            cursor = self.index.execute("DELETE FROM MEDIA_INDEX WHERE TIME<?", (time.time() - max_age,))
+            self.index.commit()
+            return cursor.rowcount
+
+    @staticmethod
+    def hash_file(path: str) -> str:
+        file_hash = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+
+# 实例化媒体存储
+media_store = MediaStore()
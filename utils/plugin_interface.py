@@ -1,3 +1,9 @@
 class PluginInterface:
     def run(self, bot, recv):
         raise NotImplementedError("Subclasses must implement the 'run' method.")
+
+    def on_load(self, bot):  # 插件加载或重载后调用，可以在这里启动插件自己的后台任务
+        pass
+
+    def on_unload(self):  # 插件卸载或重载前调用，结束插件自己启动的后台任务
+        pass
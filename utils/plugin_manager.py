@@ -18,6 +18,7 @@ class PluginManager:
     def __init__(self):
         self.plugins = {"command": {}, "text": {}, "mention": {}, "image": {}, "voice": {}, "join_group": {}}
         self.keywords = {}
+        self.bot = None  # 机器人实例，加载插件时交给插件的 on_load
 
         with open("main_config.yml", "r", encoding="utf-8") as f:  # 读取设置
             config = yaml.safe_load(f.read())
@@ -84,6 +85,7 @@ class PluginManager:
                 if issubclass(plugin_class, PluginInterface):  # 判断插件是否是PluginInterface的子类
                     plugin_instance = plugin_class()
                     self.plugins[plugin_type][plugin_name] = plugin_instance  # 将插件实例存入插件字典
+                    plugin_instance.on_load(self.bot)
                     if log:
                         logger.info(f"+ 已加载插件：{plugin_name}")
                     if not no_refresh:
@@ -118,6 +120,7 @@ class PluginManager:
                         if issubclass(plugin_class, PluginInterface):  # 判断插件是否是PluginInterface的子类
                             plugin_instance = plugin_class()
                             self.plugins[plugin_type][plugin_name] = plugin_instance  # 将插件实例存入插件字典
+                            plugin_instance.on_load(self.bot)
                             logger.info(f"+ 已加载插件：{plugin_name}")
 
                         else:
@@ -139,6 +142,7 @@ class PluginManager:
 
         for plugin_type in self.all_plugin_types:
             if plugin_name in self.plugins[plugin_type].keys():
+                self.plugins[plugin_type][plugin_name].on_unload()
                 del self.plugins[plugin_type][plugin_name]
                 del sys.modules[f"plugins.{plugin_type}.{plugin_name}"]
                 logger.info(f"- 已卸载插件：{plugin_name}")
@@ -160,6 +164,7 @@ class PluginManager:
         for plugin_type in self.all_plugin_types:
             for plugin_name in list(self.plugins[plugin_type].keys()):
                 if plugin_name != "manage_plugins":
+                    self.plugins[plugin_type][plugin_name].on_unload()
                     del self.plugins[plugin_type][plugin_name]
                     del sys.modules[f"plugins.{plugin_type}.{plugin_name}"]
                     logger.info(f"- 已卸载插件：{plugin_name}")
@@ -179,6 +184,7 @@ class PluginManager:
         for plugin_type in self.all_plugin_types:
             if plugin_name in list(self.plugins[plugin_type].keys()):
                 # 卸载
+                self.plugins[plugin_type][plugin_name].on_unload()
                 del self.plugins[plugin_type][plugin_name]
                 del sys.modules[f"plugins.{plugin_type}.{plugin_name}"]
 
@@ -188,6 +194,7 @@ class PluginManager:
                 if issubclass(plugin_class, PluginInterface):  # 判断插件是否是PluginInterface的子类
                     plugin_instance = plugin_class()
                     self.plugins[plugin_type][plugin_name] = plugin_instance  # 将插件实例存入插件字典
+                    plugin_instance.on_load(self.bot)
 
                     self.refresh_keywords()
                     logger.info(f"+ 已重载插件：{plugin_name}")
@@ -210,6 +217,7 @@ class PluginManager:
             for plugin_name in list(self.plugins[plugin_type].keys()):
                 if plugin_name != "manage_plugins":
                     # 卸载
+                    self.plugins[plugin_type][plugin_name].on_unload()
                     del self.plugins[plugin_type][plugin_name]
                     del sys.modules[f"plugins.{plugin_type}.{plugin_name}"]
 
@@ -219,6 +227,7 @@ class PluginManager:
                     if issubclass(plugin_class, PluginInterface):
                         plugin_instance = plugin_class()
                         self.plugins[plugin_type][plugin_name] = plugin_instance
+                        plugin_instance.on_load(self.bot)
                         logger.info(f"+ 已重载插件：{plugin_name}")
                     else:
                         logger.error(f"! 未重载插件：{plugin_name}，因为它不是PluginInterface的子类")
@@ -0,0 +1,217 @@
+#  Copyright (c) 2024. Henry Yang
+#
+#  This program is licensed under the GNU General Public License v3.0.
+
+import atexit
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import yaml
+from loguru import logger
+
+from utils.cache_manager import cache_manager
+from utils.singleton import singleton
+
+
+@singleton
+class ResponseCache:
+    def __init__(self):
+        with open("main_config.yml", "r", encoding="utf-8") as f:  # 读取设置
+            main_config = yaml.safe_load(f.read())
+
+        self.ttl = main_config["response_cache_ttl_hours"] * 3600  # 缓存的回答保留多久（秒）
+        self.max_entries = main_config["response_cache_max_entries"]  # 最多缓存多少个回答，0为关闭
+
+        self.store_path = os.path.abspath("resources/response_cache")  # 缓存的图片也放在这里，不参与普通缓存的淘汰
+        os.makedirs(self.store_path, exist_ok=True)
+
+        self.entries = OrderedDict()  # 键 -> [内容, 过期时间]，按最后使用时间从旧到新排列
+        self.hits = 0
+        self.misses = 0
+        self.last_used = {}  # 命中后还没写入数据库的最后使用时间，键 -> 时间，由缓存清理计划和退出时批量写入
+        self.lock = threading.Lock()
+
+        self.index = sqlite3.connect(os.path.join(self.store_path, "index.db"), check_same_thread=False)
+        self.index.execute("CREATE TABLE IF NOT EXISTS RESPONSE_CACHE "
+                           "(KEY TEXT PRIMARY KEY, KIND TEXT, VALUE TEXT, EXPIRE REAL, LAST_USED REAL)")
+        self.index.commit()
+
+        self._load()
+        atexit.register(self.flush_last_used)  # 退出时写入还没保存的最后使用时间
+
+    def _load(self) -> None:  # 启动时读取没过期的回答，按最后使用时间排列
+        now = time.time()
+        expired = self.index.execute("SELECT KIND, VALUE FROM RESPONSE_CACHE WHERE EXPIRE<=?", (now,)).fetchall()
+        self.index.execute("DELETE FROM RESPONSE_CACHE WHERE EXPIRE<=?", (now,))
+        self.index.commit()
+        self._remove_files(expired)
+
+        for key, value, expire in self.index.execute(
+                "SELECT KEY, VALUE, EXPIRE FROM RESPONSE_CACHE ORDER BY LAST_USED"):
+            self.entries[key] = [value, expire]
+
+        with self.lock:
+            evicted = self._pop_over_size()
+        self._remove_files(evicted)
+
+        logger.info(f"[回答缓存] 已读取 {len(self.entries)} 个缓存的回答")
+
+    @staticmethod
+    def key(kind: str, model: str, prompt: str, **params) -> str:
+        """
+        用模型、参数和规范化后的问题生成缓存键。Build a cache key from the model, parameters and normalized prompt.
+        :param kind: "chat" 或 "image"。
+        :param model: 模型名。The model name.
+        :param prompt: 问题或图片描述。The prompt.
+        :param params: 影响回答的参数，例如 temperature、max_tokens。Parameters that affect the answer.
+        :return: 缓存键。The cache key.
+        """
+        normalized = " ".join(prompt.split()).casefold()  # 忽略多余的空白和大小写
+        raw = json.dumps([kind, model, sorted(params.items()), normalized], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str:
+        """
+        取得缓存的回答。Get a cached answer.
+        :param key: 缓存键。The cache key.
+        :return: 缓存的回答，没有或已过期时返回None。The cached answer, or None if missing or expired.
+        """
+        if not self.max_entries:
+            return None
+
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                self.last_used[key] = now  # 只记在内存里，命中时不写数据库
+                return entry[0]
+
+            self.misses += 1
+            if not entry:
+                return None
+            expired = self._discard(key)  # 过期的顺便删掉
+            self.index.commit()
+
+        self._remove_files(expired)
+        return None
+
+    def put(self, key: str, value: str, kind: str = "chat") -> None:
+        """
+        缓存一个回答，超过数量上限时淘汰最久未使用的。Cache an answer, evicting the least recently used ones over the cap.
+        :param key: 缓存键。The cache key.
+        :param value: 回答，图片时为文件路径。The answer, or the file path for images.
+        :param kind: "chat" 或 "image"。
+        """
+        if not self.max_entries:
+            return
+
+        now = time.time()
+        with self.lock:
+            old = self.entries.pop(key, None)
+            self.last_used.pop(key, None)
+            self.entries[key] = [value, now + self.ttl]
+            self.index.execute("INSERT OR REPLACE INTO RESPONSE_CACHE (KEY, KIND, VALUE, EXPIRE, LAST_USED) "
+                               "VALUES (?, ?, ?, ?, ?)", (key, kind, value, now + self.ttl, now))
+            evicted = self._pop_over_size()
+            self.index.commit()
+
+        if old and old[0] != value:
+            evicted.append((kind, old[0]))
+        self._remove_files(evicted)
+
+    def get_file(self, key: str) -> str:
+        """
+        取得缓存的图片在普通缓存里的副本，用来发送。Get a copy of a cached image in the regular cache for sending.
+        :param key: 缓存键。The cache key.
+        :return: 副本的路径，没有时返回None。The path of the copy, or None if missing.
+        """
+        stored_path = self.get(key)
+        if stored_path is None:
+            return None
+        if not os.path.exists(stored_path):  # 文件被手动删除了
+            with self.lock:
+                self._discard(key)
+                self.index.commit()
+            return None
+
+        version = os.stat(stored_path).st_mtime_ns  # 同一个键重新生成过图片时不会用到旧的副本
+        path = os.path.join(cache_manager.cache_path, f"response_{version}_{os.path.basename(stored_path)}")
+        if os.path.exists(path):  # 上次复制的还没被淘汰，直接复用
+            cache_manager.touch(path)
+        else:
+            temp_path = f"{path}.{time.time_ns()}.tmp"  # 先写临时文件，同时取用的消息不会读到复制到一半的图片
+            shutil.copyfile(stored_path, temp_path)
+            os.replace(temp_path, path)
+            cache_manager.register(path)
+        return path
+
+    def put_file(self, key: str, path: str) -> None:
+        """
+        缓存一张生成的图片。Cache a generated image.
+        :param key: 缓存键。The cache key.
+        :param path: 图片路径，会复制一份保存。The image path, a copy is stored.
+        """
+        if not self.max_entries:
+            return
+
+        stored_path = os.path.join(self.store_path, f"{key}{os.path.splitext(path)[1]}")
+        shutil.copyfile(path, stored_path)
+        self.put(key, stored_path, "image")
+
+    def flush_last_used(self) -> int:
+        """
+        把命中时记下的最后使用时间批量写入数据库，重启后按它恢复淘汰顺序。
+        Write the last-used times recorded on hits to the database in one batch, so the eviction order survives a restart.
+        :return: 写入的数量。The number of written entries.
+        """
+        with self.lock:
+            if not self.last_used:
+                return 0
+            last_used, self.last_used = self.last_used, {}
+            self.index.executemany("UPDATE RESPONSE_CACHE SET LAST_USED=? WHERE KEY=?",
+                                   [(used, key) for key, used in last_used.items()])
+            self.index.commit()
+        return len(last_used)
+
+    def _discard(self, key: str) -> list:  # 需要持有锁，删除一个回答，返回 [(类型, 内容)]
+        entry = self.entries.pop(key, None)
+        self.last_used.pop(key, None)
+        row = self.index.execute("SELECT KIND FROM RESPONSE_CACHE WHERE KEY=?", (key,)).fetchone()
+        self.index.execute("DELETE FROM RESPONSE_CACHE WHERE KEY=?", (key,))
+        return [(row[0] if row else "chat", entry[0])] if entry else []
+
+    def _pop_over_size(self) -> list:  # 需要持有锁，返回被淘汰的 [(类型, 内容)]
+        evicted = []
+        while len(self.entries) > self.max_entries:
+            evicted += self._discard(next(iter(self.entries)))
+        return evicted
+
+    def _remove_files(self, evicted: list) -> None:
+        for kind, value in evicted:
+            if kind == "image" and os.path.dirname(value) == self.store_path:
+                try:
+                    os.remove(value)
+                except OSError:
+                    pass
+
+    def stats(self) -> dict:
+        """
+        缓存的命中情况。Cache hit statistics.
+        :return: {"entries", "hits", "misses", "hit_rate"}
+        """
+        with self.lock:
+            total = self.hits + self.misses
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / total if total else 0.0}
+
+
+# 实例化回答缓存
+response_cache = ResponseCache()
@@ -0,0 +1,117 @@
+#  Copyright (c) 2024. Henry Yang
+#
+#  This program is licensed under the GNU General Public License v3.0.
+
+import os
+import threading
+import time
+from collections import deque
+
+import yaml
+from loguru import logger
+
+from utils.singleton import singleton
+
+
+@singleton
+class SensitiveWords:
+    def __init__(self):
+        self.path = "sensitive_words.yml"
+        self.check_interval = 5  # 最多隔几秒检查一次文件有没有修改
+
+        # Aho-Corasick 自动机，状态0是根
+        self.goto = [{}]  # 状态 -> {字符: 下一个状态}
+        self.fail = [0]  # 状态 -> 匹配失败时跳到的状态
+        self.output = [None]  # 状态 -> 到这里结束的敏感词（包括沿失败链能匹配到的），没有则为None
+
+        self.mtime = None
+        self.last_check = 0.0
+        self.lock = threading.Lock()
+
+        self._reload_if_changed(force=True)
+
+    def _reload_if_changed(self, force: bool = False) -> None:  # 文件修改过时重新生成自动机
+        now = time.monotonic()
+        if not force and now - self.last_check < self.check_interval:
+            return
+
+        with self.lock:
+            self.last_check = now
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError as error:
+                logger.error(f"[敏感词] 无法读取 {self.path}: {error}")
+                return
+            if mtime == self.mtime:
+                return
+
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:  # 读取设置
+                    config = yaml.safe_load(f.read())
+            except (OSError, yaml.YAMLError) as error:  # 改到一半的文件，继续用之前的敏感词
+                logger.error(f"[敏感词] 无法读取 {self.path}: {error}")
+                return
+            words = [str(word) for word in (config or {}).get("sensitive_words") or [] if word]
+
+            self.goto, self.fail, self.output = self._build(words)  # 一起替换，检查中的消息继续用旧的自动机
+            self.mtime = mtime
+            logger.info(f"[敏感词] 已加载 {len(words)} 个敏感词")
+
+    @staticmethod
+    def _build(words: list) -> tuple:
+        goto, fail, output = [{}], [0], [None]
+        for word in words:  # 先建字典树
+            state = 0
+            for char in word:
+                if char not in goto[state]:
+                    goto.append({})
+                    fail.append(0)
+                    output.append(None)
+                    goto[state][char] = len(goto) - 1
+                state = goto[state][char]
+            if output[state] is None:
+                output[state] = word
+
+        queue = deque(goto[0].values())  # 再按层补上失败链
+        while queue:
+            state = queue.popleft()
+            for char, next_state in goto[state].items():
+                queue.append(next_state)
+                fallback = fail[state]
+                while fallback and char not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[next_state] = goto[fallback].get(char, 0)
+                if output[next_state] is None:
+                    output[next_state] = output[fail[next_state]]
+
+        return goto, fail, output
+
+    def find(self, message: str) -> str:
+        """
+        扫描一遍消息，找出其中的敏感词。Scan the message once and find a sensitive word in it.
+        :param message: 消息。The message.
+        :return: 找到的第一个敏感词，没有则返回None。The first sensitive word found, or None.
+        """
+        self._reload_if_changed()
+
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for char in message:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state] is not None:
+                return output[state]
+        return None
+
+    def check(self, message: str) -> bool:
+        """
+        检查消息是否不含敏感词。Check that the message contains no sensitive words.
+        :param message: 消息。The message.
+        :return: 不含敏感词时返回True。True if the message is clean.
+        """
+        return self.find(message) is None
+
+
+# 实例化敏感词检查
+sensitive_words = SensitiveWords()
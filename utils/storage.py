@@ -0,0 +1,595 @@
+#  Copyright (c) 2024. Henry Yang
+#
+#  This program is licensed under the GNU General Public License v3.0.
+
+import heapq
+import json
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+from loguru import logger
+
+USER_FIELDS = ["NICKNAME", "POINTS", "SIGNINSTAT", "WHITELIST"]  # 每个用户保存的数据，WXID之外的列
+
+
+# row factory function for the database
+def dict_factory(cursor, row):
+    fields = [column[0] for column in cursor.description]
+    return {key: value for key, value in zip(fields, row)}
+
+
+def new_user() -> dict:
+    return {"NICKNAME": "", "POINTS": 0, "SIGNINSTAT": 0, "WHITELIST": 0}
+
+
+class StorageBackend:
+    """
+    BotDatabase 的存储后端。写方法只会在 BotDatabase 的写线程里调用，读方法可能在多个线程里同时调用。
+    Storage backend behind BotDatabase. Write methods are only called from the BotDatabase writer thread,
+    read methods may be called from several threads at once.
+    """
+
+    def get_wxids(self) -> set:
+        raise NotImplementedError("Subclasses must implement the 'get_wxids' method.")
+
+    def load_users(self, wxids: list) -> dict:  # 只返回已存在的用户，wxid -> {"NICKNAME", "POINTS", "SIGNINSTAT", "WHITELIST"}
+        raise NotImplementedError("Subclasses must implement the 'load_users' method.")
+
+    def write_users(self, new_wxids: list, rows: dict, ledger: list) -> None:
+        """
+        把一批修改作为一个整体写入。Write a batch of changes as one unit.
+        :param new_wxids: 需要新建的用户。Users to create.
+        :param rows: wxid -> (积分变化 points change, 昵称 nickname, 签到状态 sign-in state, 白名单 whitelist)，
+                     还不存在的用户会新建。Users that do not exist yet are created.
+        :param ledger: [(wxid, 变化 change, 余额 balance, 原因 reason, 时间 time)]
+        """
+        raise NotImplementedError("Subclasses must implement the 'write_users' method.")
+
+    def reset_stat(self) -> None:
+        raise NotImplementedError("Subclasses must implement the 'reset_stat' method.")
+
+    def get_leaderboard(self, num: int) -> list:  # [{"WXID", "NICKNAME", "POINTS"}]
+        raise NotImplementedError("Subclasses must implement the 'get_leaderboard' method.")
+
+    def get_user_list(self) -> list:
+        raise NotImplementedError("Subclasses must implement the 'get_user_list' method.")
+
+    def get_user_count(self) -> int:
+        raise NotImplementedError("Subclasses must implement the 'get_user_count' method.")
+
+    def get_columns(self) -> list:
+        return ["WXID"] + USER_FIELDS
+
+    def get_points_ledger(self, wxid: str, limit: int) -> list:  # [{"CHANGE", "BALANCE", "REASON", "TIME"}]，从新到旧
+        raise NotImplementedError("Subclasses must implement the 'get_points_ledger' method.")
+
+    def audit_points(self) -> list:  # [{"WXID", "POINTS", "LEDGER_POINTS"}]
+        raise NotImplementedError("Subclasses must implement the 'audit_points' method.")
+
+    def rebuild_points(self, wxid: str) -> None:
+        raise NotImplementedError("Subclasses must implement the 'rebuild_points' method.")
+
+    def get_dialogue(self, wxid: str, limit: int) -> list:  # [{"role", "content"}]，从旧到新
+        raise NotImplementedError("Subclasses must implement the 'get_dialogue' method.")
+
+    def append_dialogue(self, wxid: str, turns: list, keep: int) -> None:  # keep不为0时只保留最后keep条
+        raise NotImplementedError("Subclasses must implement the 'append_dialogue' method.")
+
+    def clear_dialogue(self, wxid: str) -> None:
+        raise NotImplementedError("Subclasses must implement the 'clear_dialogue' method.")
+
+
+class SQLiteStorage(StorageBackend):
+    def __init__(self, path: str = "userdata.db"):
+        self.path = path
+        self.database_column = [("WXID", "TEXT PRIMARY KEY"), ("NICKNAME", "TEXT"), ("POINTS", "INT"),
+                                ("SIGNINSTAT", "INT"), ("WHITELIST", "INT")]
+
+        self.cache_size = -16000  # 每个连接的页缓存，负数单位为KB
+        self.read_connection_count = 4  # 只读连接池大小
+        self.dialogue_compress_size = 512  # 超过这个字节数的对话内容压缩后保存
+
+        self.database = sqlite3.connect(path, check_same_thread=False)  # 写连接，只在写线程里使用
+        self.database.row_factory = dict_factory
+        self.database.execute("PRAGMA journal_mode=WAL")  # WAL模式下读不会被写阻塞
+        self.database.execute("PRAGMA synchronous=NORMAL")  # WAL模式下NORMAL不会损坏数据库，只在断电时可能丢最后几次提交
+        self.database.execute(f"PRAGMA cache_size={self.cache_size}")
+        self.database.execute("PRAGMA temp_store=MEMORY")
+
+        # 数据库结构的迁移步骤，按顺序执行，执行到第几步记录在 PRAGMA user_version 里
+        # 只能在末尾追加新的步骤，每一步都要能在已经手动改过的数据库上重复执行
+        self.migrations = [self._create_userdata, self._create_points_ledger, self._create_points_index,
+                           self._create_dialogue_table]
+        self._migrate()
+
+        self.read_pool = queue.Queue()  # 只读连接池，各个线程都可以同时读
+        for _ in range(self.read_connection_count):
+            connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+            connection.row_factory = dict_factory
+            connection.execute(f"PRAGMA cache_size={self.cache_size}")
+            self.read_pool.put(connection)
+
+    @contextmanager
+    def _read_cursor(self):  # 从只读连接池借一个连接
+        connection = self.read_pool.get()
+        cursor = connection.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+            self.read_pool.put(connection)
+
+    @contextmanager
+    def _transaction(self):  # 只在写线程里使用，块内的所有语句一起提交，出错时回滚
+        cursor = self.database.cursor()
+        try:
+            yield cursor
+            self.database.commit()
+        except Exception:
+            self.database.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def _migrate(self):  # 执行还没执行过的迁移步骤，每一步和版本号在同一个事务里提交
+        cursor = self.database.cursor()
+
+        try:
+            cursor.execute("PRAGMA user_version")
+            version = cursor.fetchone()["user_version"]
+            if version > len(self.migrations):
+                logger.warning(f"[数据库] 数据库版本 {version} 比程序支持的版本 {len(self.migrations)} 新，请更新XYBot")
+                return
+
+            for number, migration in enumerate(self.migrations[version:], version + 1):
+                cursor.execute("BEGIN")
+                try:
+                    migration(cursor)
+                    cursor.execute(f"PRAGMA user_version={number}")
+                    self.database.commit()
+                except Exception:
+                    self.database.rollback()
+                    raise
+                logger.info(f"[数据库] 已升级到版本 {number}: {migration.__name__}")
+        finally:
+            cursor.close()
+
+    def _create_userdata(self, cursor):
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='USERDATA'")
+        if cursor.fetchall():
+            return
+
+        logger.warning("检测到数据库不存在，正在创建数据库")
+        cursor.execute(f"CREATE TABLE USERDATA ({', '.join(f'{name} {kind}' for name, kind in self.database_column)})")
+
+    @staticmethod
+    def _create_points_ledger(cursor):  # 积分流水表，只追加，任何用户的积分都可以由流水重算
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='POINTS_LEDGER'")
+        if cursor.fetchall():
+            return
+
+        cursor.execute("CREATE TABLE POINTS_LEDGER (ID INTEGER PRIMARY KEY AUTOINCREMENT, WXID TEXT, "
+                       "CHANGE INT, BALANCE INT, REASON TEXT, TIME REAL)")
+        cursor.execute("CREATE INDEX POINTS_LEDGER_WXID ON POINTS_LEDGER (WXID)")
+        # 已有的积分作为初始流水，保证流水总和等于当前积分
+        cursor.execute("INSERT INTO POINTS_LEDGER (WXID, CHANGE, BALANCE, REASON, TIME) "
+                       "SELECT WXID, POINTS, POINTS, 'initial', ? FROM USERDATA WHERE POINTS != 0", (time.time(),))
+
+    @staticmethod
+    def _create_points_index(cursor):  # 排行榜不需要全表排序
+        cursor.execute("CREATE INDEX IF NOT EXISTS USERDATA_POINTS ON USERDATA (POINTS)")
+
+    def _create_dialogue_table(self, cursor):  # 私聊GPT对话表，每条消息一行，只追加不重写
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='GPT_DIALOGUE'")
+        if cursor.fetchall():
+            return
+
+        cursor.execute("CREATE TABLE GPT_DIALOGUE (WXID TEXT, SEQ INT, ROLE TEXT, CONTENT BLOB, COMPRESSED INT, "
+                       "TIME REAL, PRIMARY KEY (WXID, SEQ)) WITHOUT ROWID")
+
+        cursor.execute("PRAGMA table_info(USERDATA)")
+        if "PRIVATE_GPT_DATA" in [column["name"] for column in cursor.fetchall()]:  # 把旧的对话数据搬到新表
+            cursor.execute("SELECT WXID, PRIVATE_GPT_DATA FROM USERDATA WHERE PRIVATE_GPT_DATA NOT IN ('', '{}')")
+            rows = []
+            for user in cursor.fetchall():
+                try:
+                    turns = json.loads(user["PRIVATE_GPT_DATA"]).get("data", [])
+                except (ValueError, AttributeError):
+                    continue
+                turns = self._dialogue_turns(user["WXID"], turns)
+                rows += [self._dialogue_row(user["WXID"], seq, turn) for seq, turn in enumerate(turns, 1)]
+            cursor.executemany("INSERT INTO GPT_DIALOGUE (WXID, SEQ, ROLE, CONTENT, COMPRESSED, TIME) "
+                               "VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+            if sqlite3.sqlite_version_info >= (3, 35, 0):  # 旧版SQLite不支持删除列，只清空
+                cursor.execute("ALTER TABLE USERDATA DROP COLUMN PRIVATE_GPT_DATA")
+            else:
+                cursor.execute("UPDATE USERDATA SET PRIVATE_GPT_DATA=NULL")
+
+    @staticmethod
+    def _dialogue_turns(wxid, turns) -> list:  # 内容不是字符串的消息转成字符串，转不了的跳过，避免整批写入失败
+        valid = []
+        for turn in turns:
+            content = turn.get("content")
+            if isinstance(content, list):  # OpenAI的多段内容，只保留文字部分
+                content = "".join(part.get("text", "") for part in content if isinstance(part, dict)) or None
+            elif content is not None and not isinstance(content, str):
+                content = str(content)
+                logger.warning(f"[数据库]{wxid} 的对话内容不是字符串，已转成字符串保存")
+
+            if content is None:
+                logger.warning(f"[数据库]{wxid} 的一条{turn.get('role')}对话没有文字内容，已跳过")
+                continue
+            valid.append({"role": turn["role"], "content": content})
+        return valid
+
+    def _dialogue_row(self, wxid, seq, turn) -> tuple:  # 较长的内容用zlib压缩
+        content = turn["content"]
+        compressed = 0
+        if len(content.encode()) > self.dialogue_compress_size:
+            content = zlib.compress(content.encode())
+            compressed = 1
+        return wxid, seq, turn["role"], content, compressed, time.time()
+
+    def get_wxids(self) -> set:
+        with self._read_cursor() as cursor:
+            cursor.execute("select u.WXID from USERDATA u;")  # 获取已有用户
+            return {item["WXID"] for item in cursor.fetchall()}
+
+    def load_users(self, wxids: list) -> dict:
+        rows = {}
+        with self._read_cursor() as cursor:
+            for start in range(0, len(wxids), 500):  # SQLite对参数个数有限制
+                chunk = wxids[start:start + 500]
+                cursor.execute("SELECT WXID, NICKNAME, POINTS, SIGNINSTAT, WHITELIST FROM USERDATA "
+                               f"WHERE WXID IN ({', '.join('?' * len(chunk))})", chunk)
+                for row in cursor.fetchall():
+                    rows[row.pop("WXID")] = row
+        return rows
+
+    def write_users(self, new_wxids: list, rows: dict, ledger: list) -> None:
+        with self._transaction() as cursor:
+            cursor.executemany(
+                "INSERT OR IGNORE INTO USERDATA (WXID, NICKNAME, POINTS, SIGNINSTAT, WHITELIST) VALUES (?, '', 0, 0, 0)",
+                [(wxid,) for wxid in dict.fromkeys([*new_wxids, *rows])])
+            # 积分只写入变化量，数据库里的积分始终等于流水总和
+            cursor.executemany(
+                "UPDATE USERDATA SET POINTS=POINTS+?, NICKNAME=?, SIGNINSTAT=?, WHITELIST=? WHERE WXID=?",
+                [(*row, wxid) for wxid, row in rows.items()])
+            cursor.executemany(
+                "INSERT INTO POINTS_LEDGER (WXID, CHANGE, BALANCE, REASON, TIME) VALUES (?, ?, ?, ?, ?)", ledger)
+
+    def reset_stat(self) -> None:
+        with self._transaction() as cursor:
+            cursor.execute("UPDATE USERDATA SET SIGNINSTAT=0")
+
+    def get_leaderboard(self, num: int) -> list:
+        with self._read_cursor() as cursor:  # 按索引取前几名，昵称一起取出
+            sql = "SELECT WXID, NICKNAME, POINTS FROM USERDATA ORDER BY POINTS DESC LIMIT ?"
+            arg = (num,)
+            cursor.execute(sql, arg)
+            return cursor.fetchall()
+
+    def get_user_list(self) -> list:
+        with self._read_cursor() as cursor:
+            cursor.execute("select * from USERDATA")
+            return cursor.fetchall()
+
+    def get_user_count(self) -> int:
+        with self._read_cursor() as cursor:
+            cursor.execute("select count(*) from USERDATA")
+            return cursor.fetchall()[0]["count(*)"]
+
+    def get_columns(self) -> list:
+        with self._read_cursor() as cursor:
+            cursor.execute("PRAGMA table_info(USERDATA)")
+            return [column["name"] for column in cursor.fetchall()]
+
+    def get_points_ledger(self, wxid: str, limit: int) -> list:
+        with self._read_cursor() as cursor:
+            sql = "SELECT CHANGE, BALANCE, REASON, TIME FROM POINTS_LEDGER WHERE WXID=? ORDER BY ID DESC LIMIT ?"
+            arg = (wxid, limit,)
+            cursor.execute(sql, arg)
+            return cursor.fetchall()
+
+    def audit_points(self) -> list:
+        with self._read_cursor() as cursor:
+            cursor.execute("SELECT u.WXID, u.POINTS, COALESCE(l.TOTAL, 0) AS LEDGER_POINTS FROM USERDATA u "
+                           "LEFT JOIN (SELECT WXID, SUM(CHANGE) AS TOTAL FROM POINTS_LEDGER GROUP BY WXID) l "
+                           "ON u.WXID = l.WXID WHERE u.POINTS != COALESCE(l.TOTAL, 0)")
+            return cursor.fetchall()
+
+    def rebuild_points(self, wxid: str) -> None:
+        with self._transaction() as cursor:
+            sql = "UPDATE USERDATA SET POINTS=(SELECT COALESCE(SUM(CHANGE), 0) FROM POINTS_LEDGER WHERE WXID=?) WHERE WXID=?"
+            arg = (wxid, wxid,)
+            cursor.execute(sql, arg)
+
+    def get_dialogue(self, wxid: str, limit: int) -> list:
+        with self._read_cursor() as cursor:
+            sql = "SELECT ROLE, CONTENT, COMPRESSED FROM GPT_DIALOGUE WHERE WXID=? ORDER BY SEQ DESC LIMIT ?"
+            arg = (wxid, limit,)
+            cursor.execute(sql, arg)
+            rows = cursor.fetchall()
+
+        return [{"role": row["ROLE"],
+                 "content": zlib.decompress(row["CONTENT"]).decode() if row["COMPRESSED"] else row["CONTENT"]}
+                for row in reversed(rows)]
+
+    def append_dialogue(self, wxid: str, turns: list, keep: int) -> None:
+        turns = self._dialogue_turns(wxid, turns)
+        with self._transaction() as cursor:
+            cursor.execute("SELECT COALESCE(MAX(SEQ), 0) AS SEQ FROM GPT_DIALOGUE WHERE WXID=?", (wxid,))
+            last_seq = cursor.fetchone()["SEQ"]
+
+            cursor.executemany("INSERT INTO GPT_DIALOGUE (WXID, SEQ, ROLE, CONTENT, COMPRESSED, TIME) "
+                               "VALUES (?, ?, ?, ?, ?, ?)",
+                               [self._dialogue_row(wxid, last_seq + i, turn) for i, turn in enumerate(turns, 1)])
+            if keep:
+                cursor.execute("DELETE FROM GPT_DIALOGUE WHERE WXID=? AND SEQ<=?",
+                               (wxid, last_seq + len(turns) - keep,))
+
+    def clear_dialogue(self, wxid: str) -> None:
+        with self._transaction() as cursor:
+            cursor.execute("DELETE FROM GPT_DIALOGUE WHERE WXID=?", (wxid,))
+
+
+class MemoryStorage(StorageBackend):  # 数据只在内存里，用于测试和基准测试，程序退出后丢失
+    def __init__(self):
+        self.users = {}  # wxid -> {"NICKNAME", "POINTS", "SIGNINSTAT", "WHITELIST"}
+        self.ledger = {}  # wxid -> [{"CHANGE", "BALANCE", "REASON", "TIME"}]
+        self.dialogues = {}  # wxid -> [{"role", "content"}]
+        self.lock = threading.Lock()
+
+    def get_wxids(self) -> set:
+        with self.lock:
+            return set(self.users)
+
+    def load_users(self, wxids: list) -> dict:
+        with self.lock:
+            return {wxid: dict(self.users[wxid]) for wxid in wxids if wxid in self.users}
+
+    def write_users(self, new_wxids: list, rows: dict, ledger: list) -> None:
+        with self.lock:
+            for wxid in new_wxids:
+                self.users.setdefault(wxid, new_user())
+            for wxid, (change, nickname, stat, whitelist) in rows.items():
+                user = self.users.setdefault(wxid, new_user())
+                user["POINTS"] += change
+                user["NICKNAME"], user["SIGNINSTAT"], user["WHITELIST"] = nickname, stat, whitelist
+            for wxid, change, balance, reason, change_time in ledger:
+                self.ledger.setdefault(wxid, []).append(
+                    {"CHANGE": change, "BALANCE": balance, "REASON": reason, "TIME": change_time})
+
+    def reset_stat(self) -> None:
+        with self.lock:
+            for user in self.users.values():
+                user["SIGNINSTAT"] = 0
+
+    def get_leaderboard(self, num: int) -> list:
+        with self.lock:
+            top = heapq.nlargest(num, self.users.items(), key=lambda item: item[1]["POINTS"])
+            return [{"WXID": wxid, "NICKNAME": user["NICKNAME"], "POINTS": user["POINTS"]} for wxid, user in top]
+
+    def get_user_list(self) -> list:
+        with self.lock:
+            return [{"WXID": wxid, **user} for wxid, user in self.users.items()]
+
+    def get_user_count(self) -> int:
+        with self.lock:
+            return len(self.users)
+
+    def get_points_ledger(self, wxid: str, limit: int) -> list:
+        with self.lock:
+            return [dict(entry) for entry in reversed(self.ledger.get(wxid, [])[-limit:])]
+
+    def audit_points(self) -> list:
+        with self.lock:
+            result = []
+            for wxid, user in self.users.items():
+                total = sum(entry["CHANGE"] for entry in self.ledger.get(wxid, []))
+                if user["POINTS"] != total:
+                    result.append({"WXID": wxid, "POINTS": user["POINTS"], "LEDGER_POINTS": total})
+            return result
+
+    def rebuild_points(self, wxid: str) -> None:
+        with self.lock:
+            if wxid in self.users:
+                self.users[wxid]["POINTS"] = sum(entry["CHANGE"] for entry in self.ledger.get(wxid, []))
+
+    def get_dialogue(self, wxid: str, limit: int) -> list:
+        with self.lock:
+            return [dict(turn) for turn in self.dialogues.get(wxid, [])[-limit:]] if limit else []
+
+    def append_dialogue(self, wxid: str, turns: list, keep: int) -> None:
+        with self.lock:
+            dialogue = self.dialogues.setdefault(wxid, [])
+            dialogue += [{"role": turn["role"], "content": turn["content"]} for turn in turns]
+            if keep:
+                del dialogue[:-keep]
+
+    def clear_dialogue(self, wxid: str) -> None:
+        with self.lock:
+            self.dialogues.pop(wxid, None)
+
+
+class KVClient:
+    """
+    键值数据库客户端，方法和Redis的同名命令一致，值都是字符串。
+    Key-value store client. Methods mirror the Redis commands of the same name, all values are strings.
+    """
+
+    def mget(self, keys: list) -> list:
+        raise NotImplementedError("Subclasses must implement the 'mget' method.")
+
+    def mset(self, mapping: dict) -> None:
+        raise NotImplementedError("Subclasses must implement the 'mset' method.")
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError("Subclasses must implement the 'delete' method.")
+
+    def keys(self, prefix: str) -> list:
+        raise NotImplementedError("Subclasses must implement the 'keys' method.")
+
+    def rpush(self, key: str, values: list) -> None:
+        raise NotImplementedError("Subclasses must implement the 'rpush' method.")
+
+    def lrange(self, key: str, start: int, end: int) -> list:
+        raise NotImplementedError("Subclasses must implement the 'lrange' method.")
+
+    def ltrim(self, key: str, start: int, end: int) -> None:
+        raise NotImplementedError("Subclasses must implement the 'ltrim' method.")
+
+
+class LocalKVClient(KVClient):  # 本地替身，用于在没有键值数据库时测试 KVStorage
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def mget(self, keys: list) -> list:
+        with self.lock:
+            return [self.data.get(key) for key in keys]
+
+    def mset(self, mapping: dict) -> None:
+        with self.lock:
+            self.data.update(mapping)
+
+    def delete(self, key: str) -> None:
+        with self.lock:
+            self.data.pop(key, None)
+
+    def keys(self, prefix: str) -> list:
+        with self.lock:
+            return [key for key in self.data if key.startswith(prefix)]
+
+    def rpush(self, key: str, values: list) -> None:
+        with self.lock:
+            self.data.setdefault(key, []).extend(values)
+
+    def lrange(self, key: str, start: int, end: int) -> list:  # 和Redis一样，end包含在内，可以是负数
+        with self.lock:
+            values = self.data.get(key, [])
+            end = len(values) if end == -1 else end + 1
+            return list(values[start:end])
+
+    def ltrim(self, key: str, start: int, end: int) -> None:
+        with self.lock:
+            values = self.data.get(key, [])
+            end = len(values) if end == -1 else end + 1
+            self.data[key] = values[start:end]
+
+
+class KVStorage(StorageBackend):
+    """
+    用键值数据库保存用户数据，多个机器人进程可以共用同一个数据库。
+    键值数据库没有事务，一批修改不是原子写入的，程序在写入中途退出时可能只写入一部分。
+    Store user data in a key-value store so several bot processes can share it.
+    The store has no transactions, so a batch is not written atomically.
+    """
+
+    def __init__(self, client: KVClient, prefix: str = "xybot"):
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, kind: str, wxid: str = "") -> str:
+        return f"{self.prefix}:{kind}:{wxid}"
+
+    def get_wxids(self) -> set:
+        user_prefix = self._key("user")
+        return {key[len(user_prefix):] for key in self.client.keys(user_prefix)}
+
+    def load_users(self, wxids: list) -> dict:
+        values = self.client.mget([self._key("user", wxid) for wxid in wxids])
+        return {wxid: json.loads(value) for wxid, value in zip(wxids, values) if value is not None}
+
+    def _all_users(self) -> dict:
+        return self.load_users(sorted(self.get_wxids()))
+
+    def write_users(self, new_wxids: list, rows: dict, ledger: list) -> None:
+        users = self.load_users(list(rows))
+        for wxid in new_wxids:
+            users.setdefault(wxid, new_user())
+        for wxid, (change, nickname, stat, whitelist) in rows.items():
+            user = users.setdefault(wxid, new_user())
+            user["POINTS"] += change
+            user["NICKNAME"], user["SIGNINSTAT"], user["WHITELIST"] = nickname, stat, whitelist
+        self.client.mset({self._key("user", wxid): json.dumps(user) for wxid, user in users.items()})
+
+        entries = {}
+        for wxid, change, balance, reason, change_time in ledger:
+            entries.setdefault(wxid, []).append(
+                json.dumps({"CHANGE": change, "BALANCE": balance, "REASON": reason, "TIME": change_time}))
+        for wxid, values in entries.items():
+            self.client.rpush(self._key("ledger", wxid), values)
+
+    def reset_stat(self) -> None:
+        users = self._all_users()
+        for user in users.values():
+            user["SIGNINSTAT"] = 0
+        self.client.mset({self._key("user", wxid): json.dumps(user) for wxid, user in users.items()})
+
+    def get_leaderboard(self, num: int) -> list:
+        top = heapq.nlargest(num, self._all_users().items(), key=lambda item: item[1]["POINTS"])
+        return [{"WXID": wxid, "NICKNAME": user["NICKNAME"], "POINTS": user["POINTS"]} for wxid, user in top]
+
+    def get_user_list(self) -> list:
+        return [{"WXID": wxid, **user} for wxid, user in self._all_users().items()]
+
+    def get_user_count(self) -> int:
+        return len(self.get_wxids())
+
+    def _ledger_total(self, wxid: str) -> int:
+        return sum(json.loads(value)["CHANGE"] for value in self.client.lrange(self._key("ledger", wxid), 0, -1))
+
+    def get_points_ledger(self, wxid: str, limit: int) -> list:
+        values = self.client.lrange(self._key("ledger", wxid), -limit, -1) if limit else []
+        return [json.loads(value) for value in reversed(values)]
+
+    def audit_points(self) -> list:
+        result = []
+        for wxid, user in self._all_users().items():
+            total = self._ledger_total(wxid)
+            if user["POINTS"] != total:
+                result.append({"WXID": wxid, "POINTS": user["POINTS"], "LEDGER_POINTS": total})
+        return result
+
+    def rebuild_points(self, wxid: str) -> None:
+        users = self.load_users([wxid])
+        if wxid in users:
+            users[wxid]["POINTS"] = self._ledger_total(wxid)
+            self.client.mset({self._key("user", wxid): json.dumps(users[wxid])})
+
+    def get_dialogue(self, wxid: str, limit: int) -> list:
+        values = self.client.lrange(self._key("dialogue", wxid), -limit, -1) if limit else []
+        return [json.loads(value) for value in values]
+
+    def append_dialogue(self, wxid: str, turns: list, keep: int) -> None:
+        key = self._key("dialogue", wxid)
+        self.client.rpush(key, [json.dumps({"role": turn["role"], "content": turn["content"]}) for turn in turns])
+        if keep:
+            self.client.ltrim(key, -keep, -1)
+
+    def clear_dialogue(self, wxid: str) -> None:
+        self.client.delete(self._key("dialogue", wxid))
+
+
+def create_storage(backend: str) -> StorageBackend:
+    """
+    按设置创建存储后端。Create the storage backend named in the config.
+    :param backend: "sqlite"、"memory" 或 "kv"。
+    :return: 存储后端。The storage backend.
+    """
+    if backend == "sqlite":
+        return SQLiteStorage()
+    elif backend == "memory":
+        logger.warning("[数据库] 使用内存存储，程序退出后数据会丢失")
+        return MemoryStorage()
+    elif backend == "kv":  # 接入真实的键值数据库时，把 LocalKVClient 换成实现了 KVClient 的客户端
+        logger.warning("[数据库] 使用本地键值存储替身，程序退出后数据会丢失")
+        return KVStorage(LocalKVClient())
+    else:
+        raise ValueError(f"未知的数据库后端: {backend}")
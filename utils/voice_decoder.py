@@ -0,0 +1,43 @@
+#  Copyright (c) 2024. Henry Yang
+#
+#  This program is licensed under the GNU General Public License v3.0.
+
+import io
+import wave
+
+try:
+    import pysilk
+except ImportError:  # 没装silk-python时只能拿到MP3文件
+    pysilk = None
+
+SILK_HEADER = b"#!SILK_V3"
+
+
+def silk_available() -> bool:
+    return pysilk is not None
+
+
+def decode_silk_to_wav(silk: bytes, sample_rate: int = 24000) -> bytes:
+    """
+    把微信的SILK语音解码成WAV，在工作进程里运行。
+    Decode a WeChat SILK voice message to WAV. Runs in a worker process.
+    :param silk: SILK语音数据。The SILK data.
+    :param sample_rate: 采样率。The sample rate.
+    :return: 16位单声道PCM的WAV数据。WAV data with 16-bit mono PCM.
+    """
+    if silk[1:10] == SILK_HEADER:  # 微信的SILK前面多了一个0x02字节
+        silk = silk[1:]
+    if not silk.startswith(SILK_HEADER):
+        raise ValueError(f"不是SILK语音数据，开头为 {silk[:10]!r}")
+
+    pcm = io.BytesIO()
+    pysilk.decode(io.BytesIO(silk), pcm, sample_rate)
+
+    wav = io.BytesIO()
+    with wave.open(wav, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm.getvalue())
+
+    return wav.getvalue()
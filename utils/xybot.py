@@ -3,7 +3,6 @@
 #  This program is licensed under the GNU General Public License v3.0.
 
 import asyncio
-import os
 import re
 
 import yaml
@@ -11,8 +10,9 @@ from loguru import logger
 from wcferry import client, wxmsg
 
 from utils.database import BotDatabase
+from utils.media_store import media_store
 from utils.plugin_manager import plugin_manager
-from wcferry_helper import XYBotWxMsg, async_download_image
+from wcferry_helper import XYBotWxMsg
 
 
 class XYBot:
@@ -28,10 +28,7 @@ class XYBot:
         self.ignorance_blacklist = main_config['blacklist']
         self.ignorance_whitelist = main_config['whitelist']
 
-        self.image_save_path = os.path.abspath("resources/cache")
-        self.voice_save_path = os.path.abspath("resources/cache")
-        logger.debug(f"语音保存路径: {self.voice_save_path}")
-        logger.debug(f"图片保存路径: {self.image_save_path}")
+        logger.debug(f"图片/语音保存路径: {media_store.store_path}")
 
         self.self_wxid = bot.get_self_wxid()
 
@@ -42,7 +39,7 @@ class XYBot:
         db = BotDatabase()
 
         nickname_latest = False
-        if not db.get_nickname(recv.sender):  # 如果数据库中没有这个用户的昵称，需要先获取昵称再运行插件
+        if not await db.async_get_nickname(recv.sender):  # 如果数据库中没有这个用户的昵称，需要先获取昵称再运行插件
             await self.attempt_set_nickname(bot, recv, db)
             nickname_latest = True
 
@@ -66,19 +63,19 @@ class XYBot:
     async def attempt_set_nickname(self, bot: client.Wcf, recv: XYBotWxMsg, db: BotDatabase) -> None:
         if recv.from_group():  # 如果是群聊
             nickname = bot.get_alias_in_chatroom(recv.sender, recv.roomid)
-            db.set_nickname(recv.sender, nickname)
+            await db.async_set_nickname(recv.sender, nickname)
         else:  # 如果是私聊
             flag = True
             for user in bot.contacts:
                 if user["wxid"] == recv.sender:
-                    db.set_nickname(recv.sender, user["name"])
+                    await db.async_set_nickname(recv.sender, user["name"])
                     flag = False
                     break
 
             if flag:  # 如果没有找到，重新获取一次最新的联系人列表
                 for user in bot.get_contacts():
                     if user["wxid"] == recv.sender:
-                        db.set_nickname(recv.sender, user["name"])
+                        await db.async_set_nickname(recv.sender, user["name"])
                         break
 
     async def text_message_handler(self, bot: client.Wcf, recv: XYBotWxMsg) -> None:
@@ -121,9 +118,11 @@ class XYBot:
         if not self.ignorance_check(recv):  # 屏蔽检查
             return
 
-        # 如果是图片消息，recv字典中会有一个image键值对，值为图片的绝对路径。
-        path = await async_download_image(bot, recv.id, recv.extra, self.image_save_path)
-        recv.image = os.path.abspath(path)  # 确保图片为绝对路径
+        if not plugin_manager.plugins["image"]:  # 没有图片插件，不需要下载
+            return
+
+        # 图片在插件调用 await recv.get_image() 时才下载，返回图片的绝对路径，发送前用 cache_manager.pinned_file() 固定，防止被缓存淘汰
+        recv.set_media_loader(lambda: media_store.get_image(bot, recv.id, recv.extra))
 
         # image插件调用
         for plugin in plugin_manager.plugins["image"].values():
@@ -135,8 +134,13 @@ class XYBot:
         if not self.ignorance_check(recv):  # 屏蔽检查
             return
 
-        path = await async_download_image(bot, recv.id, recv.extra, self.voice_save_path)  # 下载语音
-        recv.voice = os.path.abspath(path)  # 确保语音为绝对路径
+        if not plugin_manager.plugins["voice"]:  # 没有语音插件，不需要下载
+            return
+
+        # 语音在插件调用 await recv.get_voice() 时才下载，返回MP3文件的绝对路径
+        # 需要音频数据的插件可以调用 await recv.get_voice_wav()，直接在内存里解码，不经过磁盘
+        recv.set_media_loader(lambda: media_store.get_voice(bot, recv.id))
+        recv.set_voice_wav_loader(lambda: media_store.get_voice_wav(bot, recv.id))
 
         # voice插件调用
         for plugin in plugin_manager.plugins["voice"].values():
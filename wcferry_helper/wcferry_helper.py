@@ -5,6 +5,7 @@
 import asyncio
 import subprocess
 import time
+from concurrent.futures import Executor
 from os import path
 from platform import system
 
@@ -88,6 +89,10 @@ class XYBotWxMsg:
         self.image = ""
         self.voice = ""
         self.join_group = ""
+        self._media_loader = None  # 按需下载图片/语音的协程函数，由消息分发器设置
+        self._media_task = None
+        self._voice_wav_loader = None  # 按需解码语音的协程函数
+        self._voice_wav_task = None
 
         # 处理xml
         self.xml = xmltodict.parse(self.xml.replace('\\n|\\t| ', ''))  # 将xml转换为字典
@@ -146,8 +151,44 @@ class XYBotWxMsg:
         """是否文本消息"""
         return self.type == 1
 
-
-async def async_download_image(bot: client.Wcf, id: int, extra: str, dir: str, timeout: int = 30) -> str:
+    def set_media_loader(self, loader) -> None:
+        """设置按需下载图片/语音的协程函数"""
+        self._media_loader = loader
+
+    async def get_image(self) -> str:
+        """按需下载图片，返回图片的绝对路径，下载失败返回空字符串。文件在缓存里，发送期间请用 cache_manager.pinned_file() 固定"""
+        if not self.image:
+            self.image = await self._load_media()
+        return self.image
+
+    async def get_voice(self) -> str:
+        """按需下载语音，返回语音的绝对路径，下载失败返回空字符串"""
+        if not self.voice:
+            self.voice = await self._load_media()
+        return self.voice
+
+    def set_voice_wav_loader(self, loader) -> None:
+        """设置按需解码语音的协程函数"""
+        self._voice_wav_loader = loader
+
+    async def get_voice_wav(self) -> bytes:
+        """按需解码语音，返回16位单声道PCM的WAV数据，可用io.BytesIO当作流读取，失败返回空bytes"""
+        if self._voice_wav_loader is None:
+            return b""
+        if self._voice_wav_task is None:
+            self._voice_wav_task = asyncio.ensure_future(self._voice_wav_loader())
+        return await self._voice_wav_task
+
+    async def _load_media(self) -> str:
+        if self._media_loader is None:
+            return ""
+        if self._media_task is None:  # 多个插件同时请求时只下载一次
+            self._media_task = asyncio.ensure_future(self._media_loader())
+        return await self._media_task
+
+
+async def async_download_image(bot: client.Wcf, id: int, extra: str, dir: str, timeout: int = 30,
+                               executor: Executor = None) -> str:
     """
     Download the image asynchronously.
     :param bot: The bot.
@@ -155,22 +196,24 @@ async def async_download_image(bot: client.Wcf, id: int, extra: str, dir: str, t
     :param extra: The extra.
     :param dir: The directory.
     :param timeout: The timeout.
+    :param executor: The executor to download in, the default executor if None.
     :return: The path of the downloaded image, or an empty string if the download failed.
     """
     loop = asyncio.get_running_loop()
-    result = await loop.run_in_executor(None, bot.download_image, id, extra, dir, timeout)
+    result = await loop.run_in_executor(executor, bot.download_image, id, extra, dir, timeout)
     return result
 
 
-async def async_get_audio_msg(bot: client.Wcf, id: int, dir: str, timeout: int = 30) -> str:
+async def async_get_audio_msg(bot: client.Wcf, id: int, dir: str, timeout: int = 30, executor: Executor = None) -> str:
     """
     Get the audio message asynchronously.
     :param bot: The bot.
     :param id: The id.
     :param dir: The directory.
     :param timeout: The timeout.
+    :param executor: The executor to download in, the default executor if None.
     :return: The path of the audio message, or an empty string if the download failed.
     """
     loop = asyncio.get_running_loop()
-    result = await loop.run_in_executor(None, bot.get_audio_msg, id, dir, timeout)
+    result = await loop.run_in_executor(executor, bot.get_audio_msg, id, dir, timeout)
     return result